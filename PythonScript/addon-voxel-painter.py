@@ -23,11 +23,44 @@ THE SOFTWARE.
 
 
 import bpy
+import os
+import hashlib
+import mmap
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import OrderedDict, deque
+import time
+import traceback
+import multiprocessing
+import queue
+import numpy as np
 from bpy.props import StringProperty, BoolProperty, IntProperty, FloatProperty, \
                           FloatVectorProperty, EnumProperty, PointerProperty
 from bpy.types import Operator
+from bpy.app.handlers import persistent
 from mathutils import Vector
 from bpy_extras import view3d_utils
+from bpy_extras.io_utils import ImportHelper, ExportHelper
+
+#edge length of a voxel in VoxelArray local space, this matches the size
+#of the cube created by bpy.ops.mesh.primitive_cube_add
+VOXEL_SIZE = 2.0
+
+#name of the mesh datablock shared by voxel objects, see get_voxel_cube_mesh
+VOXEL_CUBE_MESH_NAME = "VoxelCube"
+
+#edge length, in voxels, of the chunks a VoxelGrid is split into
+CHUNK_SIZE = 16
+
+#time in seconds that remeshing after an edit in the voxel editor may take
+#before the rest of the work is deferred, a bit less than one frame at 60fps
+#to leave blender some time to redraw
+REMESH_BUDGET = 0.012
+
+#seconds between the ray casts of a brush stroke
+STROKE_SAMPLE_INTERVAL = 1.0 / 60.0
 
 #Miscelaneous Functions and classes
 def operator_contextswitch(context, obj, operator, **argsdic):
@@ -59,6 +92,18 @@ def select_none(context, active=False):
     if(not active):
         set_active(context, None)
 
+def remove_object(context, obj):
+    """delete an object and its mesh through bpy.data, which unlike
+    bpy.ops.object.delete doesn't depend on, or change, the selection"""
+    for child in obj.children:
+        remove_object(context, child)
+    data = obj.data
+    if obj.name in context.scene.objects:
+        context.scene.objects.unlink(obj)
+    bpy.data.objects.remove(obj)
+    if data is not None and data.users == 0:
+        bpy.data.meshes.remove(data)
+
 class SelectionBackup(object):
     """This class is used for creating a backup of the context
     in the current scene. active_only flag is used to tell it
@@ -92,13 +137,3286 @@ class SelectionBackup(object):
         set_active(self.context, self.active)
         #print("done restoring active")
 
+#Voxel grid storage
+def pos_to_coord(pos):
+    """Convert a position in VoxelArray local space to the integer
+    (x, y, z) grid coordinate of the voxel containing it"""
+    return (int(round(pos[0] / VOXEL_SIZE)),
+            int(round(pos[1] / VOXEL_SIZE)),
+            int(round(pos[2] / VOXEL_SIZE)))
+
+def coord_to_pos(coord):
+    """Convert an integer grid coordinate to the position of the voxel
+    centre in VoxelArray local space"""
+    return Vector((coord[0] * VOXEL_SIZE,
+                   coord[1] * VOXEL_SIZE,
+                   coord[2] * VOXEL_SIZE))
+
+def chunk_key(coord):
+    """return the key of the chunk containing the integer grid coordinate"""
+    return (coord[0] // CHUNK_SIZE,
+            coord[1] // CHUNK_SIZE,
+            coord[2] // CHUNK_SIZE)
+
+def chunk_name(key):
+    """name of the entry for a chunk in the ID properties of the empty"""
+    return "{0},{1},{2}".format(key[0], key[1], key[2])
+
+def chunk_name_key(name):
+    return tuple(int(k) for k in name.split(","))
+
+class VoxelChunk(object):
+    """A dense CHUNK_SIZE^3 block of cells of a VoxelGrid. The values buffer
+    holds the attribute of each cell, where 0 means the cell is empty, so it
+    doubles as the occupancy buffer. The dirty flag is set by every edit and
+    cleared by whatever consumes the chunk (meshing, saving etc.), the
+    generation is the grid generation of the last edit of the chunk"""
+
+    def __init__(self, key):
+        self.key = tuple(key)
+        self.values = np.zeros((CHUNK_SIZE,) * 3, dtype=np.uint8)
+        self.count = 0
+        self.dirty = True
+        self.generation = 0
+        #(generation, bytes) of the last encode_chunk of the values
+        self._encoded = None
+        #(generation, rows) of the last pack_occupancy of the values
+        self._bits = None
+
+    def encoded(self):
+        """the values run through encode_chunk, which is only redone when
+        the chunk has been edited since the last call"""
+        if self._encoded is None or self._encoded[0] != self.generation:
+            self._encoded = (self.generation, encode_chunk(self.values))
+        return self._encoded[1]
+
+    def is_encoded(self):
+        return (self._encoded is not None and
+                self._encoded[0] == self.generation)
+
+    def bits(self):
+        """the occupancy packed into bits, see pack_occupancy, which is only
+        repacked when the chunk has been edited since the last call"""
+        if self._bits is None or self._bits[0] != self.generation:
+            self._bits = (self.generation, pack_occupancy(self.values))
+        return self._bits[1]
+
+    def origin(self):
+        """grid coordinate of the cell at local index (0, 0, 0)"""
+        return np.array(self.key, dtype=np.int32) * CHUNK_SIZE
+
+    def local(self, coord):
+        return (coord[0] - self.key[0] * CHUNK_SIZE,
+                coord[1] - self.key[1] * CHUNK_SIZE,
+                coord[2] - self.key[2] * CHUNK_SIZE)
+
+    def occupancy(self):
+        return self.values != 0
+
+    def coords(self):
+        """(n, 3) int32 array of the occupied cells in grid coordinates"""
+        return np.argwhere(self.values).astype(np.int32) + self.origin()
+
+    def __len__(self):
+        return self.count
+
+class VoxelGrid(object):
+    """Sparse voxel storage which is independent of blender. The grid is
+    split into fixed size VoxelChunks, kept in a hash map from the chunk key
+    to the chunk, so only the regions which contain voxels use memory, and
+    adding, deleting and looking up voxels are O(1). Each chunk keeps its
+    own dense buffer and dirty flag, so an edit only invalidates the chunk
+    it touches, and whole chunks can be handed to numpy in bulk.
+    Values are 1-255, 0 is reserved for empty cells.
+    Every edit bumps the generation of the grid and stamps it on the chunk,
+    so anything derived from the grid can remember the generation it was
+    built at, and find what has changed since with edited_since.
+    A grid can be attached to a saved grid blob, see attach, in which case
+    its chunks are only decoded when they are first asked for, so chunks
+    holds the loaded chunks, and chunk_keys all of them.
+    When the grid has a VoxelJournal, every edit records the cells it
+    changes in the journal, so it can be undone.
+    Blender objects are only used to display what is stored in here."""
+
+    def __init__(self):
+        self.chunks = {}
+        self.n = 0
+        self.generation = 0
+        self.source = None
+        self.journal = None
+        #generation given to the chunks of the source as they are loaded
+        self.load_generation = 0
+        #why the saved voxels couldn't be loaded, if they couldn't
+        self.load_error = None
+        self._lazy = {}
+        self._dropped = {}
+        self._bounds = None
+        self._bounds_loose = False
+
+    def attach(self, source):
+        """take the chunks of source, a GridBlobSource, without decoding
+        any of them. Only the chunk counts are read up front, each chunk
+        is decoded the first time get_chunk is called for it"""
+        self.source = source
+        counts = source.counts()
+        self._lazy.update(counts)
+        self.n += sum(counts.values())
+        self._bounds = None
+
+    def _load(self, key):
+        data = self.source.read(key)
+        chunk = VoxelChunk(key)
+        chunk.values[...] = decode_chunk(data)
+        chunk.count = self._lazy.pop(key)
+        chunk.dirty = False
+        chunk.generation = self.load_generation
+        chunk._encoded = (chunk.generation, data)
+        self.chunks[key] = chunk
+        return chunk
+
+    def load_all(self):
+        """decode every chunk which hasn't been loaded yet"""
+        for key in list(self._lazy):
+            self._load(key)
+
+    def unload(self, key):
+        """drop a loaded chunk which is the same as the one in the source,
+        to free its memory, it is decoded again when it's next asked for.
+        returns False, and keeps the chunk, if it has changes the source
+        doesn't have, or hasn't been displayed since it was edited"""
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            return key in self._lazy
+        if (self.source is None or chunk.dirty or not chunk.count or
+                not chunk.is_encoded() or key not in self.source.entries):
+            return False
+        del self.chunks[key]
+        self._lazy[key] = chunk.count
+        return True
+
+    def chunk_keys(self):
+        """the keys of all the chunks, loaded or not"""
+        keys = set(self.chunks)
+        keys.update(self._lazy)
+        return keys
+
+    def chunk_counts(self):
+        """chunk key -> voxel count of all the chunks, loaded or not"""
+        counts = dict(self._lazy)
+        counts.update((key, chunk.count) for key, chunk in self.chunks.items())
+        return counts
+
+    def encoded_chunks(self):
+        """yield (key, count, encode_chunk bytes) for every chunk which
+        holds voxels, in key order. Chunks which haven't been loaded are
+        copied from the source as they are"""
+        for key in sorted(self.chunk_keys()):
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                yield key, self._lazy[key], self.source.read(key)
+            elif chunk.count:
+                yield key, chunk.count, chunk.encoded()
+
+    def get_chunk(self, key, create=False):
+        chunk = self.chunks.get(key)
+        if chunk is None and key in self._lazy:
+            chunk = self._load(key)
+        if chunk is None and create:
+            chunk = VoxelChunk(key)
+            self.chunks[key] = chunk
+        return chunk
+
+    def set(self, coord, value=1):
+        """Occupy the cell at coord, or update its value if it is
+        already occupied"""
+        coord = (int(coord[0]), int(coord[1]), int(coord[2]))
+        chunk = self.get_chunk(chunk_key(coord), create=True)
+        local = chunk.local(coord)
+        self._record(chunk, local, value)
+        if chunk.values[local] == 0:
+            chunk.count += 1
+            self.n += 1
+            if self._bounds is not None:
+                lo, hi = self._bounds
+                np.minimum(lo, coord, out=lo)
+                np.maximum(hi, coord, out=hi)
+        chunk.values[local] = value
+        chunk.dirty = True
+        self._touch(chunk)
+        self._touch_neighbours(local, chunk.key)
+
+    def _touch(self, chunk):
+        self.generation += 1
+        chunk.generation = self.generation
+
+    def _record(self, chunk, local, value):
+        """record the change of one cell of a chunk in the journal"""
+        if self.journal is not None:
+            index = (local[0] * CHUNK_SIZE + local[1]) * CHUNK_SIZE + local[2]
+            self.journal.record(chunk.key, [index], chunk.values[local],
+                                value)
+
+    def _touch_neighbours(self, local, key):
+        """mark the chunks next to a cell on the border of its chunk as
+        dirty, because the faces they display depend on the cell"""
+        for axis in range(3):
+            if local[axis] == 0:
+                side = -1
+            elif local[axis] == CHUNK_SIZE - 1:
+                side = 1
+            else:
+                continue
+            nkey = list(key)
+            nkey[axis] += side
+            neighbour = self.get_chunk(tuple(nkey))
+            if neighbour is not None:
+                neighbour.dirty = True
+
+    def remove(self, coord):
+        """Clear the cell at coord, returns False if it was empty"""
+        coord = (int(coord[0]), int(coord[1]), int(coord[2]))
+        chunk = self.get_chunk(chunk_key(coord))
+        if chunk is None:
+            return False
+        local = chunk.local(coord)
+        if chunk.values[local] == 0:
+            return False
+
+        self._record(chunk, local, 0)
+        chunk.values[local] = 0
+        chunk.count -= 1
+        chunk.dirty = True
+        self._touch(chunk)
+        self._touch_neighbours(local, chunk.key)
+        self.n -= 1
+        if self._bounds is not None:
+            lo, hi = self._bounds
+            if (lo == coord).any() or (hi == coord).any():
+                self._bounds_loose = True
+        return True
+
+    def set_many(self, coords, value=1):
+        """set for an (n, 3) array of cells at once, a chunk at a time.
+        value is either one value for all of them, or an (n,) array of
+        a value per cell"""
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        if len(coords) == 0:
+            return
+        value = np.asarray(value, dtype=np.uint8)
+        for key, cells, local in self._chunk_cells(coords):
+            self._write_cells(key, local,
+                              value if value.ndim == 0 else value[cells])
+        if self._bounds is not None:
+            lo, hi = self._bounds
+            np.minimum(lo, coords.min(axis=0), out=lo)
+            np.maximum(hi, coords.max(axis=0), out=hi)
+
+    def remove_many(self, coords):
+        """remove for an (n, 3) array of cells at once, a chunk at a time,
+        the cells which are already empty are left alone"""
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        if len(coords) == 0:
+            return
+        for key, cells, local in self._chunk_cells(coords):
+            if self.get_chunk(key) is not None:
+                self._write_cells(key, local, 0)
+        self._bounds_loose = True
+
+    def fill_mask(self, lo, mask, value=1):
+        """fill the empty cells where the boolean array mask is True with
+        value, leaving the values of the cells which are occupied already,
+        or remove the cells if value is 0, mask[0, 0, 0] being the cell lo.
+        The mask is cut up along the chunk borders and each piece is
+        applied to its chunk at once, only to the cells it changes"""
+        lo = np.asarray(lo, dtype=np.int64)
+        hi = lo + mask.shape
+        key_lo = lo // CHUNK_SIZE
+        key_hi = (hi - 1) // CHUNK_SIZE
+        for kx in range(key_lo[0], key_hi[0] + 1):
+            for ky in range(key_lo[1], key_hi[1] + 1):
+                for kz in range(key_lo[2], key_hi[2] + 1):
+                    key = (int(kx), int(ky), int(kz))
+                    origin = np.array(key, dtype=np.int64) * CHUNK_SIZE
+                    start = np.maximum(lo, origin)
+                    end = np.minimum(hi, origin + CHUNK_SIZE)
+                    piece = mask[tuple(slice(a, b) for a, b in
+                                       zip(start - lo, end - lo))]
+                    if not piece.any():
+                        continue
+                    chunk = self.get_chunk(key)
+                    if chunk is not None:
+                        cells = chunk.values[tuple(
+                            slice(a, b) for a, b in
+                            zip(start - origin, end - origin))]
+                        piece = piece & ((cells == 0) if value else
+                                         (cells != 0))
+                    elif value == 0:
+                        continue
+                    local = np.argwhere(piece) + (start - origin)
+                    if len(local):
+                        self._write_cells(key, local, value)
+        if value == 0:
+            self._bounds_loose = True
+        elif self._bounds is not None:
+            cells = np.argwhere(mask)
+            lo_cell, hi_cell = self._bounds
+            np.minimum(lo_cell, lo + cells.min(axis=0), out=lo_cell)
+            np.maximum(hi_cell, lo + cells.max(axis=0), out=hi_cell)
+
+    def fill_chunk_masks(self, masks, value=1):
+        """set the cells where masks, a dict of chunk key -> boolean
+        CHUNK_SIZE^3 array, are True to value, or remove them if value
+        is 0"""
+        for key, mask in masks.items():
+            if value == 0 and self.get_chunk(key) is None:
+                continue
+            self._write_cells(key, np.argwhere(mask), value)
+        if value == 0:
+            self._bounds_loose = True
+        else:
+            self._bounds = None
+
+    def _chunk_cells(self, coords):
+        """group an (n, 3) array of cells by chunk, yields the chunk key,
+        the indices of the cells in coords and their local coordinates"""
+        keys = coords // CHUNK_SIZE
+        local = coords - keys * CHUNK_SIZE
+        #sort on one int64 per chunk key
+        key_lo = keys.min(axis=0)
+        dims = tuple(keys.max(axis=0) - key_lo + 1)
+        flat = np.ravel_multi_index((keys - key_lo).T, dims)
+        order = np.argsort(flat, kind="stable")
+        flat, starts = np.unique(flat[order], return_index=True)
+        keys = np.stack(np.unravel_index(flat, dims), axis=1) + key_lo
+        for key, cells in zip(keys.tolist(), np.split(order, starts[1:])):
+            yield tuple(key), cells, local[cells]
+
+    def _write_cells(self, key, local, values, record=True):
+        """set the cells of a chunk at local, an (m, 3) array, to values,
+        and bring the count and dirty flags in line"""
+        chunk = self.get_chunk(key, create=True)
+        x, y, z = local.T
+        if record and self.journal is not None:
+            self.journal.record(key, np.ravel_multi_index(
+                (x, y, z), (CHUNK_SIZE,) * 3), chunk.values[x, y, z], values)
+        chunk.values[x, y, z] = values
+        count = int(np.count_nonzero(chunk.values))
+        self.n += count - chunk.count
+        chunk.count = count
+        chunk.dirty = True
+        self._touch(chunk)
+        for axis, side in BOX_PLANES:
+            edge = 0 if side < 0 else CHUNK_SIZE - 1
+            if (local[:, axis] == edge).any():
+                nkey = list(key)
+                nkey[axis] += side
+                neighbour = self.get_chunk(tuple(nkey))
+                if neighbour is not None:
+                    neighbour.dirty = True
+
+    def restore_cells(self, key, index, values):
+        """put back the values of the cells of a chunk at the flat indices
+        in index, for the VoxelJournal, so it isn't recorded as an edit"""
+        local = np.stack(np.unravel_index(index, (CHUNK_SIZE,) * 3), axis=1)
+        self._write_cells(key, local, values, record=False)
+        self._bounds = None
+
+    def get(self, coord, default=0):
+        chunk = self.get_chunk(chunk_key(coord))
+        if chunk is None:
+            return default
+        value = chunk.values[chunk.local(coord)]
+        if value == 0:
+            return default
+        return int(value)
+
+    def set_chunk_values(self, key, values):
+        """replace the whole value buffer of a chunk in one go"""
+        chunk = self.get_chunk(tuple(key), create=True)
+        count = int(np.count_nonzero(values))
+        if self.journal is not None:
+            index = np.flatnonzero(chunk.values != values)
+            self.journal.record(chunk.key, index,
+                                chunk.values.ravel()[index],
+                                np.asarray(values).ravel()[index])
+        chunk.values[...] = values
+        self.n += count - chunk.count
+        chunk.count = count
+        chunk.dirty = True
+        self._touch(chunk)
+        for axis, side in BOX_PLANES:
+            nkey = list(chunk.key)
+            nkey[axis] += side
+            neighbour = self.get_chunk(tuple(nkey))
+            if neighbour is not None:
+                neighbour.dirty = True
+        self._bounds = None
+
+    def clear(self):
+        if self.journal is not None:
+            #the journal needs the values which are cleared
+            self.load_all()
+        #no need to decode the chunks which are about to be emptied
+        for key in list(self._lazy):
+            self.chunks[key] = VoxelChunk(key)
+        self._lazy.clear()
+        for chunk in self.chunks.values():
+            if self.journal is not None and chunk.count:
+                index = np.flatnonzero(chunk.values)
+                self.journal.record(chunk.key, index,
+                                    chunk.values.ravel()[index], 0)
+            chunk.values[...] = 0
+            chunk.count = 0
+            chunk.dirty = True
+            self._touch(chunk)
+        self.n = 0
+        self._bounds = None
+        self._bounds_loose = False
+
+    def dirty_chunks(self):
+        """return the keys of the chunks modified since they were last
+        cleaned, including chunks which have become empty"""
+        return [key for key, chunk in self.chunks.items() if chunk.dirty]
+
+    def clean_chunk(self, key):
+        """clear the dirty flag of a chunk once it has been consumed, and
+        drop it if it no longer holds any voxels"""
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            return
+        chunk.dirty = False
+        if chunk.count == 0:
+            #remember when the chunk went, for edited_since
+            self._dropped[key] = chunk.generation
+            del self.chunks[key]
+
+    def edited_since(self, generation):
+        """return the keys of the chunks edited after the grid generation,
+        including chunks which have been dropped since, and the chunks
+        which haven't been loaded yet if they are loaded at a later
+        generation"""
+        keys = set(key for key, chunk in self.chunks.items()
+                   if chunk.generation > generation)
+        if self.load_generation > generation:
+            keys.update(self._lazy)
+        keys.update(key for key, dropped in self._dropped.items()
+                    if dropped > generation)
+        return keys
+
+    def padded_values(self, key):
+        """return the values of a chunk with a one cell border taken from
+        the six face neighbours, so the neighbours of every cell on the
+        boundary of the chunk can be tested without a hash lookup"""
+        n = CHUNK_SIZE
+        padded = np.zeros((n + 2,) * 3, dtype=np.uint8)
+        chunk = self.get_chunk(key)
+        if chunk is not None:
+            padded[1:-1, 1:-1, 1:-1] = chunk.values
+
+        for axis in range(3):
+            for side, src, dst in ((-1, n - 1, 0), (1, 0, n + 1)):
+                nkey = list(key)
+                nkey[axis] += side
+                neighbour = self.get_chunk(tuple(nkey))
+                if neighbour is None:
+                    continue
+                src_index = [slice(None)] * 3
+                src_index[axis] = src
+                dst_index = [slice(1, -1)] * 3
+                dst_index[axis] = dst
+                padded[tuple(dst_index)] = neighbour.values[tuple(src_index)]
+        return padded
+
+    def occupancy_bits(self, key):
+        """the packed occupancy of a chunk, see pack_occupancy, all zeros
+        for a chunk which doesn't exist. Don't write to it"""
+        chunk = self.get_chunk(key)
+        if chunk is None:
+            return _NO_BITS
+        return chunk.bits()
+
+    def coords(self):
+        """(n, 3) int32 array of the occupied cells"""
+        self.load_all()
+        parts = [c.coords() for c in self.chunks.values() if c.count]
+        if not parts:
+            return np.empty((0, 3), dtype=np.int32)
+        return np.concatenate(parts)
+
+    def values(self):
+        """(n,) uint8 array of the values matching coords()"""
+        self.load_all()
+        parts = [c.values[c.values != 0] for c in self.chunks.values()
+                 if c.count]
+        if not parts:
+            return np.empty(0, dtype=np.uint8)
+        return np.concatenate(parts)
+
+    def bounds(self, exact=False):
+        """return the (min, max) corner cells, or None for an empty grid.
+        Deleting voxels doesn't shrink the bounds unless exact is True, so
+        they may enclose some empty space, which is fine for ray casting
+        and saves a rescan of the grid after every delete. Chunks which
+        haven't been loaded count as full unless exact is True"""
+        if self.n == 0:
+            return None
+        if exact and self._lazy:
+            self.load_all()
+            self._bounds_loose = True
+        if self._bounds is None or (exact and self._bounds_loose):
+            self._bounds_loose = bool(self._lazy)
+            #only look at the occupied rows of each chunk, rather than
+            #gathering every coordinate in the grid
+            lo = np.full(3, np.iinfo(np.int32).max, dtype=np.int32)
+            hi = np.full(3, np.iinfo(np.int32).min, dtype=np.int32)
+            if self._lazy:
+                keys = np.array(list(self._lazy), dtype=np.int32)
+                np.minimum(lo, keys.min(axis=0) * CHUNK_SIZE, out=lo)
+                np.maximum(hi, keys.max(axis=0) * CHUNK_SIZE + CHUNK_SIZE - 1,
+                           out=hi)
+            for chunk in self.chunks.values():
+                if chunk.count == 0:
+                    continue
+                origin = chunk.origin()
+                for axis in range(3):
+                    others = tuple(a for a in range(3) if a != axis)
+                    rows = np.nonzero(chunk.values.any(axis=others))[0]
+                    lo[axis] = min(lo[axis], origin[axis] + rows[0])
+                    hi[axis] = max(hi[axis], origin[axis] + rows[-1])
+            self._bounds = (lo, hi)
+        lo, hi = self._bounds
+        return lo.copy(), hi.copy()
+
+    def __contains__(self, coord):
+        chunk = self.get_chunk(chunk_key(coord))
+        if chunk is None:
+            return False
+        return chunk.values[chunk.local(coord)] != 0
+
+    def __iter__(self):
+        for coord in self.coords():
+            yield tuple(coord.tolist())
+
+    def __len__(self):
+        return self.n
+
+#most steps, and most cells over all the steps, a VoxelJournal keeps before
+#dropping the oldest steps
+JOURNAL_MAX_STEPS = 256
+JOURNAL_MAX_CELLS = 1 << 24
+
+class VoxelJournal(object):
+    """The edits of a VoxelGrid as deltas, so they can be undone and redone
+    in time proportional to the cells they changed, rather than the size
+    of the grid. The grid records every cell it changes as it goes, and
+    commit closes the edits since the last commit into a step, which is a
+    list of (chunk key, flat cell indices, old values, new values), with
+    one entry per cell.
+    Each step has an id, and so does the state the grid started in, which
+    is how the steps are matched with blender's undo steps, see
+    voxel_grids_undo_handler."""
+
+    def __init__(self, base_id=0):
+        self.base_id = base_id
+        self.next_id = base_id
+        #(id, step) of the steps, the first position of which are applied
+        self.steps = []
+        self.position = 0
+        self.n_cells = 0
+        #chunk key -> list of (index, old, new) recorded since the commit
+        self.pending = {}
+
+    def record(self, key, index, old, new):
+        index = np.asarray(index, dtype=np.uint16).ravel()
+        values = []
+        for value in (old, new):
+            value = np.array(value, dtype=np.uint8)
+            if value.ndim == 0:
+                value = np.full(index.shape, value, dtype=np.uint8)
+            values.append(value.ravel())
+        self.pending.setdefault(key, []).append((index,) + tuple(values))
+
+    def current_id(self):
+        if self.position:
+            return self.steps[self.position - 1][0]
+        return self.base_id
+
+    @staticmethod
+    def step_cells(step):
+        return sum(len(index) for key, index, old, new in step)
+
+    def commit(self):
+        """make the edits recorded since the last commit a step, dropping
+        the steps which were undone. Returns the id of the step, or None
+        if nothing actually changed"""
+        step = []
+        for key, records in sorted(self.pending.items()):
+            index = np.concatenate([r[0] for r in records])
+            old = np.concatenate([r[1] for r in records])
+            new = np.concatenate([r[2] for r in records])
+            #a cell edited more than once goes from its first old value
+            #to its last new value
+            order = np.argsort(index, kind="stable")
+            index, old, new = index[order], old[order], new[order]
+            first = np.ones(len(index), dtype=bool)
+            first[1:] = index[1:] != index[:-1]
+            last = np.ones(len(index), dtype=bool)
+            last[:-1] = first[1:]
+            index, old, new = index[first], old[first], new[last]
+            changed = old != new
+            if changed.any():
+                step.append((key, index[changed], old[changed], new[changed]))
+        self.pending = {}
+        if not step:
+            return None
+
+        for step_id, undone in self.steps[self.position:]:
+            self.n_cells -= self.step_cells(undone)
+        del self.steps[self.position:]
+        self.next_id += 1
+        self.steps.append((self.next_id, step))
+        self.position += 1
+        self.n_cells += self.step_cells(step)
+        #the oldest steps go for good, their ids can't be sought any more
+        while len(self.steps) > 1 and (
+                len(self.steps) > JOURNAL_MAX_STEPS or
+                self.n_cells > JOURNAL_MAX_CELLS):
+            self.base_id, oldest = self.steps.pop(0)
+            self.n_cells -= self.step_cells(oldest)
+            self.position -= 1
+        return self.next_id
+
+    def reset(self):
+        """forget all the steps and the pending edits, for an edit which is
+        too big to journal, and give the state the grid is in a new id,
+        which is returned. The states before it can't be sought any more"""
+        self.next_id += 1
+        self.base_id = self.next_id
+        self.steps = []
+        self.position = 0
+        self.n_cells = 0
+        self.pending = {}
+        return self.base_id
+
+    def revert_pending(self, grid):
+        """put back the cells edited since the last commit"""
+        for key, records in self.pending.items():
+            for index, old, new in reversed(records):
+                grid.restore_cells(key, index, old)
+        self.pending = {}
+
+    def undo(self, grid):
+        step_id, step = self.steps[self.position - 1]
+        for key, index, old, new in step:
+            grid.restore_cells(key, index, old)
+        self.position -= 1
+
+    def redo(self, grid):
+        step_id, step = self.steps[self.position]
+        for key, index, old, new in step:
+            grid.restore_cells(key, index, new)
+        self.position += 1
+
+    def seek(self, grid, step_id):
+        """undo or redo steps until the grid is in the state after the
+        step step_id, returns False if the journal doesn't have the step"""
+        ids = [self.base_id] + [s[0] for s in self.steps]
+        if step_id not in ids:
+            return False
+        self.revert_pending(grid)
+        target = ids.index(step_id)
+        while self.position > target:
+            self.undo(grid)
+        while self.position < target:
+            self.redo(grid)
+        return True
+
+def grid_raycast(grid, origin, direction, max_t):
+    """Walk the cells of the grid along a ray using the Amanatides & Woo
+    3D-DDA algorithm, and return (coord, normal, t) for the first occupied
+    cell, or None if the ray leaves the grid first. origin and direction
+    are in grid space, where the cell (x, y, z) spans [x, x + 1) on each
+    axis, and the hit point is origin + direction * t. normal is the
+    integer normal of the face of the cell the ray entered through.
+    Only the cells along the ray are visited, so the cost depends on the
+    length of the ray through the grid rather than the number of voxels."""
+    bounds = grid.bounds()
+    if bounds is None:
+        return None
+    lo, hi = bounds
+
+    #clip the ray against the bounding box of the grid
+    t_enter = 0.0
+    t_exit = max_t
+    enter_axis = -1
+    for axis in range(3):
+        o = origin[axis]
+        d = direction[axis]
+        box_lo = float(lo[axis])
+        box_hi = float(hi[axis] + 1)
+        if d == 0.0:
+            if o < box_lo or o >= box_hi:
+                return None
+            continue
+        t0 = (box_lo - o) / d
+        t1 = (box_hi - o) / d
+        if t0 > t1:
+            t0, t1 = t1, t0
+        if t0 > t_enter:
+            t_enter = t0
+            enter_axis = axis
+        t_exit = min(t_exit, t1)
+        if t_enter > t_exit:
+            return None
+
+    cell = [0, 0, 0]
+    step = [0, 0, 0]
+    t_max = [float("inf")] * 3
+    t_delta = [float("inf")] * 3
+    normal = [0, 0, 0]
+    for axis in range(3):
+        d = direction[axis]
+        p = origin[axis] + d * t_enter
+        c = int(np.floor(p))
+        #points on the far side of the box round outside it
+        cell[axis] = min(max(c, int(lo[axis])), int(hi[axis]))
+        if d > 0.0:
+            step[axis] = 1
+            t_max[axis] = (cell[axis] + 1 - origin[axis]) / d
+            t_delta[axis] = 1.0 / d
+        elif d < 0.0:
+            step[axis] = -1
+            t_max[axis] = (cell[axis] - origin[axis]) / d
+            t_delta[axis] = -1.0 / d
+    if enter_axis != -1:
+        normal[enter_axis] = -step[enter_axis]
+
+    t = t_enter
+    while t <= t_exit:
+        if tuple(cell) in grid:
+            return tuple(cell), tuple(normal), t
+
+        if t_max[0] < t_max[1]:
+            axis = 0 if t_max[0] < t_max[2] else 2
+        else:
+            axis = 1 if t_max[1] < t_max[2] else 2
+        t = t_max[axis]
+        cell[axis] += step[axis]
+        t_max[axis] += t_delta[axis]
+        normal = [0, 0, 0]
+        normal[axis] = -step[axis]
+
+    return None
+
+def brush_mask(shape, radius, axis=2):
+    """boolean array of the cells inside a brush, (2 * radius + 1) cells
+    across with the centre of the brush in the middle cell. shape is
+    'SPHERE', 'BOX' or 'CYLINDER', the cylinder standing along axis"""
+    d = np.arange(-radius, radius + 1)
+    x, y, z = np.ix_(d, d, d)
+    size = 2 * radius + 1
+    if shape == 'SPHERE':
+        #half a cell more than the radius, so the poles aren't single cells
+        mask = x * x + y * y + z * z <= (radius + 0.5) ** 2
+    elif shape == 'CYLINDER':
+        mask = np.repeat(x * x + y * y <= (radius + 0.5) ** 2, size, axis=2)
+        mask = np.swapaxes(mask, 2, axis)
+    else:
+        mask = np.ones((size,) * 3, dtype=bool)
+    return mask
+
+#Region operations
+#Fills and hollowing work on the dense value buffers of the chunks, as
+#boolean masks of CHUNK_SIZE^3 cells per chunk key. A flood fill floods
+#one chunk at a time by dilating the seed cells within the region until
+#they stop growing, then hands the cells it reached on the border of the
+#chunk to the neighbouring chunks as their seeds, through a queue.
+_ALL_CELLS = np.ones((CHUNK_SIZE,) * 3, dtype=bool)
+_ALL_CELLS.flags.writeable = False
+
+def dilate(mask, connectivity=6):
+    """grow a boolean array by a cell, to the 6 face neighbours, or to all
+    26 neighbours of each cell. Nothing wraps around the edges"""
+    if connectivity == 26:
+        #the 3x3x3 box is three 3 cell lines, one along each axis
+        grown = mask
+        for axis in range(3):
+            grown = grown | shift_cells(grown, axis, 1) | \
+                shift_cells(grown, axis, -1)
+        return grown
+    grown = mask.copy()
+    for axis in range(3):
+        grown |= shift_cells(mask, axis, 1)
+        grown |= shift_cells(mask, axis, -1)
+    return grown
+
+def erode(mask, connectivity=6):
+    """shrink a boolean array by a cell, the opposite of dilate. Cells on
+    the edges of the array are taken to have solid neighbours outside"""
+    return ~dilate(~mask, connectivity)
+
+def shift_cells(mask, axis, step):
+    """mask moved one cell along axis, filling in with False"""
+    shifted = np.zeros_like(mask)
+    src = [slice(None)] * 3
+    dst = [slice(None)] * 3
+    if step > 0:
+        src[axis] = slice(None, -1)
+        dst[axis] = slice(1, None)
+    else:
+        src[axis] = slice(1, None)
+        dst[axis] = slice(None, -1)
+    shifted[tuple(dst)] = mask[tuple(src)]
+    return shifted
+
+def box_mask(key, lo, hi):
+    """the cells of a chunk inside the box of cells lo to hi inclusive, or
+    None if none of them are"""
+    origin = np.array(key, dtype=np.int64) * CHUNK_SIZE
+    start = np.maximum(lo - origin, 0)
+    end = np.minimum(hi - origin + 1, CHUNK_SIZE)
+    if (end <= start).any():
+        return None
+    if (start == 0).all() and (end == CHUNK_SIZE).all():
+        return _ALL_CELLS
+    mask = np.zeros((CHUNK_SIZE,) * 3, dtype=bool)
+    mask[start[0]:end[0], start[1]:end[1], start[2]:end[2]] = True
+    return mask
+
+def chunk_box_keys(lo, hi):
+    """the keys of the chunks overlapping the box of cells lo to hi"""
+    key_lo = np.asarray(lo) // CHUNK_SIZE
+    key_hi = np.asarray(hi) // CHUNK_SIZE
+    for kx in range(key_lo[0], key_hi[0] + 1):
+        for ky in range(key_lo[1], key_hi[1] + 1):
+            for kz in range(key_lo[2], key_hi[2] + 1):
+                yield (int(kx), int(ky), int(kz))
+
+def flood_region(grid, seeds, connectivity=6, box=None):
+    """flood the cells connected to the seeds, a dict of chunk key ->
+    boolean mask, through the cells with the same value as the seed cells,
+    which is 0 to flood empty space. The flood is kept in box, (lo, hi)
+    cells inclusive, which it must be given when flooding empty space.
+    returns a dict of chunk key -> boolean mask of the cells reached"""
+    filled = {}
+    target = None
+    pending = dict(seeds)
+    frontier = deque(pending)
+    while frontier:
+        key = frontier.popleft()
+        seed = pending.pop(key)
+        chunk = grid.get_chunk(key)
+        if target is None:
+            values = chunk.values if chunk is not None else None
+            target = 0 if values is None else int(values[seed][0])
+        if box is None:
+            inside = _ALL_CELLS
+        else:
+            inside = box_mask(key, box[0], box[1])
+            if inside is None:
+                continue
+        if chunk is None:
+            if target != 0:
+                continue
+            region = inside
+        else:
+            region = (chunk.values == target) & inside
+        done = filled.get(key)
+        if done is not None:
+            region = region & ~done
+        grown = seed & region
+        if not grown.any():
+            continue
+
+        if chunk is None:
+            #the empty part of the box in an empty chunk is all one region
+            grown = region
+        else:
+            while True:
+                more = dilate(grown, connectivity) & region
+                if (more == grown).all():
+                    break
+                grown = more
+        filled[key] = grown if done is None else done | grown
+
+        #seed the neighbours with the cells next to the border
+        padded = np.zeros((CHUNK_SIZE + 2,) * 3, dtype=bool)
+        padded[1:-1, 1:-1, 1:-1] = grown
+        padded = dilate(padded, connectivity)
+        for offset in NEIGHBOUR_OFFSETS:
+            src = tuple(slice(1, -1) if d == 0 else (0 if d < 0 else -1)
+                        for d in offset)
+            piece = padded[src]
+            if not piece.any():
+                continue
+            nkey = (key[0] + offset[0], key[1] + offset[1],
+                    key[2] + offset[2])
+            dst = tuple(slice(None) if d == 0 else
+                        (CHUNK_SIZE - 1 if d < 0 else 0) for d in offset)
+            nseed = pending.get(nkey)
+            if nseed is None:
+                nseed = np.zeros((CHUNK_SIZE,) * 3, dtype=bool)
+                pending[nkey] = nseed
+                frontier.append(nkey)
+            nseed[dst] |= piece
+    return filled
+
+#offsets of the 26 chunks around a chunk
+NEIGHBOUR_OFFSETS = [(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1)
+                     for z in (-1, 0, 1) if (x, y, z) != (0, 0, 0)]
+
+def fill_enclosed(grid, seed, connectivity=6):
+    """the empty cells connected to the empty cell seed, as for
+    flood_region, or None if they aren't enclosed by the voxels, that is
+    the flood gets out of the bounds of the grid"""
+    bounds = grid.bounds(exact=True)
+    if bounds is None or grid.get(seed):
+        return None
+    lo, hi = bounds
+    if (np.array(seed) < lo).any() or (np.array(seed) > hi).any():
+        return None
+    key = chunk_key(seed)
+    mask = np.zeros((CHUNK_SIZE,) * 3, dtype=bool)
+    mask[tuple(np.array(seed) - np.array(key) * CHUNK_SIZE)] = True
+    filled = flood_region(grid, {key: mask}, connectivity, (lo - 1, hi + 1))
+    for key, mask in filled.items():
+        inside = box_mask(key, lo, hi)
+        if inside is None or (mask & ~inside).any():
+            return None
+    return filled
+
+def fill_cavities(grid, connectivity=6):
+    """the empty cells which can't be reached from outside the voxels, as
+    a dict of chunk key -> boolean mask. The outside is flooded from the
+    layer of cells around the bounds of the grid, and whatever empty
+    space inside the bounds it doesn't reach is a cavity"""
+    bounds = grid.bounds(exact=True)
+    if bounds is None:
+        return {}
+    lo, hi = bounds
+    box = (lo - 1, hi + 1)
+    seeds = {}
+    for key in chunk_box_keys(*box):
+        outer = box_mask(key, *box)
+        inner = box_mask(key, lo, hi)
+        shell = outer if inner is None else outer & ~inner
+        if shell.any():
+            seeds[key] = shell
+    outside = flood_region(grid, seeds, connectivity, box)
+
+    cavities = {}
+    for key in chunk_box_keys(lo, hi):
+        chunk = grid.get_chunk(key)
+        empty = box_mask(key, lo, hi)
+        if chunk is not None:
+            empty = empty & (chunk.values == 0)
+        reached = outside.get(key)
+        if reached is not None:
+            empty = empty & ~reached
+        if empty.any():
+            cavities[key] = empty
+    return cavities
+
+def padded_occupancy(grid, key, pad):
+    """the occupancy of a chunk with pad cells, at most CHUNK_SIZE, of each
+    of the 26 chunks around it"""
+    n = CHUNK_SIZE
+    padded = np.zeros((n + 2 * pad,) * 3, dtype=bool)
+    for offset in [(0, 0, 0)] + NEIGHBOUR_OFFSETS:
+        chunk = grid.get_chunk((key[0] + offset[0], key[1] + offset[1],
+                                key[2] + offset[2]))
+        if chunk is None:
+            continue
+        src = []
+        dst = []
+        for d in offset:
+            if d < 0:
+                src.append(slice(n - pad, n))
+                dst.append(slice(0, pad))
+            elif d > 0:
+                src.append(slice(0, pad))
+                dst.append(slice(n + pad, n + 2 * pad))
+            else:
+                src.append(slice(None))
+                dst.append(slice(pad, n + pad))
+        padded[tuple(dst)] = chunk.values[tuple(src)] != 0
+    return padded
+
+def hollow_cells(grid, thickness=1):
+    """the voxels more than thickness cells in from an empty cell, the
+    ones which go to hollow the voxels out into a shell, as a dict of
+    chunk key -> boolean mask. The occupancy is eroded thickness times
+    with the 3x3x3 box, so the shell is closed for 26 connected cells
+    too. All of it is worked out before anything is removed"""
+    if not 1 <= thickness <= CHUNK_SIZE:
+        raise ValueError("wall thickness must be 1 to {0}".format(CHUNK_SIZE))
+    interior = {}
+    for key, count in grid.chunk_counts().items():
+        if count == 0:
+            continue
+        #erode takes the cells past the edges to be solid, which only
+        #reaches as far in as the padding by the time it's done
+        solid = padded_occupancy(grid, key, thickness)
+        for i in range(thickness):
+            solid = erode(solid, 26)
+        inner = solid[(slice(thickness, -thickness),) * 3]
+        if inner.any():
+            interior[key] = inner
+    return interior
+
+#Packed occupancy
+#For the questions which only need to know which cells are occupied, each
+#chunk packs its occupancy into CHUNK_SIZE^2 rows of CHUNK_SIZE bits, bit
+#z of row [x, y] being the cell (x, y, z). That's an eighth of the size of
+#the values, and a whole row of cells is tested or combined with another
+#at once, as one integer.
+BITS_DTYPE = np.dtype("u{0}".format(CHUNK_SIZE // 8))
+_NO_BITS = np.zeros((CHUNK_SIZE, CHUNK_SIZE), dtype=BITS_DTYPE)
+_NO_BITS.flags.writeable = False
+
+def pack_occupancy(values):
+    """pack the cells of a CHUNK_SIZE^3 array which aren't 0 into rows of
+    bits, a (CHUNK_SIZE, CHUNK_SIZE) BITS_DTYPE array"""
+    #packbits puts the first cell in the top bit of the first byte, so
+    #reversed along z and read big endian, cell z lands in bit z
+    packed = np.packbits(values[:, :, ::-1] != 0, axis=2)
+    rows = packed.view(BITS_DTYPE.newbyteorder(">"))
+    return rows.reshape(CHUNK_SIZE, CHUNK_SIZE).astype(BITS_DTYPE)
+
+def unpack_occupancy(rows):
+    """the boolean CHUNK_SIZE^3 array of rows of bits, the opposite of
+    pack_occupancy"""
+    packed = rows.astype(BITS_DTYPE.newbyteorder(">")).view(np.uint8)
+    packed = packed.reshape(CHUNK_SIZE, CHUNK_SIZE, -1)
+    return np.unpackbits(packed, axis=2)[:, :, ::-1].astype(bool)
+
+def exposed_faces(grid, key):
+    """the occupied cells of a chunk which show a face, one array of rows of
+    bits for each of the BOX_PLANES, where the neighbouring cell across the
+    face is empty. The neighbours on the boundary of the chunk are taken
+    from the face neighbour chunks"""
+    n = CHUNK_SIZE
+    rows = grid.occupancy_bits(key)
+    faces = np.empty((len(BOX_PLANES), n, n), dtype=BITS_DTYPE)
+    for i, (axis, side) in enumerate(BOX_PLANES):
+        nkey = list(key)
+        nkey[axis] += side
+        neighbour = grid.occupancy_bits(tuple(nkey))
+        if axis == 2:
+            #the bits of a row are the cells along z, so the neighbours
+            #are a shift away, with one bit from the neighbouring chunk
+            if side > 0:
+                covered = (rows >> 1) | ((neighbour & 1) << (n - 1))
+            else:
+                covered = (rows << 1) | (neighbour >> (n - 1))
+        else:
+            covered = np.empty_like(rows)
+            dst = [slice(None)] * 2
+            src = [slice(None)] * 2
+            if side > 0:
+                dst[axis], src[axis] = slice(None, -1), slice(1, None)
+                edge, across = -1, 0
+            else:
+                dst[axis], src[axis] = slice(1, None), slice(None, -1)
+                edge, across = 0, -1
+            covered[tuple(dst)] = rows[tuple(src)]
+            dst[axis] = edge
+            src[axis] = across
+            covered[tuple(dst)] = neighbour[tuple(src)]
+        faces[i] = rows & ~covered
+    return faces
+
+def boolean_cells(grid, other, operation):
+    """the cells a boolean operation of grid with other changes, as a dict
+    of chunk key -> boolean mask. operation is 'UNION', for the cells of
+    other which go to be added, or 'DIFFERENCE' or 'INTERSECT', for the
+    cells of grid which go to be removed. The grids are combined cell for
+    cell, a chunk at a time with the packed occupancy, and only the chunks
+    which change are unpacked"""
+    if operation == 'UNION':
+        keys = other.chunk_keys()
+    elif operation == 'DIFFERENCE':
+        keys = grid.chunk_keys() & other.chunk_keys()
+    elif operation == 'INTERSECT':
+        keys = grid.chunk_keys()
+    else:
+        raise ValueError("unknown boolean operation {0}".format(operation))
+    masks = {}
+    for key in keys:
+        rows = grid.occupancy_bits(key)
+        other_rows = other.occupancy_bits(key)
+        if operation == 'UNION':
+            rows = other_rows & ~rows
+        elif operation == 'DIFFERENCE':
+            rows = rows & other_rows
+        else:
+            rows = rows & ~other_rows
+        if rows.any():
+            masks[key] = unpack_occupancy(rows)
+    return masks
+
+#Voxel grid serialization
+#A grid is saved as one blob: a header, a directory with the key, offset,
+#size and voxel count of every chunk, then the chunks one after another,
+#each encoded by encode_chunk. Chunks can be encoded and decoded on their
+#own, so only the edited ones need encoding again, and any one can be read
+#without the rest. The directory can have room for more chunks than it
+#holds, so a sidecar file can add chunks without moving the chunk data.
+GRID_MAGIC = b"VXGR"
+GRID_VERSION = 2
+GRID_HEADER = struct.Struct("<4sHHII")
+GRID_DIRECTORY_DTYPE = np.dtype([("key", "<i4", (3,)), ("offset", "<u8"),
+                                 ("size", "<u4"), ("count", "<u4")])
+#version 1 blobs had no spare directory entries or voxel counts
+GRID_HEADER_V1 = struct.Struct("<4sHHI")
+GRID_DIRECTORY_DTYPE_V1 = np.dtype([("key", "<i4", (3,)), ("offset", "<u8"),
+                                    ("size", "<u4")])
+
+#first byte of an encoded chunk
+CHUNK_UNIFORM = 0
+CHUNK_RLE = 1
+
+def encode_chunk(values):
+    """encode the values of a chunk compactly. A chunk with one value
+    throughout, like the inside of a solid, is just that value. Otherwise
+    the values in x, y, z order are run length encoded, the runs are split
+    into a palette of the values used, the palette index of each run and
+    the length of each run, and the lot is compressed with zlib."""
+    flat = np.ascontiguousarray(values, dtype=np.uint8).ravel()
+    starts = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    if len(starts) == 0:
+        return struct.pack("<BB", CHUNK_UNIFORM, int(flat[0]))
+    starts = np.concatenate(([0], starts))
+    lengths = np.diff(np.append(starts, len(flat))).astype("<u2")
+    palette, runs = np.unique(flat[starts], return_inverse=True)
+    data = b"".join((struct.pack("<BI", len(palette) & 0xff, len(starts)),
+                     palette.astype(np.uint8).tobytes(),
+                     runs.astype(np.uint8).tobytes(),
+                     lengths.tobytes()))
+    return struct.pack("<B", CHUNK_RLE) + zlib.compress(data)
+
+def decode_chunk(data):
+    """the values of a chunk from encode_chunk"""
+    shape = (CHUNK_SIZE,) * 3
+    if data[0] == CHUNK_UNIFORM:
+        return np.full(shape, data[1], dtype=np.uint8)
+    data = zlib.decompress(data[1:])
+    n_palette, n_runs = struct.unpack_from("<BI", data)
+    offset = struct.calcsize("<BI")
+    #256 values don't fit in the palette size byte
+    n_palette = n_palette or 256
+    palette = np.frombuffer(data, np.uint8, n_palette, offset)
+    offset += n_palette
+    runs = np.frombuffer(data, np.uint8, n_runs, offset)
+    offset += n_runs
+    lengths = np.frombuffer(data, "<u2", n_runs, offset)
+    return np.repeat(palette[runs], lengths).reshape(shape)
+
+def grid_blob_parts(chunks, capacity=None):
+    """the pieces of a grid blob for chunks, a list of (key, voxel count,
+    encode_chunk bytes), with room in the directory for capacity chunks"""
+    if capacity is None:
+        capacity = len(chunks)
+    directory = np.zeros(capacity, dtype=GRID_DIRECTORY_DTYPE)
+    if chunks:
+        entries = directory[:len(chunks)]
+        entries["key"] = [key for key, count, data in chunks]
+        entries["count"] = [count for key, count, data in chunks]
+        sizes = np.array([len(data) for key, count, data in chunks],
+                         dtype=np.uint64)
+        entries["size"] = sizes
+        entries["offset"] = np.cumsum(sizes) - sizes
+    header = GRID_HEADER.pack(GRID_MAGIC, GRID_VERSION, CHUNK_SIZE,
+                              len(chunks), capacity)
+    return ([header, directory.tobytes()] +
+            [data for key, count, data in chunks])
+
+def encode_grid(chunks, capacity=None):
+    """join encoded chunks into one grid blob, see grid_blob_parts"""
+    return b"".join(grid_blob_parts(chunks, capacity))
+
+def read_grid_directory(data):
+    """check the header of a grid blob, returns a copy of its directory,
+    the offset of the chunk data, which directory offsets are relative to,
+    and the number of chunks the directory has room for"""
+    magic, version, chunk_size = struct.unpack_from("<4sHH", data)
+    if magic != GRID_MAGIC or version not in (1, GRID_VERSION):
+        raise ValueError("not a voxel grid")
+    if chunk_size != CHUNK_SIZE:
+        raise ValueError("voxel grid has {0} sized chunks, not {1}".format(
+            chunk_size, CHUNK_SIZE))
+    if version == 1:
+        n_chunks = GRID_HEADER_V1.unpack_from(data)[3]
+        old = np.frombuffer(data, GRID_DIRECTORY_DTYPE_V1, n_chunks,
+                            GRID_HEADER_V1.size)
+        base = GRID_HEADER_V1.size + old.nbytes
+        directory = np.zeros(n_chunks, dtype=GRID_DIRECTORY_DTYPE)
+        for field in old.dtype.names:
+            directory[field] = old[field]
+        directory["count"] = [
+            np.count_nonzero(decode_chunk(data[base + offset:
+                                               base + offset + size]))
+            for offset, size in zip(old["offset"].tolist(),
+                                    old["size"].tolist())]
+        return directory, base, n_chunks
+    n_chunks, capacity = GRID_HEADER.unpack_from(data)[3:]
+    directory = np.frombuffer(data, GRID_DIRECTORY_DTYPE, n_chunks,
+                              GRID_HEADER.size).copy()
+    base = GRID_HEADER.size + capacity * GRID_DIRECTORY_DTYPE.itemsize
+    return directory, base, capacity
+
+class GridBlobSource(object):
+    """the chunks of a grid blob, for VoxelGrid.attach. Only the header and
+    directory are read when it is made, the chunk data is sliced out of
+    the blob as it's asked for, so the blob can be anything which can be
+    sliced, like an mmap"""
+
+    def __init__(self, data):
+        self.data = data
+        self.read_directory()
+
+    def read_directory(self):
+        directory, self.base, self.capacity = read_grid_directory(self.data)
+        self.entries = {}
+        for key, offset, size, count in zip(directory["key"].tolist(),
+                                            directory["offset"].tolist(),
+                                            directory["size"].tolist(),
+                                            directory["count"].tolist()):
+            self.entries[tuple(key)] = (offset, size, count)
+
+    def counts(self):
+        """chunk key -> voxel count of the chunks"""
+        return dict((key, entry[2]) for key, entry in self.entries.items())
+
+    def read(self, key):
+        """the encode_chunk bytes of a chunk"""
+        offset, size, count = self.entries[key]
+        start = self.base + offset
+        return bytes(self.data[start:start + size])
+
+#smallest directory a sidecar is written with, it is grown by doubling
+SIDECAR_MIN_CAPACITY = 1024
+#stale chunk data a sidecar can pile up before it is compacted, it is also
+#compacted whenever the stale data outgrows the live data
+SIDECAR_MAX_STALE = 64 << 20
+SIDECAR_MIN_STALE = 1 << 20
+
+class VoxelSidecar(GridBlobSource):
+    """a grid blob in a file of its own next to the blend file, which is
+    mmaped, so opening it only reads the directory at the head, and the
+    pages of a chunk are only read when the chunk is decoded.
+    Saving appends the chunks edited since the last save to the end of
+    the file and rewrites the directory in place, leaving the old copies
+    of the chunks behind as stale data. The whole file is rewritten when
+    the directory runs out of room, or the stale data gets too big."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.open()
+
+    @classmethod
+    def create(cls, path, chunks):
+        """write a new sidecar holding chunks, as for grid_blob_parts"""
+        cls.write(path, chunks)
+        return cls(path)
+
+    @staticmethod
+    def write(path, chunks):
+        capacity = max(SIDECAR_MIN_CAPACITY, 2 * len(chunks))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.writelines(grid_blob_parts(chunks, capacity))
+        os.replace(tmp_path, path)
+
+    def open(self):
+        self.file = open(self.path, "r+b")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0)
+        except (OSError, ValueError):
+            self.file.close()
+            self.file = None
+            raise
+        try:
+            self.read_directory()
+        except ValueError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.file is not None:
+            self.data.close()
+            self.file.close()
+            self.file = None
+
+    def stale_size(self):
+        live = sum(entry[1] for entry in self.entries.values())
+        return len(self.data) - self.base - live
+
+    def update(self, changed, removed):
+        """save the chunks in changed, a list of (key, voxel count,
+        encode_chunk bytes), and drop the chunks with keys in removed"""
+        entries = dict(self.entries)
+        end = len(self.data) - self.base
+        stale = self.stale_size()
+        for key in removed:
+            if key in entries:
+                stale += entries.pop(key)[1]
+        for key, count, data in changed:
+            if key in entries:
+                stale += entries[key][1]
+            entries[key] = (end, len(data), count)
+            end += len(data)
+        live = end - stale
+
+        if (len(entries) > self.capacity or stale > SIDECAR_MAX_STALE or
+                (stale > SIDECAR_MIN_STALE and stale > live)):
+            changed = dict((key, (count, data))
+                           for key, count, data in changed)
+            chunks = []
+            for key in sorted(entries):
+                if key in changed:
+                    chunks.append((key,) + changed[key])
+                else:
+                    chunks.append((key, entries[key][2], self.read(key)))
+            self.close()
+            self.write(self.path, chunks)
+            self.open()
+            return
+
+        #append the chunk data before pointing the directory at it, so if
+        #blender goes down while appending, the old directory is still
+        #whole and the extra data is just stale. The directory itself is
+        #rewritten in place though, so going down part way through that
+        #leaves a directory which is half old and half new
+        self.close()
+        with open(self.path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            f.writelines(data for key, count, data in changed)
+            f.flush()
+            directory = np.zeros(len(entries), dtype=GRID_DIRECTORY_DTYPE)
+            keys = sorted(entries)
+            directory["key"] = keys
+            directory["offset"], directory["size"], directory["count"] = \
+                np.array([entries[key] for key in keys],
+                         dtype=np.uint64).reshape(-1, 3).T
+            f.seek(GRID_HEADER.size)
+            f.write(directory.tobytes())
+            f.seek(0)
+            f.write(GRID_HEADER.pack(GRID_MAGIC, GRID_VERSION, CHUNK_SIZE,
+                                     len(entries), self.capacity))
+        self.open()
+
+#Voxel meshing
+def greedy_mesh(padded):
+    """Build the surface mesh of a chunk from its padded values (see
+    VoxelGrid.padded_values). Faces between two occupied cells are culled,
+    and the remaining coplanar faces with the same value are merged into
+    rectangles greedily, so the size of the mesh depends on the surface
+    area rather than the number of voxels.
+    returns (verts, faces, face_values), where verts is a (n, 3) float32
+    array in cell units relative to the corner of the chunk, faces is a
+    (m, 4) int32 array of quads wound counter clockwise seen from outside,
+    and face_values holds the value of the cells each quad came from."""
+    n = padded.shape[0] - 2
+    inner = padded[1:-1, 1:-1, 1:-1]
+    quads = []
+    quad_values = []
+
+    for axis in range(3):
+        u_axis = (axis + 1) % 3
+        v_axis = (axis + 2) % 3
+        for side in (1, -1):
+            index = [slice(1, -1)] * 3
+            index[axis] = slice(1 + side, n + 1 + side)
+            neighbour = padded[tuple(index)]
+            visible = np.where(neighbour == 0, inner, 0)
+            #move the axis being meshed to the front, and u, v after it
+            visible = visible.transpose(axis, u_axis, v_axis)
+
+            for layer in np.nonzero(visible.any(axis=(1, 2)))[0]:
+                mask = visible[layer].copy()
+                plane = layer + 1 if side == 1 else layer
+                for u, v in zip(*np.nonzero(mask)):
+                    value = mask[u, v]
+                    if value == 0:
+                        continue
+                    #grow along v, then along u while the whole strip matches
+                    v_end = v + 1
+                    while v_end < n and mask[u, v_end] == value:
+                        v_end += 1
+                    u_end = u + 1
+                    while u_end < n and (mask[u_end, v:v_end] == value).all():
+                        u_end += 1
+                    mask[u:u_end, v:v_end] = 0
+
+                    corners = ((u, v), (u_end, v), (u_end, v_end), (u, v_end))
+                    if side == -1:
+                        corners = corners[::-1]
+                    quad = []
+                    for cu, cv in corners:
+                        co = [0, 0, 0]
+                        co[axis] = plane
+                        co[u_axis] = cu
+                        co[v_axis] = cv
+                        quad.append(co)
+                    quads.append(quad)
+                    quad_values.append(value)
+
+    if not quads:
+        return (np.empty((0, 3), dtype=np.float32),
+                np.empty((0, 4), dtype=np.int32),
+                np.empty(0, dtype=np.uint8))
+
+    corners = np.array(quads, dtype=np.int32).reshape(-1, 3)
+    verts, faces = np.unique(corners, axis=0, return_inverse=True)
+    return (verts.astype(np.float32),
+            faces.reshape(-1, 4).astype(np.int32),
+            np.array(quad_values, dtype=np.uint8))
+
+def culled_mesh(padded):
+    """Build the surface mesh of a chunk like greedy_mesh, but with one quad
+    per visible cell face and no merging. This is entirely vectorised, so it
+    is used to get an edit on screen quickly, and the chunk is greedy meshed
+    again later when there is time.
+    returns (verts, faces, face_values) in the same form as greedy_mesh"""
+    n = padded.shape[0] - 2
+    inner = padded[1:-1, 1:-1, 1:-1]
+    quads = []
+    quad_values = []
+
+    for axis in range(3):
+        u_axis = (axis + 1) % 3
+        v_axis = (axis + 2) % 3
+        for side in (1, -1):
+            index = [slice(1, -1)] * 3
+            index[axis] = slice(1 + side, n + 1 + side)
+            neighbour = padded[tuple(index)]
+            visible = np.where(neighbour == 0, inner, 0)
+            cells = np.argwhere(visible).astype(np.int32)
+            if len(cells) == 0:
+                continue
+
+            corners = np.zeros((4, 3), dtype=np.int32)
+            corners[:, axis] = 1 if side == 1 else 0
+            corners[:, u_axis] = (0, 1, 1, 0)
+            corners[:, v_axis] = (0, 0, 1, 1)
+            if side == -1:
+                corners = corners[::-1]
+            quads.append(cells[:, None, :] + corners[None, :, :])
+            quad_values.append(visible[tuple(cells.T)])
+
+    if not quads:
+        return (np.empty((0, 3), dtype=np.float32),
+                np.empty((0, 4), dtype=np.int32),
+                np.empty(0, dtype=np.uint8))
+
+    quads = np.concatenate(quads)
+    faces = np.arange(len(quads) * 4, dtype=np.int32).reshape(-1, 4)
+    return (quads.reshape(-1, 3).astype(np.float32),
+            faces,
+            np.concatenate(quad_values))
+
+def get_voxel_cube_mesh():
+    """return the cube mesh datablock which voxel objects link to when the
+    VoxelArray shares one mesh between all of its voxels, creating it the
+    first time it's needed"""
+    mesh = bpy.data.meshes.get(VOXEL_CUBE_MESH_NAME)
+    if mesh is not None:
+        return mesh
+
+    mesh = bpy.data.meshes.new(VOXEL_CUBE_MESH_NAME)
+    write_mesh_data(mesh, *voxel_cube_geometry())
+    return mesh
+
+def voxel_cube_geometry():
+    """return (verts, faces) of a voxel sized cube around the origin"""
+    r = VOXEL_SIZE / 2.0
+    verts = np.array([(-r, -r, -r), (r, -r, -r), (r, r, -r), (-r, r, -r),
+                      (-r, -r, r), (r, -r, r), (r, r, r), (-r, r, r)])
+    faces = np.array([(0, 3, 2, 1), (4, 5, 6, 7), (0, 1, 5, 4),
+                      (1, 2, 6, 5), (2, 3, 7, 6), (3, 0, 4, 7)])
+    return verts, faces
+
+def write_mesh_data(mesh, verts, faces, face_values=None):
+    """Fill an empty mesh datablock in bulk with foreach_set, without going
+    through bmesh or operators. faces is either a (m, k) array for faces
+    which all have k sides, or a list of index sequences for ngons."""
+    verts = np.asarray(verts, dtype=np.float32)
+    if isinstance(faces, np.ndarray):
+        loop_totals = np.full(len(faces), faces.shape[1], dtype=np.int32)
+        loop_indices = faces.astype(np.int32).ravel()
+    else:
+        loop_totals = np.array([len(f) for f in faces], dtype=np.int32)
+        if len(faces):
+            loop_indices = np.concatenate(faces).astype(np.int32)
+        else:
+            loop_indices = np.empty(0, dtype=np.int32)
+    loop_starts = np.zeros(len(loop_totals), dtype=np.int32)
+    np.cumsum(loop_totals[:-1], out=loop_starts[1:])
+
+    mesh.vertices.add(len(verts))
+    mesh.vertices.foreach_set("co", verts.ravel())
+    mesh.loops.add(len(loop_indices))
+    mesh.loops.foreach_set("vertex_index", loop_indices)
+    mesh.polygons.add(len(loop_totals))
+    mesh.polygons.foreach_set("loop_start", loop_starts)
+    mesh.polygons.foreach_set("loop_total", loop_totals)
+    if face_values is not None:
+        #the voxel value picks the material slot, 1 being the first
+        material_index = np.asarray(face_values, dtype=np.int32) - 1
+        mesh.polygons.foreach_set("material_index", material_index)
+    mesh.update(calc_edges=True)
+
+def read_mesh_data(mesh):
+    """the reverse of write_mesh_data, returns the float32 verts and the
+    loop totals and loop indices of the polygons of a mesh"""
+    verts = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", verts)
+    loop_indices = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_indices)
+    loop_totals = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("loop_total", loop_totals)
+    return verts.reshape(-1, 3), loop_totals, loop_indices
+
+def split_pieces(verts, loop_totals, loop_indices, face_ids):
+    """split mesh buffers into a dict from id to the (verts, loop_totals,
+    loop_indices) of the faces with that id, the pieces mustn't share
+    vertices"""
+    loop_starts = np.cumsum(loop_totals) - loop_totals
+    order = np.argsort(face_ids, kind="stable")
+    ids, starts = np.unique(face_ids[order], return_index=True)
+    pieces = {}
+    for i, faces in zip(ids.tolist(), np.split(order, starts[1:])):
+        totals = loop_totals[faces]
+        #the loops of the faces, in order
+        loops = (np.repeat(loop_starts[faces] - (np.cumsum(totals) - totals),
+                           totals) + np.arange(totals.sum()))
+        used, local = np.unique(loop_indices[loops], return_inverse=True)
+        pieces[i] = (verts[used], totals, local.astype(np.int32))
+    return pieces
+
+def merge_pieces(pieces):
+    """the reverse of split_pieces, returns (verts, loop_totals,
+    loop_indices, face_ids)"""
+    ids = list(pieces)
+    verts = [pieces[i][0] for i in ids]
+    offsets = np.cumsum([0] + [len(v) for v in verts])
+    loop_indices = [pieces[i][2] + offset for i, offset in zip(ids, offsets)]
+    loop_totals = [pieces[i][1] for i in ids]
+    face_ids = np.repeat(ids, [len(t) for t in loop_totals])
+    return (np.concatenate(verts), np.concatenate(loop_totals),
+            np.concatenate(loop_indices), face_ids.astype(np.int32))
+
+#Voxel mesh intersection
+#faces of a voxel box as (axis, side), side being -1 for the face at the
+#minimum of the axis and 1 for the face at the maximum. The index of a face
+#in this tuple is used to label the edges which clipping creates on it.
+BOX_PLANES = ((0, -1), (0, 1), (1, -1), (1, 1), (2, -1), (2, 1))
+
+#distance from a face of the box under which a point counts as on the face
+CLIP_EPSILON = 1e-9
+
+#number of point/triangle pairs winding_numbers works on at a time
+WINDING_BATCH = 1 << 20
+
+#number of whole or cached voxels intersect_mesh_job writes between yields
+ISECT_STEP_VOXELS = 256
+
+#seconds of intersecting VoxelArrayIntersectMeshOp does every timer tick
+ISECT_TICK_BUDGET = 0.05
+
+def mesh_object_triangles(obj, matrix, scene):
+    """return a (n, 3, 3) float64 array of the triangles of the mesh object,
+    with its modifiers applied, and transformed by matrix. Faces with more
+    than three sides are split into a fan of triangles."""
+    batches = list(mesh_object_triangle_batches(obj, matrix, scene))
+    if not batches:
+        return np.empty((0, 3, 3), dtype=np.float64)
+    return np.concatenate(batches)
+
+def matrix_array(matrix):
+    """a mathutils Matrix as a 4x4 numpy array"""
+    return np.array([list(row) for row in matrix], dtype=np.float64)
+
+def mesh_object_triangle_batches(obj, matrix, scene, batch=None):
+    """mesh_object_triangles, yielding the triangles of at most batch
+    polygons at a time. The evaluated mesh is read into flat arrays of
+    its vertices and loops first, so only the triangles are batched, the
+    memory for those arrays still grows with the size of the mesh"""
+    mesh = obj.to_mesh(scene, True, 'PREVIEW')
+    try:
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", co)
+        loop_start = np.empty(len(mesh.polygons), dtype=np.int32)
+        loop_total = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", loop_start)
+        mesh.polygons.foreach_get("loop_total", loop_total)
+        vertex_index = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", vertex_index)
+    finally:
+        bpy.data.meshes.remove(mesh)
+
+    #the vertices are transformed a batch at a time, rather than making a
+    #float64 copy of all of them
+    m = matrix_array(matrix)
+    co = co.reshape(-1, 3)
+
+    batch = batch or max(len(loop_start), 1)
+    for i in range(0, len(loop_start), batch):
+        loop_total_batch = loop_total[i:i + batch]
+        n_tris = np.maximum(loop_total_batch - 2, 0)
+        poly = np.repeat(np.arange(len(n_tris)), n_tris)
+        fan = np.arange(n_tris.sum()) - np.repeat(np.cumsum(n_tris) - n_tris,
+                                                  n_tris)
+        first = loop_start[i:i + batch][poly]
+        tris = np.stack((vertex_index[first],
+                         vertex_index[first + fan + 1],
+                         vertex_index[first + fan + 2]), axis=1)
+        yield np.dot(co[tris].astype(np.float64), m[:3, :3].T) + m[:3, 3]
+
+def winding_numbers(points, tris):
+    """Generalized winding numbers of the points with respect to the
+    triangle mesh: the sum of the solid angles the triangles subtend at
+    each point over 4 pi (Van Oosterom & Strackee). This is close to 1
+    inside and 0 outside, and unlike counting ray crossings it degrades
+    gracefully for meshes with holes or overlaps, like scans.
+    Points are processed in batches against all the triangles at once,
+    so the temporary arrays stay around WINDING_BATCH elements."""
+    points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+    winding = np.zeros(len(points), dtype=np.float64)
+    if len(tris) == 0 or len(points) == 0:
+        return winding
+
+    tris = np.asarray(tris, dtype=np.float64)
+    batch = max(1, WINDING_BATCH // len(tris))
+    for start in range(0, len(points), batch):
+        p = points[start:start + batch, None, :]
+        a = tris[None, :, 0, :] - p
+        b = tris[None, :, 1, :] - p
+        c = tris[None, :, 2, :] - p
+        la = np.sqrt((a * a).sum(axis=2))
+        lb = np.sqrt((b * b).sum(axis=2))
+        lc = np.sqrt((c * c).sum(axis=2))
+        det = (a * np.cross(b, c)).sum(axis=2)
+        div = (la * lb * lc + (a * b).sum(axis=2) * lc +
+               (a * c).sum(axis=2) * lb + (b * c).sum(axis=2) * la)
+        solid_angle = 2.0 * np.arctan2(det, div)
+        winding[start:start + batch] = solid_angle.sum(axis=1) / (4.0 * np.pi)
+    return winding
+
+def points_in_mesh(points, tris):
+    """Test which points are inside the triangle mesh, returns a
+    boolean array"""
+    return winding_numbers(points, tris) > 0.5
+
+def label_components(coords):
+    """Label the 6-connected components of a set of voxel coordinates,
+    returns an array with the smallest index in each voxel's component.
+    Labels are spread between neighbours with numpy until nothing changes,
+    so it takes about as many passes as the components are long."""
+    n = len(coords)
+    labels = np.arange(n)
+    if n == 0:
+        return labels
+
+    coords = coords.astype(np.int64)
+    lo = coords.min(axis=0) - 1
+    dims = tuple(coords.max(axis=0) - lo + 2)
+    keys = np.ravel_multi_index((coords - lo).T, dims)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    pairs = []
+    for axis in range(3):
+        step = np.zeros(3, dtype=np.int64)
+        step[axis] = 1
+        nkeys = np.ravel_multi_index((coords + step - lo).T, dims)
+        pos = np.minimum(np.searchsorted(sorted_keys, nkeys), n - 1)
+        found = sorted_keys[pos] == nkeys
+        pairs.append(np.stack((np.nonzero(found)[0], order[pos[found]])))
+    i, j = np.concatenate(pairs, axis=1)
+
+    while True:
+        smallest = np.minimum(labels[i], labels[j])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, i, smallest)
+        np.minimum.at(new_labels, j, smallest)
+        new_labels = new_labels[new_labels]
+        if (new_labels == labels).all():
+            return labels
+        labels = new_labels
+
+def classify_voxels(coords, tris, size):
+    """Classify voxels which no triangle passes through as inside or
+    outside the mesh. Neighbouring voxels like that can't have the surface
+    between them, so only one voxel centre per connected group is tested,
+    and those are all tested in one winding_numbers call.
+    returns a boolean array, True for the voxels inside"""
+    labels = label_components(coords)
+    groups, group_of = np.unique(labels, return_inverse=True)
+    centres = coords[groups].astype(np.float64) * size
+    return points_in_mesh(centres, tris)[group_of.ravel()]
+
+def expand_boxes(lo_cell, span):
+    """list the cells of a set of boxes of cells, each given by its
+    minimum cell and its size in cells. returns (box index, cell) arrays
+    with a row for every cell of every box"""
+    count = span.prod(axis=1)
+    pair_box = np.repeat(np.arange(len(count)), count)
+    k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    sx = span[pair_box, 0]
+    sy = span[pair_box, 1]
+    cells = lo_cell[pair_box] + np.stack((k % sx, (k // sx) % sy,
+                                          k // (sx * sy)), axis=1)
+    return pair_box, cells
+
+def bin_triangles(tris, coords, size):
+    """Broad phase for intersecting a mesh with voxels. Each triangle is
+    put in every occupied voxel its bounding box overlaps, all in one go
+    with numpy. returns a dict from the coordinate tuple of each voxel
+    which has triangles in it to an array of the triangle indices.
+    Voxels which aren't in the dict are entirely inside or outside."""
+    bins = {}
+    if len(tris) == 0 or len(coords) == 0:
+        return bins
+
+    grid_lo = coords.min(axis=0).astype(np.int64)
+    grid_hi = coords.max(axis=0).astype(np.int64)
+    dims = tuple(grid_hi - grid_lo + 1)
+    lo_cell = np.floor(tris.min(axis=1) / size + 0.5).astype(np.int64)
+    hi_cell = np.floor(tris.max(axis=1) / size + 0.5).astype(np.int64)
+    lo_cell = np.maximum(lo_cell, grid_lo)
+    hi_cell = np.minimum(hi_cell, grid_hi)
+    span = hi_cell - lo_cell + 1
+    keep = np.all(span > 0, axis=1)
+    tri_index = np.nonzero(keep)[0]
+    lo_cell = lo_cell[keep]
+    span = span[keep]
+    if len(span) == 0:
+        return bins
+
+    #expand each triangle into the cells of its bounding box
+    pair_tri, cells = expand_boxes(lo_cell, span)
+
+    #only keep the cells which hold a voxel
+    pair_keys = np.ravel_multi_index((cells - grid_lo).T, dims)
+    voxel_keys = np.ravel_multi_index((coords.astype(np.int64) - grid_lo).T,
+                                      dims)
+    occupied = np.isin(pair_keys, voxel_keys)
+    pair_keys = pair_keys[occupied]
+    pair_tri = tri_index[pair_tri[occupied]]
+    if len(pair_keys) == 0:
+        return bins
+
+    order = np.argsort(pair_keys, kind='mergesort')
+    pair_keys = pair_keys[order]
+    pair_tri = pair_tri[order]
+    keys, starts = np.unique(pair_keys, return_index=True)
+    cells = np.stack(np.unravel_index(keys, dims), axis=1) + grid_lo
+    for cell, group in zip(cells.tolist(), np.split(pair_tri, starts[1:])):
+        bins[tuple(cell)] = group
+    return bins
+
+def _plane_crossing(a, b, axis, bound):
+    """point where the segment a-b crosses the plane, always computed from
+    the same end so that triangles sharing the edge agree exactly"""
+    if a > b:
+        a, b = b, a
+    t = (bound - a[axis]) / (b[axis] - a[axis])
+    p = [a[0] + (b[0] - a[0]) * t,
+         a[1] + (b[1] - a[1]) * t,
+         a[2] + (b[2] - a[2]) * t]
+    p[axis] = bound
+    return tuple(p)
+
+def _clip_polygon(poly, labels, plane, bound):
+    """Sutherland-Hodgman clip of a polygon against one face of the box.
+    labels[i] is the label of the edge from poly[i] to poly[i + 1], and
+    the edge which closes the polygon along the face gets the label plane.
+    Points on the face count as outside, as if the box was shrunk by an
+    infinitely small amount, which keeps triangles lying in the face, or
+    touching it, from leaving slivers and stray cut edges behind."""
+    axis, side = BOX_PLANES[plane]
+    out = []
+    out_labels = []
+    k = len(poly)
+    for i in range(k):
+        a = poly[i]
+        b = poly[(i + 1) % k]
+        da = (a[axis] - bound) * side
+        db = (b[axis] - bound) * side
+        if -CLIP_EPSILON < da < CLIP_EPSILON:
+            da = 0.0
+        if -CLIP_EPSILON < db < CLIP_EPSILON:
+            db = 0.0
+        if da < 0.0:
+            out.append(a)
+            out_labels.append(labels[i])
+            if db >= 0.0:
+                #leaving the box, the edge after the crossing runs along
+                #the face until the polygon enters again
+                out.append(b if db == 0.0 else
+                           _plane_crossing(a, b, axis, bound))
+                out_labels.append(plane)
+        elif db < 0.0:
+            crossing = a if da == 0.0 else _plane_crossing(a, b, axis, bound)
+            if out and out[-1] == crossing:
+                out_labels[-1] = labels[i]
+            else:
+                out.append(crossing)
+                out_labels.append(labels[i])
+    if len(out) > 1 and out[0] == out[-1]:
+        out.pop()
+        out_labels.pop()
+    return out, out_labels
+
+def clip_triangles(tris, lo, hi):
+    """Clip triangles against the box lo-hi. returns (polygons, cuts), where
+    polygons are the parts of the triangles inside the box, and cuts[plane]
+    holds the edges that clipping created on each face of the box, reversed
+    so they run the way the boundary of the cap on that face has to"""
+    polygons = []
+    cuts = [[] for plane in BOX_PLANES]
+    bounds = [lo[axis] if side == -1 else hi[axis]
+              for axis, side in BOX_PLANES]
+    for tri in np.asarray(tris, dtype=np.float64).tolist():
+        poly = [tuple(p) for p in tri]
+        labels = [-1, -1, -1]
+        for plane in range(len(BOX_PLANES)):
+            poly, labels = _clip_polygon(poly, labels, plane, bounds[plane])
+            if len(poly) < 3:
+                break
+        else:
+            polygons.append(poly)
+            k = len(poly)
+            for i, label in enumerate(labels):
+                if label >= 0:
+                    cuts[label].append((poly[(i + 1) % k], poly[i]))
+    return polygons, cuts
+
+def _point_key(p):
+    return (round(p[0], 9), round(p[1], 9))
+
+def _polygon_area(poly):
+    area = 0.0
+    for i in range(len(poly)):
+        x0, y0 = poly[i - 1]
+        x1, y1 = poly[i]
+        area += x0 * y1 - x1 * y0
+    return area * 0.5
+
+def _point_in_polygon(p, poly):
+    x, y = p
+    inside = False
+    for i in range(len(poly)):
+        x0, y0 = poly[i - 1]
+        x1, y1 = poly[i]
+        if (y0 > y) != (y1 > y):
+            if x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+                inside = not inside
+    return inside
+
+def _chain_segments(segments):
+    """join 2D segments end to start, returns (open_chains, loops), each a
+    list of point lists"""
+    by_start = {}
+    ends = set()
+    for i, (a, b) in enumerate(segments):
+        by_start.setdefault(_point_key(a), []).append(i)
+        ends.add(_point_key(b))
+    used = [False] * len(segments)
+
+    def follow(i):
+        points = [segments[i][0]]
+        while True:
+            used[i] = True
+            b = segments[i][1]
+            following = [j for j in by_start.get(_point_key(b), ())
+                         if not used[j]]
+            if not following:
+                return points, b
+            points.append(b)
+            i = following[0]
+
+    open_chains = []
+    loops = []
+    for i, (a, b) in enumerate(segments):
+        if not used[i] and _point_key(a) not in ends:
+            points, end = follow(i)
+            points.append(end)
+            open_chains.append(points)
+    for i in range(len(segments)):
+        if not used[i]:
+            points, end = follow(i)
+            if _point_key(end) == _point_key(points[0]) and len(points) > 2:
+                loops.append(points)
+    return open_chains, loops
+
+def _segments_cross(a, b, c, d):
+    """proper intersection test between segments a-b and c-d, touching at
+    the ends doesn't count"""
+    def orient(p, q, r):
+        return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+    d1 = orient(c, d, a)
+    d2 = orient(c, d, b)
+    d3 = orient(a, b, c)
+    d4 = orient(a, b, d)
+    return ((d1 > 0.0) != (d2 > 0.0) and (d3 > 0.0) != (d4 > 0.0) and
+            d1 != 0.0 and d2 != 0.0 and d3 != 0.0 and d4 != 0.0)
+
+def _bridge_holes(outer, holes):
+    """cut each hole into the outer polygon along a segment which doesn't
+    cross any edges, giving one (weakly simple) polygon"""
+    poly = list(outer)
+    holes = sorted(holes, key=lambda h: -max(p[0] for p in h))
+    for n, hole in enumerate(holes):
+        start = max(range(len(hole)), key=lambda i: hole[i][0])
+        h = hole[start]
+        edges = [(poly[i - 1], poly[i]) for i in range(len(poly))]
+        for other in holes[n:]:
+            edges.extend((other[i - 1], other[i]) for i in range(len(other)))
+        order = sorted(range(len(poly)),
+                       key=lambda i: (poly[i][0] - h[0]) ** 2 +
+                                     (poly[i][1] - h[1]) ** 2)
+        best = order[0]
+        for i in order:
+            if not any(_segments_cross(h, poly[i], c, d) for c, d in edges):
+                best = i
+                break
+        hole = hole[start:] + hole[:start]
+        poly = poly[:best + 1] + hole + [hole[0]] + poly[best:]
+    return poly
+
+def _triangulate_polygon(poly):
+    """ear clipping triangulation of a counter clockwise 2D polygon,
+    returns triangles as index triples into poly"""
+    def cross(p, q, r):
+        return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+
+    remaining = list(range(len(poly)))
+    tris = []
+    while len(remaining) > 3:
+        k = len(remaining)
+        for n in range(k):
+            i0 = remaining[n - 1]
+            i1 = remaining[n]
+            i2 = remaining[(n + 1) % k]
+            p0, p1, p2 = poly[i0], poly[i1], poly[i2]
+            if cross(p0, p1, p2) <= 1e-12:
+                continue
+            corners = (p0, p1, p2)
+            ear = True
+            for j in remaining:
+                p = poly[j]
+                if j in (i0, i1, i2) or p in corners:
+                    continue
+                if (cross(p0, p1, p) >= 0.0 and cross(p1, p2, p) >= 0.0 and
+                        cross(p2, p0, p) >= 0.0):
+                    ear = False
+                    break
+            if ear:
+                tris.append((i0, i1, i2))
+                del remaining[n]
+                break
+        else:
+            #nothing left but degenerate corners
+            break
+    if len(remaining) == 3:
+        tris.append(tuple(remaining))
+    return tris
+
+def cap_box_face(segments, plane, lo, hi, face_inside):
+    """Build the polygons which close the clipped mesh on one face of the
+    box, from the cut edges on that face. Open chains of cut edges end on
+    the border of the face and are joined by walking counter clockwise
+    around it. Closed loops are islands, or holes when they run clockwise.
+    face_inside is called, with no arguments, when no cut edges give away
+    whether the rest of the face is inside the mesh.
+    returns a list of 3D polygons"""
+    axis, side = BOX_PLANES[plane]
+    u, v = (axis + 1) % 3, (axis + 2) % 3
+    if side == -1:
+        u, v = v, u
+    bound = lo[axis] if side == -1 else hi[axis]
+    u0, u1, v0, v1 = lo[u], hi[u], lo[v], hi[v]
+    width = u1 - u0
+    height = v1 - v0
+    perimeter = 2.0 * (width + height)
+    corners = ((0.0, (u0, v0)), (width, (u1, v0)),
+               (width + height, (u1, v1)), (2.0 * width + height, (u0, v1)))
+
+    def border_t(p):
+        x, y = p
+        dist = (abs(y - v0), abs(x - u1), abs(y - v1), abs(x - u0))
+        edge = dist.index(min(dist))
+        if edge == 0:
+            return min(max(x - u0, 0.0), width)
+        if edge == 1:
+            return width + min(max(y - v0, 0.0), height)
+        if edge == 2:
+            return width + height + min(max(u1 - x, 0.0), width)
+        return 2.0 * width + height + min(max(v1 - y, 0.0), height)
+
+    segments2d = []
+    for a, b in segments:
+        a2 = (a[u], a[v])
+        b2 = (b[u], b[v])
+        if _point_key(a2) != _point_key(b2):
+            segments2d.append((a2, b2))
+    open_chains, loops = _chain_segments(segments2d)
+
+    outers = []
+    holes = []
+    if open_chains:
+        starts = [border_t(chain[0]) for chain in open_chains]
+        remaining = set(range(len(open_chains)))
+        while remaining:
+            first = remaining.pop()
+            poly = []
+            i = first
+            while True:
+                poly.extend(open_chains[i])
+                t_end = border_t(open_chains[i][-1])
+                candidates = list(remaining) + [first]
+                j = min(candidates,
+                        key=lambda c: (starts[c] - t_end) % perimeter)
+                walk = (starts[j] - t_end) % perimeter
+                passed = sorted((((t - t_end) % perimeter, corner)
+                                 for t, corner in corners), key=lambda c: c[0])
+                poly.extend(corner for dist, corner in passed
+                            if 0.0 < dist < walk)
+                if j == first:
+                    break
+                remaining.discard(j)
+                i = j
+            outers.append(poly)
+    else:
+        if loops:
+            outermost = max(loops, key=lambda l: abs(_polygon_area(l)))
+            base_inside = _polygon_area(outermost) < 0.0
+        else:
+            base_inside = face_inside()
+        if base_inside:
+            outers.append([corner for t, corner in corners])
+
+    for loop in loops:
+        if _polygon_area(loop) > 0.0:
+            outers.append(loop)
+        else:
+            holes.append(loop)
+
+    #give each hole to the smallest polygon around it
+    outer_holes = [[] for outer in outers]
+    areas = [abs(_polygon_area(outer)) for outer in outers]
+    for hole in holes:
+        around = [i for i, outer in enumerate(outers)
+                  if _point_in_polygon(hole[0], outer)]
+        if around:
+            outer_holes[min(around, key=lambda i: areas[i])].append(hole)
+
+    polygons = []
+    for outer, inner in zip(outers, outer_holes):
+        if inner:
+            poly = _bridge_holes(outer, inner)
+            polys2d = [[poly[i] for i in tri]
+                       for tri in _triangulate_polygon(poly)]
+        else:
+            polys2d = [outer]
+        for poly2d in polys2d:
+            poly3d = []
+            for x, y in poly2d:
+                p = [0.0, 0.0, 0.0]
+                p[axis] = bound
+                p[u] = x
+                p[v] = y
+                poly3d.append(tuple(p))
+            polygons.append(poly3d)
+    return polygons
+
+def weld_polygons(polygons):
+    """merge the coincident corners of a list of 3D polygons, returns
+    (verts, faces) with faces as lists of vertex indices"""
+    if not polygons:
+        return np.empty((0, 3), dtype=np.float64), []
+    points = np.array([p for poly in polygons for p in poly])
+    verts, index = np.unique(np.round(points, 9), axis=0, return_inverse=True)
+    index = index.ravel().tolist()
+    faces = []
+    i = 0
+    for poly in polygons:
+        face = []
+        for vi in index[i:i + len(poly)]:
+            if not face or face[-1] != vi:
+                face.append(vi)
+        i += len(poly)
+        while len(face) > 1 and face[0] == face[-1]:
+            face.pop()
+        if len(set(face)) >= 3 and len(set(face)) == len(face):
+            faces.append(face)
+    return verts, faces
+
+def intersect_box(tris, lo, hi, face_inside):
+    """Intersect a closed triangle mesh with the box lo-hi analytically.
+    The triangles are clipped against the faces of the box, and the holes
+    this leaves in the faces of the box are capped.
+    face_inside(point) returns whether a point on a face of the box, away
+    from the mesh, is inside the mesh.
+    returns (verts, faces) of the closed intersection, faces is empty when
+    the box is outside the mesh"""
+    lo = [float(c) for c in lo]
+    hi = [float(c) for c in hi]
+    polygons, cuts = clip_triangles(tris, lo, hi)
+    return cap_clipped(polygons, cuts, lo, hi,
+                       lambda plane: face_inside(box_face_centre(lo, hi,
+                                                                 plane)))
+
+def box_face_centre(lo, hi, plane):
+    axis, side = BOX_PLANES[plane]
+    centre = [(l + h) * 0.5 for l, h in zip(lo, hi)]
+    centre[axis] = lo[axis] if side == -1 else hi[axis]
+    return centre
+
+def cap_clipped(polygons, cuts, lo, hi, face_inside):
+    """second half of intersect_box, caps the faces of the box given the
+    result of clip_triangles. face_inside(plane) is only called for faces
+    without any cut edges."""
+    polygons = list(polygons)
+    for plane in range(len(BOX_PLANES)):
+        polygons.extend(cap_box_face(cuts[plane], plane, lo, hi,
+                                     lambda p=plane: face_inside(p)))
+    return weld_polygons(polygons)
+
+def intersect_voxels(tris, voxels, size):
+    """intersect_box for a batch of boundary voxels, given as a list of
+    (coord, triangle indices) pairs. All the voxels are clipped first, so
+    the inside tests for the faces of the boxes which no triangle cuts can
+    be done in one call. returns a list of
+    (coord, verts, loop_totals, loop_indices) with the mesh buffers of each
+    voxel which isn't empty, verts being relative to the voxel centre"""
+    half = size / 2.0
+    clipped = []
+    #neighbouring voxels share faces, so each face is only tested once
+    queries = {}
+    for coord, indices in voxels:
+        centre = np.array(coord, dtype=np.float64) * size
+        lo = (centre - half).tolist()
+        hi = (centre + half).tolist()
+        polygons, cuts = clip_triangles(tris[indices], lo, hi)
+        face_keys = {}
+        for plane in range(len(BOX_PLANES)):
+            if not cuts[plane]:
+                key = tuple(round(c, 9)
+                            for c in box_face_centre(lo, hi, plane))
+                face_keys[plane] = queries.setdefault(key, len(queries))
+        clipped.append((coord, centre, lo, hi, polygons, cuts, face_keys))
+    points = sorted(queries, key=queries.get)
+    inside = points_in_mesh(points, tris) if points else []
+
+    results = []
+    for coord, centre, lo, hi, polygons, cuts, face_keys in clipped:
+        face_inside = dict((plane, bool(inside[i]))
+                           for plane, i in face_keys.items())
+        verts, faces = cap_clipped(polygons, cuts, lo, hi, face_inside.get)
+        if not faces:
+            continue
+        loop_totals = np.array([len(f) for f in faces], dtype=np.int32)
+        loop_indices = np.concatenate(faces).astype(np.int32)
+        results.append((coord, (verts - centre).astype(np.float32),
+                        loop_totals, loop_indices))
+    return results
+
+def _intersect_worker(tris, size, tasks, results):
+    """loop run by the processes of intersect_voxels_parallel"""
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        i, voxels = task
+        try:
+            results.put((i, len(voxels), intersect_voxels(tris, voxels, size),
+                         None))
+        except Exception:
+            results.put((i, len(voxels), [], traceback.format_exc()))
+
+#seconds intersect_voxels_parallel waits for a result before checking
+#that its processes are still running
+ISECT_POLL_INTERVAL = 1.0
+
+def intersect_voxels_parallel(tris, tasks, size, processes):
+    """Run intersect_voxels for the tasks, each a (chunk key, voxels) pair,
+    on a pool of forked processes. The processes inherit the triangles
+    when they are forked, so they share the pages of the array copy on
+    write rather than each getting a copy, and only the mesh buffers of
+    each voxel come back, so blender's main thread is left with just
+    writing them into meshes. Falls back to running in this process when
+    there's only one process to use, or processes can't be forked, and
+    for the tasks left over when a process dies.
+    yields (chunk key, n_voxels_done, results) for each task as it
+    finishes. Closing the generator early terminates the processes."""
+    processes = min(processes, len(tasks))
+    try:
+        ctx = multiprocessing.get_context("fork")
+    except (AttributeError, ValueError):
+        ctx = None
+    #without fork, on windows for one, the processes would have to be
+    #sent a copy of the triangles each, so the intersection is run
+    #serially in this process instead
+    if processes <= 1 or ctx is None:
+        for key, voxels in tasks:
+            yield key, len(voxels), intersect_voxels(tris, voxels, size)
+        return
+
+    done = set()
+    workers = []
+    try:
+        task_queue = ctx.Queue()
+        result_queue = ctx.Queue()
+        for i, (key, voxels) in enumerate(tasks):
+            task_queue.put((i, voxels))
+        for i in range(processes):
+            task_queue.put(None)
+            worker = ctx.Process(target=_intersect_worker,
+                                 args=(tris, size, task_queue, result_queue))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        while len(done) < len(tasks):
+            try:
+                i, n_voxels, results, error = result_queue.get(
+                    timeout=ISECT_POLL_INTERVAL)
+            except queue.Empty:
+                #a process which was killed never puts its result, and
+                #the ones which are left may never get to its task
+                if any(w.exitcode not in (None, 0) for w in workers) or \
+                        not any(w.is_alive() for w in workers):
+                    break
+                continue
+            if error is not None:
+                raise RuntimeError("intersecting chunk {0} failed:\n{1}"
+                                   .format(tasks[i][0], error))
+            done.add(i)
+            yield tasks[i][0], n_voxels, results
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    for i, (key, voxels) in enumerate(tasks):
+        if i not in done:
+            yield key, len(voxels), intersect_voxels(tris, voxels, size)
+
+#Mesh voxelization
+#number of triangles voxelize_mesh works on at a time
+VOXELIZE_BATCH = 1 << 16
+
+#the columns of cells are sampled this far off their centre, in cells, so
+#the rays of the parity fill don't run exactly through mesh edges which
+#are aligned with the grid
+PARITY_OFFSET = (1.23e-5, 2.71e-5)
+
+def triangle_box_overlap(tris, centres, half):
+    """Separating axis test of triangles against axis aligned boxes with
+    the same half size, a pair at a time (Akenine-Moller). tris is an
+    (n, 3, 3) array and centres an (n, 3) array, returns an (n,) bool
+    array which is True where the triangle touches the box. The bounding
+    boxes are assumed to overlap already, so only the triangle plane and
+    the nine edge cross product axes are tested."""
+    v = [tris[:, i] - centres for i in range(3)]
+    edges = [v[1] - v[0], v[2] - v[1], v[0] - v[2]]
+
+    #the plane of the triangle
+    normal = np.cross(edges[0], edges[1])
+    radius = half * np.abs(normal).sum(axis=1)
+    overlap = np.abs((normal * v[0]).sum(axis=1)) <= radius
+
+    #the cross products of the box axes with the triangle edges. Both
+    #ends of an edge project to the same point on its axes, so only one
+    #of them and the opposite vertex need projecting
+    for i, e in enumerate(edges):
+        a = v[i]
+        b = v[(i + 2) % 3]
+        for axis in range(3):
+            a1 = (axis + 1) % 3
+            a2 = (axis + 2) % 3
+            #axis x edge = (.., -e[a2], e[a1]) on (a1, a2)
+            pa = a[:, a2] * e[:, a1] - a[:, a1] * e[:, a2]
+            pb = b[:, a2] * e[:, a1] - b[:, a1] * e[:, a2]
+            radius = half * (np.abs(e[:, a1]) + np.abs(e[:, a2]))
+            overlap &= ((np.minimum(pa, pb) <= radius) &
+                        (np.maximum(pa, pb) >= -radius))
+    return overlap
+
+#largest bounding box of cells, in cells, unique_cells marks in a bitmap
+#rather than sorting
+UNIQUE_BITMAP_CELLS = 1 << 28
+
+def unique_cells(coords):
+    """np.unique of the rows of an (n, 3) int array of cells, done on one
+    int64 key per cell, which is much faster than unique with axis=0.
+    When the cells fit in a box of up to UNIQUE_BITMAP_CELLS the keys are
+    marked in a bitmap instead of sorted, which is faster still"""
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+    if len(coords) == 0:
+        return coords
+    lo = coords.min(axis=0)
+    dims = tuple(coords.max(axis=0) - lo + 1)
+    keys = np.ravel_multi_index((coords - lo).T, dims)
+    if np.prod(dims) <= UNIQUE_BITMAP_CELLS:
+        marked = np.zeros(int(np.prod(dims)), dtype=bool)
+        marked[keys] = True
+        keys = np.flatnonzero(marked)
+    else:
+        keys = np.unique(keys)
+    return np.stack(np.unravel_index(keys, dims), axis=1) + lo
+
+def voxelize_surface(tris, size):
+    """return the (n, 3) int32 coordinates of the cells touched by the
+    triangles, possibly with repeats. The cells of the bounding box of
+    each triangle are the candidates, and triangle_box_overlap keeps the
+    ones the triangle really passes through. A triangle whose bounding
+    box is a single cell needs no testing."""
+    lo_cell = np.floor(tris.min(axis=1) / size + 0.5).astype(np.int64)
+    hi_cell = np.floor(tris.max(axis=1) / size + 0.5).astype(np.int64)
+    span = hi_cell - lo_cell + 1
+    single = np.all(span == 1, axis=1)
+    pair_tri, cells = expand_boxes(lo_cell[~single], span[~single])
+    pair_tri = np.nonzero(~single)[0][pair_tri]
+    touch = triangle_box_overlap(tris[pair_tri], cells * float(size),
+                                 size / 2.0)
+    return np.concatenate((lo_cell[single], cells[touch])).astype(np.int32)
+
+def voxelize_crossings(tris, size):
+    """find where the triangles cross the columns of cells along z, for
+    voxelize_solid. returns (column x, column y, z) arrays, z in cells"""
+    xy = tris[:, :, :2] / size - PARITY_OFFSET
+    lo = np.ceil(xy.min(axis=1)).astype(np.int64)
+    hi = np.floor(xy.max(axis=1)).astype(np.int64)
+    span = np.ones((len(tris), 3), dtype=np.int64)
+    span[:, :2] = hi - lo + 1
+    keep = np.all(span > 0, axis=1)
+    lo3 = np.zeros((int(keep.sum()), 3), dtype=np.int64)
+    lo3[:, :2] = lo[keep]
+    pair_tri, cols = expand_boxes(lo3, span[keep])
+    pair_tri = np.nonzero(keep)[0][pair_tri]
+
+    #2d edge functions of the column against the projected triangle
+    p = xy[pair_tri]
+    q = cols[:, :2].astype(np.float64)
+    w = np.empty((len(p), 3))
+    for i in range(3):
+        a = p[:, i]
+        b = p[:, (i + 1) % 3]
+        w[:, i] = ((b[:, 0] - a[:, 0]) * (q[:, 1] - a[:, 1]) -
+                   (b[:, 1] - a[:, 1]) * (q[:, 0] - a[:, 0]))
+    hit = np.all(w > 0, axis=1) | np.all(w < 0, axis=1)
+    pair_tri = pair_tri[hit]
+    w = w[hit]
+    cols = cols[hit]
+
+    #interpolate z with the barycentric weights, w[i] is the weight of the
+    #vertex opposite edge i
+    z = tris[pair_tri, :, 2] / size
+    weights = np.roll(w, -1, axis=1)
+    z = (weights * z).sum(axis=1) / weights.sum(axis=1)
+    return cols[:, 0], cols[:, 1], z
+
+def voxelize_solid(tris, size):
+    """return the (n, 3) int32 coordinates of the cells whose centre is
+    inside the closed mesh, by scanline parity. Every column of cells
+    along z is crossed by the mesh an even number of times, and the
+    cells between the first and second crossing, the third and fourth
+    and so on are inside. Columns with an odd count, from holes in the
+    mesh, lose their last crossing."""
+    parts = [voxelize_crossings(tris[i:i + VOXELIZE_BATCH], size)
+             for i in range(0, len(tris), VOXELIZE_BATCH)]
+    if not parts:
+        return np.empty((0, 3), dtype=np.int32)
+    return parity_fill(np.concatenate([part[0] for part in parts]),
+                       np.concatenate([part[1] for part in parts]),
+                       np.concatenate([part[2] for part in parts]))
+
+def parity_fill(x, y, z):
+    """the cells between alternate crossings of each column, for
+    voxelize_solid. The crossings of a column must all be here, but the
+    columns are independent of each other"""
+    order = np.lexsort((z, y, x))
+    x, y, z = x[order], y[order], z[order]
+
+    #rank of each crossing in its column
+    new_col = np.ones(len(x), dtype=bool)
+    new_col[1:] = (x[1:] != x[:-1]) | (y[1:] != y[:-1])
+    starts = np.nonzero(new_col)[0]
+    rank = np.arange(len(x)) - np.repeat(starts, np.diff(np.append(starts,
+                                                                  len(x))))
+    enter = np.nonzero(rank % 2 == 0)[0]
+    enter = enter[enter + 1 < len(x)]
+    enter = enter[~new_col[enter + 1]]
+    z_lo = np.ceil(z[enter]).astype(np.int64)
+    z_hi = np.floor(z[enter + 1]).astype(np.int64)
+    span = np.ones((len(enter), 3), dtype=np.int64)
+    span[:, 2] = z_hi - z_lo + 1
+    keep = span[:, 2] > 0
+    lo = np.stack((x[enter], y[enter], z_lo), axis=1)[keep]
+    pair, cells = expand_boxes(lo, span[keep])
+    return cells.astype(np.int32)
+
+def voxelize_mesh(tris, size, solid=True):
+    """return the (n, 3) int32 unique coordinates of the cells of the
+    voxelized mesh, the surface cells, and when solid the cells inside it
+    as well"""
+    parts = [voxelize_surface(tris[i:i + VOXELIZE_BATCH], size)
+             for i in range(0, len(tris), VOXELIZE_BATCH)]
+    if solid:
+        parts.append(voxelize_solid(tris, size))
+    if not parts:
+        return np.empty((0, 3), dtype=np.int32)
+    return unique_cells(np.concatenate(parts)).astype(np.int32)
+
+#Streaming voxelization
+#number of triangles the streaming voxelizer reads at a time
+STREAM_BATCH = 1 << 18
+
+#number of dense chunks a ChunkSpill keeps in memory
+SPILL_RESIDENT_CHUNKS = 4096
+
+class ChunkSpill(object):
+    """Chunk values for the streaming voxelizer, which may be too many to
+    keep in memory. At most max_resident dense chunks are kept, in least
+    recently used order, and the rest are written out to a file each in
+    directory, to be read back when they are next touched. items()
+    flushes everything and yields each chunk from disk in turn."""
+
+    def __init__(self, directory, max_resident=SPILL_RESIDENT_CHUNKS):
+        self.directory = directory
+        self.max_resident = max_resident
+        self.resident = OrderedDict()
+        self.spilled = set()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, "{0}_{1}_{2}.chunk".format(*key))
+
+    def get_chunk(self, key):
+        values = self.resident.get(key)
+        if values is not None:
+            self.resident.move_to_end(key)
+            return values
+        if key in self.spilled:
+            values = np.fromfile(self.path(key), dtype=np.uint8)
+            values = values.reshape((CHUNK_SIZE,) * 3)
+        else:
+            values = np.zeros((CHUNK_SIZE,) * 3, dtype=np.uint8)
+        self.resident[key] = values
+        while len(self.resident) > self.max_resident:
+            self.spill(*self.resident.popitem(last=False))
+        return values
+
+    def spill(self, key, values):
+        values.tofile(self.path(key))
+        self.spilled.add(key)
+
+    def set_many(self, coords, value=1):
+        """VoxelGrid.set_many for the spilled chunks"""
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        if len(coords) == 0:
+            return
+        keys = coords // CHUNK_SIZE
+        local = coords - keys * CHUNK_SIZE
+        key_lo = keys.min(axis=0)
+        dims = tuple(keys.max(axis=0) - key_lo + 1)
+        flat = np.ravel_multi_index((keys - key_lo).T, dims)
+        order = np.argsort(flat, kind="stable")
+        flat, starts = np.unique(flat[order], return_index=True)
+        keys = np.stack(np.unravel_index(flat, dims), axis=1) + key_lo
+        for key, cells in zip(keys.tolist(), np.split(order, starts[1:])):
+            x, y, z = local[cells].T
+            self.get_chunk(tuple(key))[x, y, z] = value
+
+    def keys(self):
+        return self.spilled | set(self.resident)
+
+    def items(self):
+        """yield (key, values) for every chunk, only one being read from
+        disk at a time"""
+        while self.resident:
+            self.spill(*self.resident.popitem(last=False))
+        for key in sorted(self.spilled):
+            values = np.fromfile(self.path(key), dtype=np.uint8)
+            yield key, values.reshape((CHUNK_SIZE,) * 3)
+
+#crossing of a column of cells, see voxelize_crossings
+CROSSING_DTYPE = np.dtype([("x", "<i8"), ("y", "<i8"), ("z", "<f8")])
+
+def voxelize_stream(batches, size, spill, work_dir, solid=True):
+    """voxelize_mesh for triangles which come in batches, writing the
+    cells into the ChunkSpill spill. The surface of each batch is written
+    straight away. The parity fill needs all the crossings of a column at
+    once, so they are appended to a file per column of chunks in work_dir,
+    and the columns are filled one file at a time at the end. The memory
+    used depends on the batch size and the largest column of chunks,
+    rather than the size of the mesh. returns the number of triangles"""
+    n_tris = 0
+    columns = set()
+    for tris in batches:
+        n_tris += len(tris)
+        for i in range(0, len(tris), VOXELIZE_BATCH):
+            spill.set_many(voxelize_surface(tris[i:i + VOXELIZE_BATCH], size))
+        if not solid:
+            continue
+        x, y, z = voxelize_crossings(tris, size)
+        crossings = np.empty(len(x), dtype=CROSSING_DTYPE)
+        crossings["x"] = x
+        crossings["y"] = y
+        crossings["z"] = z
+        column = np.stack((x // CHUNK_SIZE, y // CHUNK_SIZE), axis=1)
+        order = np.lexsort((column[:, 1], column[:, 0]))
+        column = column[order]
+        crossings = crossings[order]
+        new = np.ones(len(column), dtype=bool)
+        new[1:] = np.any(column[1:] != column[:-1], axis=1)
+        starts = np.nonzero(new)[0]
+        for key, group in zip(column[starts].tolist(),
+                              np.split(crossings, starts[1:])):
+            key = tuple(key)
+            columns.add(key)
+            path = os.path.join(work_dir, "{0}_{1}.cross".format(*key))
+            with open(path, "ab") as f:
+                group.tofile(f)
+
+    for key in sorted(columns):
+        path = os.path.join(work_dir, "{0}_{1}.cross".format(*key))
+        crossings = np.fromfile(path, dtype=CROSSING_DTYPE)
+        os.remove(path)
+        spill.set_many(parity_fill(crossings["x"], crossings["y"],
+                                   crossings["z"]))
+    return n_tris
+
+STL_RECORD_DTYPE = np.dtype([("normal", "<f4", (3,)),
+                             ("verts", "<f4", (3, 3)),
+                             ("attribute", "<u2")])
+
+def read_stl_batches(path, batch=STREAM_BATCH):
+    """yield the triangles of a binary STL file, batch at a time, as
+    (n, 3, 3) float64 arrays"""
+    with open(path, "rb") as f:
+        f.read(80)
+        n_tris = struct.unpack("<I", f.read(4))[0]
+        if os.path.getsize(path) != 84 + n_tris * STL_RECORD_DTYPE.itemsize:
+            raise ValueError("{0} is not a binary STL file".format(path))
+        done = 0
+        while done < n_tris:
+            records = np.fromfile(f, dtype=STL_RECORD_DTYPE,
+                                  count=min(batch, n_tris - done))
+            done += len(records)
+            yield records["verts"].astype(np.float64)
+
+PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8"}
+
+def read_ply_header(f):
+    """parse the header of a binary PLY file, returns the byte order and a
+    list of (element name, count, properties), where each property is
+    (name, type) or (name, (count type, item type)) for a list"""
+    if f.readline().strip() != b"ply":
+        raise ValueError("not a PLY file")
+    order = None
+    elements = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError("PLY header has no end")
+        words = line.decode("ascii").split()
+        if not words or words[0] in ("comment", "obj_info"):
+            continue
+        if words[0] == "end_header":
+            break
+        if words[0] == "format":
+            if words[1] == "binary_little_endian":
+                order = "<"
+            elif words[1] == "binary_big_endian":
+                order = ">"
+            else:
+                raise ValueError("only binary PLY files can be streamed")
+        elif words[0] == "element":
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == "property":
+            if words[1] == "list":
+                prop = (words[4], (PLY_TYPES[words[2]], PLY_TYPES[words[3]]))
+            else:
+                prop = (words[2], PLY_TYPES[words[1]])
+            elements[-1][2].append(prop)
+    if order is None:
+        raise ValueError("PLY header has no format")
+    return order, elements
+
+def read_ply_batches(path, batch=STREAM_BATCH):
+    """yield the triangles of a binary PLY file, batch at a time, as
+    (n, 3, 3) float64 arrays. The vertex and face elements are memory
+    mapped rather than read, so only the vertices of the faces of a batch
+    are paged in. The faces must all be triangles."""
+    with open(path, "rb") as f:
+        order, elements = read_ply_header(f)
+        offset = f.tell()
+
+    vertices = None
+    faces = None
+    for name, count, props in elements:
+        fields = []
+        for prop_name, prop_type in props:
+            if isinstance(prop_type, tuple):
+                #a fixed size record only works out for triangles, which
+                #is checked for below
+                fields.append((prop_name + "_count", order + prop_type[0]))
+                fields.append((prop_name, order + prop_type[1], (3,)))
+            else:
+                fields.append((prop_name, order + prop_type))
+        dtype = np.dtype(fields)
+        if count:
+            data = np.memmap(path, dtype=dtype, mode="r", offset=offset,
+                             shape=(count,))
+        else:
+            data = np.empty(0, dtype=dtype)
+        offset += dtype.itemsize * count
+        if name == "vertex":
+            vertices = data
+        elif name == "face":
+            faces = data
+            break
+    if vertices is None or faces is None:
+        raise ValueError("{0} has no vertices or faces".format(path))
+    index_name = [n for n in faces.dtype.names if n.endswith("_count")]
+    if len(index_name) != 1:
+        raise ValueError("{0} faces have no vertex index list".format(path))
+    index_name = index_name[0][:-len("_count")]
+
+    for i in range(0, len(faces), batch):
+        face_batch = faces[i:i + batch]
+        if np.any(face_batch[index_name + "_count"] != 3):
+            raise ValueError("only triangulated PLY files can be streamed")
+        indices = np.asarray(face_batch[index_name], dtype=np.int64)
+        corners = vertices[indices.ravel()]
+        tris = np.stack((corners["x"], corners["y"], corners["z"]), axis=1)
+        yield tris.astype(np.float64).reshape(-1, 3, 3)
+
+def read_mesh_file_batches(path, batch=STREAM_BATCH):
+    """read_stl_batches or read_ply_batches, by the file extension"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".stl":
+        return read_stl_batches(path, batch)
+    if ext == ".ply":
+        return read_ply_batches(path, batch)
+    raise ValueError("can't stream triangles from {0} files".format(ext))
+
+#Voxel model files
+#MagicaVoxel .vox files are a tree of chunks, each an id, the size of its
+#content and the size of its children. The MAIN chunk has a SIZE and an
+#XYZI chunk for each model, which is at most VOX_MODEL_SIZE cells across,
+#with the voxels as (x, y, z, palette index) bytes, then the scene graph
+#which places the models, a tree of transform, group and shape nodes.
+#Palette indices are 1-255, just like the values of a VoxelGrid.
+VOX_MAGIC = b"VOX "
+VOX_VERSION = 150
+VOX_CHUNK_HEADER = struct.Struct("<4sii")
+VOX_MODEL_SIZE = 256
+
+def vox_chunk(chunk_id, content, children=b""):
+    return (VOX_CHUNK_HEADER.pack(chunk_id, len(content), len(children)) +
+            content + children)
+
+def vox_string(text):
+    data = text.encode("utf-8")
+    return struct.pack("<i", len(data)) + data
+
+def vox_dict(items):
+    return b"".join([struct.pack("<i", len(items))] +
+                    [vox_string(key) + vox_string(value)
+                     for key, value in sorted(items.items())])
+
+def read_vox_dict(data, offset):
+    """returns the DICT at offset in data, and the offset after it"""
+    items = {}
+    n_items = struct.unpack_from("<i", data, offset)[0]
+    offset += 4
+    for i in range(n_items):
+        pair = []
+        for j in range(2):
+            size = struct.unpack_from("<i", data, offset)[0]
+            pair.append(data[offset + 4:offset + 4 + size].decode("utf-8"))
+            offset += 4 + size
+        items[pair[0]] = pair[1]
+    return items, offset
+
+def vox_rotation(packed):
+    """the rotation matrix of the _r attribute of a transform node, which
+    packs the column of the one in the first and second rows in bits 0-1
+    and 2-3, and the signs of the rows in bits 4-6"""
+    rotation = np.zeros((3, 3), dtype=np.int64)
+    first = packed & 3
+    second = (packed >> 2) & 3
+    for row, column in enumerate((first, second, 3 - first - second)):
+        rotation[row, column] = -1 if (packed >> (4 + row)) & 1 else 1
+    return rotation
+
+def read_vox_nodes(data, chunk_id):
+    """parse the content of a scene graph chunk, returns the node id and
+    the node, as ("T", child, rotation, translation), ("G", children) or
+    ("S", model ids). Only the first frame of a transform is used."""
+    node_id = struct.unpack_from("<i", data)[0]
+    attributes, offset = read_vox_dict(data, 4)
+    if chunk_id == b"nTRN":
+        child, reserved, layer, n_frames = struct.unpack_from("<iiii", data,
+                                                              offset)
+        frame, offset = read_vox_dict(data, offset + 16)
+        rotation = vox_rotation(int(frame.get("_r", "4")))
+        translation = np.array([int(t) for t in
+                                frame.get("_t", "0 0 0").split()],
+                               dtype=np.int64)
+        return node_id, ("T", child, rotation, translation)
+    if chunk_id == b"nGRP":
+        n_children = struct.unpack_from("<i", data, offset)[0]
+        return node_id, ("G", struct.unpack_from("<{0}i".format(n_children),
+                                                 data, offset + 4))
+    n_models = struct.unpack_from("<i", data, offset)[0]
+    offset += 4
+    models = []
+    for i in range(n_models):
+        models.append(struct.unpack_from("<i", data, offset)[0])
+        model_attributes, offset = read_vox_dict(data, offset + 4)
+    return node_id, ("S", models)
+
+def vox_placements(nodes, node_id=0, rotation=None, translation=None):
+    """yield (model id, rotation, translation) for every shape in the scene
+    graph below node_id, with the transforms above it applied"""
+    if rotation is None:
+        rotation = np.identity(3, dtype=np.int64)
+        translation = np.zeros(3, dtype=np.int64)
+    node = nodes[node_id]
+    if node[0] == "T":
+        for placement in vox_placements(
+                nodes, node[1], np.dot(rotation, node[2]),
+                np.dot(rotation, node[3]) + translation):
+            yield placement
+    elif node[0] == "G":
+        for child in node[1]:
+            for placement in vox_placements(nodes, child, rotation,
+                                            translation):
+                yield placement
+    else:
+        for model in node[1]:
+            yield model, rotation, translation
+
+def read_vox_batches(path, batch=STREAM_BATCH):
+    """yield the voxels of a MagicaVoxel .vox file, batch at a time, as
+    an (n, 3) int64 array of cells and an (n,) uint8 array of palette
+    indices. Only the chunk headers are read up front, the voxels of the
+    models are memory mapped, and each model goes wherever the scene graph
+    puts it, about the middle of the model as MagicaVoxel does."""
+    models = []
+    nodes = {}
+    with open(path, "rb") as f:
+        magic, version = struct.unpack("<4si", f.read(8))
+        chunk_id, content, children = VOX_CHUNK_HEADER.unpack(
+            f.read(VOX_CHUNK_HEADER.size))
+        if magic != VOX_MAGIC or chunk_id != b"MAIN":
+            raise ValueError("{0} is not a MagicaVoxel file".format(path))
+        f.seek(content, os.SEEK_CUR)
+        end = f.tell() + children
+        size = None
+        while f.tell() < end:
+            chunk_id, content, children = VOX_CHUNK_HEADER.unpack(
+                f.read(VOX_CHUNK_HEADER.size))
+            if chunk_id == b"SIZE":
+                size = np.array(struct.unpack("<iii", f.read(12)),
+                                dtype=np.int64)
+                f.seek(content - 12, os.SEEK_CUR)
+            elif chunk_id == b"XYZI":
+                n_voxels = struct.unpack("<i", f.read(4))[0]
+                models.append((size, f.tell(), n_voxels))
+                f.seek(content - 4, os.SEEK_CUR)
+            elif chunk_id in (b"nTRN", b"nGRP", b"nSHP"):
+                node_id, node = read_vox_nodes(f.read(content), chunk_id)
+                nodes[node_id] = node
+            else:
+                f.seek(content, os.SEEK_CUR)
+            f.seek(children, os.SEEK_CUR)
+
+    if nodes:
+        placements = list(vox_placements(nodes))
+    else:
+        #files from before the scene graph have their models at the origin
+        placements = [(model, None, None) for model in range(len(models))]
+    for model, rotation, translation in placements:
+        size, offset, n_voxels = models[model]
+        if n_voxels == 0:
+            continue
+        voxels = np.memmap(path, dtype=np.uint8, mode="r", offset=offset,
+                           shape=(n_voxels, 4))
+        for i in range(0, n_voxels, batch):
+            xyzi = np.array(voxels[i:i + batch])
+            xyzi = xyzi[xyzi[:, 3] != 0]
+            coords = xyzi[:, :3].astype(np.int64)
+            if rotation is not None:
+                coords = np.dot(coords - size // 2, rotation.T) + translation
+            yield coords, xyzi[:, 3]
+
+def write_vox(path, grid):
+    """write the grid to a MagicaVoxel .vox file, split into models of
+    VOX_MODEL_SIZE cells, each placed by a transform node. The models are
+    written a block of chunks at a time, so only one model is ever held
+    in memory"""
+    per_model = VOX_MODEL_SIZE // CHUNK_SIZE
+    blocks = {}
+    for key, count in grid.chunk_counts().items():
+        if count:
+            block = tuple(k // per_model for k in key)
+            blocks.setdefault(block, []).append(key)
+    if not blocks:
+        raise ValueError("the voxel array is empty")
+
+    placements = []
+    with open(path, "wb") as f:
+        f.write(struct.pack("<4si", VOX_MAGIC, VOX_VERSION))
+        #the size of the children of MAIN is filled in at the end
+        f.write(VOX_CHUNK_HEADER.pack(b"MAIN", 0, 0))
+        for block in sorted(blocks):
+            coords = []
+            values = []
+            for key in blocks[block]:
+                chunk = grid.get_chunk(key)
+                coords.append(chunk.coords())
+                values.append(chunk.values[chunk.values != 0])
+            coords = np.concatenate(coords)
+            lo = coords.min(axis=0)
+            size = coords.max(axis=0) - lo + 1
+            xyzi = np.empty((len(coords), 4), dtype=np.uint8)
+            xyzi[:, :3] = coords - lo
+            xyzi[:, 3] = np.concatenate(values)
+            f.write(vox_chunk(b"SIZE", struct.pack("<iii", *size.tolist())))
+            f.write(VOX_CHUNK_HEADER.pack(b"XYZI", 4 + xyzi.nbytes, 0))
+            f.write(struct.pack("<i", len(xyzi)))
+            f.write(xyzi.tobytes())
+            placements.append(lo + size // 2)
+
+        #root transform -> group -> a transform and a shape per model
+        n_models = len(placements)
+        f.write(vox_chunk(b"nTRN", struct.pack("<i", 0) + vox_dict({}) +
+                          struct.pack("<iiii", 1, -1, -1, 1) + vox_dict({})))
+        f.write(vox_chunk(b"nGRP", struct.pack("<i", 1) + vox_dict({}) +
+                          struct.pack("<i", n_models) +
+                          struct.pack("<{0}i".format(n_models),
+                                      *range(2, 2 + 2 * n_models, 2))))
+        for model, translation in enumerate(placements):
+            node_id = 2 + 2 * model
+            frame = {"_t": " ".join(str(t) for t in translation.tolist())}
+            f.write(vox_chunk(b"nTRN", struct.pack("<i", node_id) +
+                              vox_dict({}) +
+                              struct.pack("<iiii", node_id + 1, -1, 0, 1) +
+                              vox_dict(frame)))
+            f.write(vox_chunk(b"nSHP", struct.pack("<i", node_id + 1) +
+                              vox_dict({}) +
+                              struct.pack("<ii", 1, model) + vox_dict({})))
+        end = f.tell()
+        f.seek(8)
+        f.write(VOX_CHUNK_HEADER.pack(b"MAIN", 0, end - 8 -
+                                      VOX_CHUNK_HEADER.size))
+
+#.binvox files are a short text header, then the occupancy of every cell
+#of a dim^3 box, run length encoded as (value, count) byte pairs, in x, z,
+#y order, y changing fastest. translate and scale place the box in space.
+def read_binvox_header(f):
+    """returns the dims, translate and scale of a .binvox file, leaving f
+    at the start of the voxel data"""
+    if not f.readline().startswith(b"#binvox"):
+        raise ValueError("not a binvox file")
+    dims = None
+    translate = (0.0, 0.0, 0.0)
+    scale = 1.0
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError("binvox header has no data")
+        words = line.decode("ascii").split()
+        if not words:
+            continue
+        if words[0] == "data":
+            break
+        if words[0] == "dim":
+            dims = tuple(int(w) for w in words[1:4])
+        elif words[0] == "translate":
+            translate = tuple(float(w) for w in words[1:4])
+        elif words[0] == "scale":
+            scale = float(words[1])
+    if dims is None:
+        raise ValueError("binvox header has no dim")
+    return dims, translate, scale
+
+def read_binvox_batches(path, batch=STREAM_BATCH):
+    """yield the occupied cells of a .binvox file, batch at a time, like
+    read_vox_batches. The runs are memory mapped and turned straight into
+    cells, without expanding the whole box. The cells are offset by the
+    translate of the file, in cells, which puts the box back where
+    write_binvox found it"""
+    with open(path, "rb") as f:
+        dims, translate, scale = read_binvox_header(f)
+        offset = f.tell()
+    n_pairs = (os.path.getsize(path) - offset) // 2
+    if n_pairs == 0:
+        return
+    runs = np.memmap(path, dtype=np.uint8, mode="r", offset=offset,
+                     shape=(n_pairs, 2))
+    unit = scale / max(dims)
+    shift = np.round(np.array(translate) / unit).astype(np.int64)
+
+    #a run is at most 255 cells
+    step = max(1, batch // 255)
+    start = 0
+    for i in range(0, n_pairs, step):
+        pairs = np.array(runs[i:i + step])
+        lengths = pairs[:, 1].astype(np.int64)
+        starts = start + np.cumsum(lengths) - lengths
+        start += int(lengths.sum())
+        full = pairs[:, 0] != 0
+        starts = starts[full]
+        lengths = lengths[full]
+        if len(starts) == 0:
+            continue
+        #the index of every cell of every run
+        index = (np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) +
+                 np.arange(lengths.sum()))
+        x, rest = np.divmod(index, dims[1] * dims[2])
+        z, y = np.divmod(rest, dims[2])
+        coords = np.stack((x, y, z), axis=1) + shift
+        yield coords, np.ones(len(coords), dtype=np.uint8)
+
+def binvox_runs(flat):
+    """the (value, count) byte pairs of a flat uint8 occupancy array"""
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(flat)))
+    #runs over 255 are split into 255 long pieces and the rest
+    pieces = (lengths + 254) // 255
+    values = np.repeat(flat[starts], pieces)
+    counts = np.full(len(values), 255, dtype=np.int64)
+    counts[np.cumsum(pieces) - 1] = lengths - 255 * (pieces - 1)
+    return np.stack((values, counts), axis=1).astype(np.uint8).tobytes()
+
+def write_binvox(path, grid, voxel_size):
+    """write the occupancy of the grid to a .binvox file, for the smallest
+    cube around it, a slab of chunks at a time"""
+    bounds = grid.bounds(exact=True)
+    if bounds is None:
+        raise ValueError("the voxel array is empty")
+    lo, hi = bounds
+    dim = int((hi - lo).max()) + 1
+    key_lo = lo // CHUNK_SIZE
+    key_hi = (lo + dim - 1) // CHUNK_SIZE
+    extent = (key_hi - key_lo + 1) * CHUNK_SIZE
+    crop = lo - key_lo * CHUNK_SIZE
+    slabs = {}
+    for key in grid.chunk_keys():
+        slabs.setdefault(key[0], []).append(key)
+
+    with open(path, "wb") as f:
+        f.write("#binvox 1\ndim {0} {0} {0}\ntranslate {1} {2} {3}\n"
+                "scale {4}\ndata\n".format(
+                    dim, *((lo * voxel_size).tolist() +
+                           [dim * voxel_size])).encode("ascii"))
+        for kx in range(int(key_lo[0]), int(key_hi[0]) + 1):
+            #the slab is indexed x, z, y like the file
+            slab = np.zeros((CHUNK_SIZE, extent[2], extent[1]),
+                            dtype=np.uint8)
+            for key in slabs.get(kx, ()):
+                chunk = grid.get_chunk(key)
+                if chunk.count == 0:
+                    continue
+                z = (key[2] - key_lo[2]) * CHUNK_SIZE
+                y = (key[1] - key_lo[1]) * CHUNK_SIZE
+                slab[:, z:z + CHUNK_SIZE, y:y + CHUNK_SIZE] = \
+                    chunk.values.transpose(0, 2, 1) != 0
+            x0 = max(kx * CHUNK_SIZE, lo[0]) - kx * CHUNK_SIZE
+            x1 = min((kx + 1) * CHUNK_SIZE, lo[0] + dim) - kx * CHUNK_SIZE
+            slab = slab[x0:x1, crop[2]:crop[2] + dim, crop[1]:crop[1] + dim]
+            f.write(binvox_runs(slab.ravel()))
+
+def read_voxel_file_batches(path, batch=STREAM_BATCH):
+    """read_vox_batches or read_binvox_batches, by the file extension"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".vox":
+        return read_vox_batches(path, batch)
+    if ext == ".binvox":
+        return read_binvox_batches(path, batch)
+    raise ValueError("can't read voxels from {0} files".format(ext))
+
+#record of the intersection key of a voxel, saved per chunk on the empty,
+#index is the flat index of the voxel in its chunk
+ISECT_KEY_DTYPE = np.dtype([("index", "<u2"), ("key", "<u8")])
+
+#intersection keys of the voxels without triangles in them
+ISECT_KEY_OUTSIDE = 0
+ISECT_KEY_INSIDE = 1
+
+def isect_key(tris):
+    """64 bit hash of the triangles binned into a voxel, the intersection
+    of the voxel only has to be redone when this changes"""
+    digest = hashlib.sha1(np.ascontiguousarray(tris).tobytes()).digest()
+    return int.from_bytes(digest[:8], "little")
+
+#size the on disk intersection cache is kept under, in bytes
+ISECT_CACHE_SIZE = 256 << 20
+
+class IntersectionCache(object):
+    """Content addressed on disk cache of the clipped geometry of the
+    boundary voxels, so re-intersecting the same object, in this session or
+    after reopening the file, reuses past work. Entries are keyed by the
+    hash of the whole target, the voxel size and the voxel coordinate,
+    because the caps of a voxel depend on the whole mesh, not just the
+    triangles in it. Each entry is a small file named by its key, holding
+    a header and the float32 verts, loop totals and loop indices. Hits
+    touch the file, and once the cache grows over max_size the least
+    recently used files are deleted."""
+    MAGIC = b"VXI1"
+    HEADER = struct.Struct("<4sIII")
+
+    def __init__(self, directory, max_size=ISECT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._sizes = None
+        #sum of _sizes, kept up to date as entries come and go
+        self._total_bytes = 0
+
+    @staticmethod
+    def key(target_hash, size, coord):
+        text = "{0}:{1!r}:{2},{3},{4}".format(target_hash, float(size),
+                                             coord[0], coord[1], coord[2])
+        return hashlib.sha1(text.encode("ascii")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".isect")
+
+    def get(self, key):
+        """return (verts, loop_totals, loop_indices) for the key, or None
+        if it isn't in the cache. An empty voxel has zero length buffers"""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        try:
+            magic, n_verts, n_loops, n_indices = self.HEADER.unpack_from(data)
+            if magic != self.MAGIC:
+                return None
+            offset = self.HEADER.size
+            index_type = np.uint16 if n_verts <= 0xffff else np.uint32
+            verts = np.frombuffer(data, np.float32, n_verts * 3, offset)
+            offset += verts.nbytes
+            loop_totals = np.frombuffer(data, np.uint32, n_loops, offset)
+            offset += loop_totals.nbytes
+            loop_indices = np.frombuffer(data, index_type, n_indices, offset)
+        except (struct.error, ValueError):
+            return None
+        return (verts.reshape(-1, 3), loop_totals.astype(np.int32),
+                loop_indices.astype(np.int32))
+
+    def put(self, key, verts, loop_totals, loop_indices):
+        verts = np.asarray(verts, dtype=np.float32).reshape(-1, 3)
+        index_type = np.uint16 if len(verts) <= 0xffff else np.uint32
+        data = b"".join((
+            self.HEADER.pack(self.MAGIC, len(verts), len(loop_totals),
+                             len(loop_indices)),
+            verts.tobytes(),
+            np.asarray(loop_totals, dtype=np.uint32).tobytes(),
+            np.asarray(loop_indices, dtype=index_type).tobytes()))
+        path = self.path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            #write to a temporary file first, so a reader never sees half
+            #an entry
+            tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            traceback.print_exc()
+            return
+        sizes = self.sizes()
+        self._total_bytes += len(data) - sizes.get(key, 0)
+        sizes[key] = len(data)
+        if self._total_bytes > self.max_size:
+            self.evict()
+
+    def sizes(self):
+        """dict from key to file size of the entries, read from the
+        directory the first time it is needed"""
+        if self._sizes is None:
+            self._sizes = {}
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                names = []
+            for name in names:
+                if name.endswith(".isect"):
+                    try:
+                        size = os.path.getsize(os.path.join(self.directory,
+                                                            name))
+                    except OSError:
+                        continue
+                    self._sizes[name[:-len(".isect")]] = size
+            self._total_bytes = sum(self._sizes.values())
+        return self._sizes
+
+    def evict(self):
+        """delete the least recently used entries until the cache is back
+        under three quarters of max_size, so it doesn't evict on every put"""
+        sizes = self.sizes()
+        used = {}
+        for key in sizes:
+            try:
+                used[key] = os.path.getmtime(self.path(key))
+            except OSError:
+                used[key] = 0.0
+        for key in sorted(used, key=used.get):
+            if self._total_bytes <= self.max_size * 3 // 4:
+                break
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            self._total_bytes -= sizes.pop(key)
+
+    def clear(self):
+        for key in list(self.sizes()):
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+        self._sizes = {}
+        self._total_bytes = 0
+
+_isect_cache = None
+
+def get_isect_cache():
+    """return the IntersectionCache, kept in blender's user data files"""
+    global _isect_cache
+    if _isect_cache is None:
+        directory = bpy.utils.user_resource('DATAFILES',
+                                            "voxel_painter_isect_cache")
+        if not directory:
+            directory = os.path.join(tempfile.gettempdir(),
+                                     "voxel_painter_isect_cache")
+        _isect_cache = IntersectionCache(directory)
+    return _isect_cache
+
+#VoxelGrid instances and coordinate -> voxel object indices for each
+#VoxelArray empty, keyed by the empty name. These are rebuilt from the
+#blend file data whenever it gets reloaded, because the objects they
+#reference don't survive a reload or an undo step.
+_voxel_grids = {}
+_voxel_indices = {}
+#keys of the chunks of each VoxelArray which are displayed with a
+#culled_mesh and are waiting to be greedy meshed
+_voxel_remesh_queues = {}
+#open VoxelSidecar files, keyed by their absolute path
+_voxel_sidecars = {}
+#names of the arrays displayed by chunk whose grid has been edited since
+#it was last saved, see VoxelArray.save_pending
+_voxel_unsaved = set()
+
+def get_sidecar(path):
+    """return the open VoxelSidecar for the file at path, or None if
+    there isn't one there yet"""
+    path = os.path.normpath(bpy.path.abspath(path))
+    sidecar = _voxel_sidecars.get(path)
+    if sidecar is None and os.path.isfile(path):
+        sidecar = VoxelSidecar(path)
+        _voxel_sidecars[path] = sidecar
+    return sidecar
+
+def close_sidecars():
+    for sidecar in _voxel_sidecars.values():
+        sidecar.close()
+    _voxel_sidecars.clear()
+
+@persistent
+def voxel_grids_clear_handler(dummy):
+    _voxel_grids.clear()
+    _voxel_indices.clear()
+    _voxel_remesh_queues.clear()
+    _voxel_unsaved.clear()
+    close_sidecars()
+
+@persistent
+def voxel_grids_save_handler(dummy):
+    """save the grids with edits which haven't been saved yet, before they
+    go into the blend file"""
+    for name in list(_voxel_unsaved):
+        obj = bpy.data.objects.get(name)
+        if obj is None or obj.vox_empty.display_mode != 'CHUNKS':
+            _voxel_unsaved.discard(name)
+        elif _voxel_grids[name].load_error is None:
+            VoxelArray(obj, bpy.context).save_grid()
+
+@persistent
+def voxel_grids_undo_handler(dummy):
+    """the objects the grids were built from have been swapped for the
+    ones from the undo step. The empty of an array displayed by chunk
+    comes back with the id of the journal step it was at, see
+    VoxelArray.commit_edit, so its grid is brought to that step by
+    replaying the deltas of the journal, and the chunk meshes, which came
+    back with the undo step, already match it. Those meshes may be the
+    quick culled ones, so the chunks the step changed are queued to be
+    greedy meshed again by refine_display, along with the chunks which
+    were waiting already. Sidecar files aren't part of the undo steps,
+    so they are saved again.
+    Grids whose journal doesn't have the step, or which index voxel
+    objects, are rebuilt from the blend file, except that sidecar grids
+    have nothing to be rebuilt from, so they stay as they are and their
+    loaded chunks, which takes in every edited chunk, are meshed again by
+    the next update_display"""
+    for name, grid in list(_voxel_grids.items()):
+        obj = bpy.data.objects.get(name)
+        sidecar = isinstance(grid.source, VoxelSidecar)
+        if obj is None or obj.vox_empty.display_mode != 'CHUNKS':
+            del _voxel_grids[name]
+            _voxel_indices.pop(name, None)
+            _voxel_unsaved.discard(name)
+            _voxel_remesh_queues.pop(name, None)
+        elif grid.journal.seek(grid, obj.get("vox_journal_step", 0)):
+            todo = _voxel_remesh_queues.setdefault(name, set())
+            for key in grid.dirty_chunks():
+                todo.add(key)
+                grid.clean_chunk(key)
+            if sidecar:
+                VoxelArray(obj, bpy.context).save_grid()
+            else:
+                #the vox_grid property came back with the undo step
+                _voxel_unsaved.discard(name)
+        elif sidecar:
+            for chunk in grid.chunks.values():
+                chunk.dirty = True
+        else:
+            del _voxel_grids[name]
+            _voxel_indices.pop(name, None)
+            _voxel_unsaved.discard(name)
+            _voxel_remesh_queues.pop(name, None)
+
 #Voxel Editor base classes
 class VoxelRayIntersection(object):
-    def __init__(self, voxel, loc, nor, dist_squared):
+    def __init__(self, voxel, loc, nor, dist_squared, coord=None):
         self.voxel = voxel
         self.dist_squared = dist_squared
         self.loc = loc
         self.nor = nor
+        self.coord = coord
 
     def __str__(self):
         return "VRI Vox:{0}, Dist:{1}".format(
@@ -139,10 +3457,35 @@ class BlenderObjectMesh(BlenderObject):
             self.copy_obj_mesh_name()
 
     def copy_obj_mesh_name(self):
-        self.obj.data.name = self.obj.name
+        #a mesh shared between several objects keeps its own name
+        if self.obj.data.users == 1:
+            self.obj.data.name = self.obj.name
 
 class IntersectionMesh(BlenderObjectMesh):
-    pass
+    """Mesh object holding the part of the intersect object inside a voxel"""
+
+    @classmethod
+    def poll_isect_mesh(cls, obj):
+        return ("vox_isect" in obj or "vox_isect_chunk" in obj or
+                "_isect" in obj.name)
+
+    @classmethod
+    def gen_get_chunk_name(cls, va_name, key):
+        """name of the merged intersection mesh of a chunk"""
+        return va_name + "_isect_chunk({0}, {1}, {2})".format(key[0], key[1],
+                                                               key[2])
+
+class VoxelChunkMesh(BlenderObjectMesh):
+    """Mesh object displaying the surface of one chunk of a VoxelArray, used
+    when the array is displayed by chunk rather than by voxel object"""
+
+    @classmethod
+    def poll_chunk_mesh(cls, obj):
+        return "vox_chunk" in obj
+
+    @classmethod
+    def gen_get_name(cls, va_name, key):
+        return va_name + "_chunk({0}, {1}, {2})".format(key[0], key[1], key[2])
 
 class Voxel(BlenderObjectMesh):
     #Operator Poll Functions
@@ -151,6 +3494,9 @@ class Voxel(BlenderObjectMesh):
         if(obj.type != 'MESH'):
             return False
 
+        if(VoxelChunkMesh.poll_chunk_mesh(obj)):
+            return False
+
         if(obj.parent is not None):
             if(VoxelArray.poll_voxelarray_empty_created(obj.parent)):
                 return True
@@ -199,7 +3545,7 @@ class Voxel(BlenderObjectMesh):
     def get_isect_mesh(self):
         for obj in self.obj.children:
             if obj.type == 'MESH':
-                if "_isect" in obj.name:
+                if IntersectionMesh.poll_isect_mesh(obj):
                     return IntersectionMesh(obj, self.context)
         return None
 
@@ -239,58 +3585,22 @@ class Voxel(BlenderObjectMesh):
                         #if obj_dupli.type == 'MESH':
                             #yield (obj_dupli, dob.matrix.copy())
 
-    def intersect_mesh(self, obj):
-        """run a boolean intersect operation between a mesh object and the voxel
-        and the resultant mesh is parented to the voxel"""
-        select_none(bpy.context)
-        self.select()
-        print("Active:", bpy.context.active_object)
-        print("Object:", bpy.context.object)
-        print("self:", self.obj)
-
-        bpy.ops.object.duplicate() #duplicate selected object
-        #duplicated object is now selected and active
-        print("Active:", bpy.context.active_object)
-        print("Object:", bpy.context.object)
-
-        isect_obj = bpy.context.scene.objects[self.obj.name + ".001"]
-        isect_obj.select=True
-        bpy.context.scene.objects.active = isect_obj
-        isect_obj.name = self.obj.name + "_isect"
-        isect_obj.parent = self.obj
-        isect_obj.location = Vector((0.0, 0.0, 0.0))
-        #bpy.ops.object.modifier_add(type='BOOLEAN')
-        #select_none(bpy.context)
-        isect_mesh = IntersectionMesh(isect_obj, self.context, creating=True)
-        isect_mesh.select()
-
-        override = selection_context(isect_obj)
-        bpy.ops.object.modifier_add(override, type='BOOLEAN')
-
-        print(isect_obj.type)
-        print(isect_obj.name)
-        bool_mod = isect_obj.modifiers[0]
-        bool_mod.object = obj
-        bpy.ops.object.modifier_apply(override, modifier=bool_mod.name)
-        isect_obj.draw_type = "TEXTURED"
-
 class VoxelArray(object):
     """VoxelArray is a utility class to facilitate accessing the sparse voxel
     array, and saving to blend file.
     An example usage would be:
-    va = VoxelArray(context.object)
-    va[0, 0, 0] = Voxel(...)
-    during assignment Voxel object is converted to blender's python ID property
-    format.
-    Currently voxels are based on objects in blender. This is convenient, because
-    it saves me work (in terms of saving the data to blend file, but it is also
-    crap because performance is bad. There is a limit of around 2000 voxels. Because
-    I've designed this program to be fairly modular, it shouldn't be too much work
-    in the future to replace this with an ID property system, which could possibly
-    be cached, but then the problem is displaying the voxels. Drawing in opengl is
-    quite a bit of extra work, and doesn't integrate as nicely. Doing stuff in edit
-    mode in a single object would be faster, but is more likely to result in user error
-    by editing the shape of the voxel array."""
+    va = VoxelArray(context.object, context)
+    va.new_vox(Vector((0, 0, 2)))
+    The voxel data itself lives in a VoxelGrid (va.grid), which stores the
+    integer coordinates and attributes of the voxels in compact arrays, so
+    adding, deleting and looking up voxels doesn't touch blender at all.
+    The grid is cached per empty, and rebuilt from the blend file data when a
+    blend file is loaded.
+    The array is displayed in one of two ways, set by the display_mode
+    property. 'OBJECTS' gives every voxel its own cube object, which is what
+    gets saved to the blend file. 'CHUNKS' gives every chunk of the grid one
+    greedy meshed object, and saves the chunk values in an ID property on
+    the empty, so the viewport only pays for the surface of the array."""
 
     #Operator Poll Functions
     @classmethod
@@ -341,6 +3651,115 @@ class VoxelArray(object):
         self.obj = obj
         self.context = context
         self.props = self.obj.vox_empty
+        self.grid = self.get_grid()
+        self.index = _voxel_indices[self.obj.name]
+        self.remesh_queue = _voxel_remesh_queues.setdefault(self.obj.name,
+                                                            set())
+        #intersection changes waiting for flush_isect, by chunk
+        self.isect_staged = {}
+        #whether the last voxelize_batches streamed into the sidecar
+        self.streamed = False
+
+    def get_grid(self):
+        """return the cached VoxelGrid for this array, building it and the
+        coordinate -> voxel object index from the voxel objects if they
+        haven't been built since the blend file loaded"""
+        grid = _voxel_grids.get(self.obj.name)
+        if grid is None:
+            self.rebuild_index()
+            grid = _voxel_grids[self.obj.name]
+        return grid
+
+    def rebuild_index(self):
+        """build the grid, and the coordinate -> voxel object index, from
+        what the array was saved in. Saved grid blobs are only attached
+        to the grid, so the chunks are decoded as they are needed, and
+        opening a big array doesn't have to go through all of it"""
+        grid = VoxelGrid()
+        index = {}
+        sidecar = None
+        path = self.obj.vox_empty.sidecar_path
+        if self.display_chunks() and path:
+            try:
+                sidecar = self.get_sidecar()
+                if sidecar is None and self.obj.get("vox_sidecar_count"):
+                    raise IOError("the file is missing")
+            except (IOError, OSError, ValueError) as e:
+                #leave the grid empty, and keep it from being saved over
+                #the voxels which couldn't be read
+                grid.load_error = "Can't read voxels from {0}: {1}".format(
+                    path, e)
+        if grid.load_error is not None:
+            pass
+        elif sidecar is not None:
+            grid.attach(sidecar)
+        elif self.display_chunks() and "vox_grid" in self.obj:
+            grid.attach(GridBlobSource(bytes(self.obj["vox_grid"])))
+        elif self.display_chunks():
+            #arrays saved before the grid blob, with a raw buffer per chunk
+            for name, data in self.obj.get("vox_chunks", {}).items():
+                key = chunk_name_key(name)
+                values = np.frombuffer(bytes(data), dtype=np.uint8)
+                grid.set_chunk_values(key, values.reshape((CHUNK_SIZE,) * 3))
+        else:
+            for c in self.voxel_objects():
+                coord = pos_to_coord(c.location)
+                grid.set(coord)
+                index[coord] = c
+        for key in grid.dirty_chunks():
+            grid.clean_chunk(key)
+        #there's no telling which chunks were edited since the array was
+        #last intersected, so all of them count as newer than that
+        grid.generation = self.obj.vox_empty.isect_generation + 1
+        grid.load_generation = grid.generation
+        for chunk in grid.chunks.values():
+            chunk.generation = grid.generation
+        grid.journal = VoxelJournal(self.obj.get("vox_journal_step", 0))
+        _voxel_grids[self.obj.name] = grid
+        _voxel_indices[self.obj.name] = index
+
+    def commit_edit(self):
+        """close the edits made since the last commit_edit into a step of
+        the journal of the grid, and tag the empty with the id of the
+        step, so the undo step blender pushes for the edit can be matched
+        up with it by voxel_grids_undo_handler. Returns False if there
+        were no edits"""
+        self.save_pending()
+        step_id = self.grid.journal.commit()
+        if step_id is None:
+            return False
+        self.obj["vox_journal_step"] = step_id
+        return True
+
+    def save_pending(self):
+        """save the grid if it has been edited since it was last saved.
+        Edits only mark the array unsaved, so strokes don't pay for
+        saving the whole grid on every update_display, and it is saved
+        when the edit is committed, or the blend file is saved"""
+        if self.obj.name in _voxel_unsaved:
+            self.save_grid()
+
+    def get_sidecar(self):
+        """the VoxelSidecar the grid is kept in, or None if it is kept in
+        the vox_grid property of the empty"""
+        path = self.obj.vox_empty.sidecar_path
+        if not path:
+            return None
+        return get_sidecar(path)
+
+    def display_chunks(self):
+        return self.obj.vox_empty.display_mode == 'CHUNKS'
+
+    def voxel_objects(self):
+        for c in self.obj.children:
+            if not (VoxelChunkMesh.poll_chunk_mesh(c) or
+                    IntersectionMesh.poll_isect_mesh(c)):
+                yield c
+
+    def chunk_objects(self):
+        for c in self.obj.children:
+            if VoxelChunkMesh.poll_chunk_mesh(c):
+                yield c
 
     def get_n_voxels(self):
         return len(self)
@@ -360,14 +3779,22 @@ class VoxelArray(object):
             voxel.select_children()
 
     def select_children_isect(self):
-        i = 0
-        for voxel in self.voxels():
-            voxel.select_children()
-            if i:
+        for i, isect_obj in enumerate(self.isect_objects()):
+            isect_obj.select = True
+            if i == 0:
                 #set the first isect mesh as the active object
-                for isect_obj in voxel.obj.children:
-                    set_active(self.context, isect_obj)
-            i+=1
+                set_active(self.context, isect_obj)
+
+    def isect_objects(self):
+        """yield the intersection mesh objects, which are parented to their
+        voxel object, or to the empty when the array is displayed by chunk"""
+        for c in self.obj.children:
+            if IntersectionMesh.poll_isect_mesh(c):
+                yield c
+            elif not VoxelChunkMesh.poll_chunk_mesh(c):
+                for isect_obj in c.children:
+                    if IntersectionMesh.poll_isect_mesh(isect_obj):
+                        yield isect_obj
 
     def select(self):
         self.clear_selected(self.context)
@@ -379,6 +3806,157 @@ class VoxelArray(object):
     def apply_draw_type(self):
         for voxel in self.voxels():
             voxel.set_draw_type(self.draw_type())
+        for chunk_obj in self.chunk_objects():
+            chunk_obj.draw_type = self.draw_type()
+
+    def apply_display_mode(self):
+        """convert the display of the array between voxel objects
+        and chunk meshes"""
+        if self.display_chunks():
+            #the intersection meshes of the voxels go with their objects
+            if self.is_intersected():
+                self.delete_intersection(None)
+            for obj in list(self.voxel_objects()):
+                remove_object(self.context, obj)
+            self.index.clear()
+            for key in self.grid.chunk_keys():
+                self.grid.get_chunk(key).dirty = True
+            self.update_display()
+            self.save_pending()
+        else:
+            for obj in list(self.chunk_objects()):
+                remove_object(self.context, obj)
+            for prop in ("vox_grid", "vox_chunks"):
+                if prop in self.obj:
+                    del self.obj[prop]
+            _voxel_unsaved.discard(self.obj.name)
+            for coord in self.grid:
+                self.new_vox_obj(coord)
+            for key in self.grid.dirty_chunks():
+                self.grid.clean_chunk(key)
+
+    def apply_share_mesh(self):
+        """link all the voxel objects to the shared cube mesh, or give them
+        back a mesh each, removing the meshes which are no longer used"""
+        share = self.obj.vox_empty.share_mesh
+        for obj in self.voxel_objects():
+            old_mesh = obj.data
+            if share:
+                obj.data = get_voxel_cube_mesh()
+            elif old_mesh.users > 1:
+                obj.data = old_mesh.copy()
+                obj.data.name = obj.name
+            if old_mesh.users == 0:
+                bpy.data.meshes.remove(old_mesh)
+
+    def update_display(self, budget=None):
+        """bring everything that depends on the chunks edited since the
+        last update in line with the grid. An edit only dirties the chunk
+        it is in, and the neighbouring chunk when it is on the border, so
+        this is cheap for single voxel edits. Once budget seconds have been
+        spent, the remaining chunks get a quick culled_mesh and are queued
+        to be greedy meshed by refine_display"""
+        start = time.time()
+        dirty = self.grid.dirty_chunks()
+        for key in dirty:
+            if self.display_chunks():
+                greedy = budget is None or time.time() - start < budget
+                self.update_chunk_mesh(key, greedy)
+            self.grid.clean_chunk(key)
+        if dirty and self.display_chunks():
+            _voxel_unsaved.add(self.obj.name)
+
+    def refine_display(self, budget=None):
+        """greedy mesh the chunks which were displayed with a culled_mesh,
+        for at most budget seconds, returns True when none are left"""
+        start = time.time()
+        while self.remesh_queue:
+            if budget is not None and time.time() - start >= budget:
+                return False
+            self.update_chunk_mesh(self.remesh_queue.pop())
+        return True
+
+    def update_chunk_mesh(self, key, greedy=True):
+        """mesh a chunk, and swap the result into its chunk object"""
+        name = VoxelChunkMesh.gen_get_name(self.obj.name, key)
+        chunk_obj = bpy.data.objects.get(name)
+        if not exposed_faces(self.grid, key).any():
+            #empty, or buried in voxels on every side, nothing to mesh
+            self.remesh_queue.discard(key)
+            if chunk_obj is not None:
+                remove_object(self.context, chunk_obj)
+            return
+        padded = self.grid.padded_values(key)
+        if greedy:
+            self.remesh_queue.discard(key)
+            verts, faces, face_values = greedy_mesh(padded)
+        else:
+            self.remesh_queue.add(key)
+            verts, faces, face_values = culled_mesh(padded)
+        if len(faces) == 0:
+            if chunk_obj is not None:
+                remove_object(self.context, chunk_obj)
+            return
+
+        mesh = bpy.data.meshes.new(name)
+        write_mesh_data(mesh, verts * VOXEL_SIZE, faces, face_values)
+        if chunk_obj is None:
+            chunk_obj = bpy.data.objects.new(name, mesh)
+            chunk_obj["vox_chunk"] = key
+            self.context.scene.objects.link(chunk_obj)
+            chunk_obj.parent = self.obj
+            #put the object origin on the corner of the first cell
+            chunk_obj.location = (coord_to_pos(np.array(key) * CHUNK_SIZE) -
+                                  Vector((0.5, 0.5, 0.5)) * VOXEL_SIZE)
+            chunk_obj.draw_type = self.draw_type()
+        else:
+            old_mesh = chunk_obj.data
+            chunk_obj.data = mesh
+            bpy.data.meshes.remove(old_mesh)
+
+    def save_grid(self):
+        """store the grid as one blob, see encode_grid, in the sidecar file
+        if the array has one, otherwise in the vox_grid ID property. Only
+        the chunks edited since they were last encoded are encoded again,
+        and only those are written to a sidecar which is already there.
+        Raises IOError rather than save a grid which failed to load"""
+        grid = self.grid
+        if grid.load_error is not None:
+            raise IOError(grid.load_error)
+        path = self.obj.vox_empty.sidecar_path
+        sidecar = self.get_sidecar()
+        if sidecar is not None and grid.source is sidecar:
+            changed = [(key, chunk.count, chunk.encoded())
+                       for key, chunk in sorted(grid.chunks.items())
+                       if chunk.count and not chunk.is_encoded()]
+            removed = [key for key in sidecar.entries
+                       if key not in grid.chunks and key not in grid._lazy]
+            removed.extend(key for key, chunk in grid.chunks.items()
+                           if chunk.count == 0)
+            if changed or removed:
+                sidecar.update(changed, removed)
+        elif path:
+            #a new sidecar, or one the grid didn't come from
+            chunks = list(grid.encoded_chunks())
+            if sidecar is not None:
+                sidecar.close()
+            path = os.path.normpath(bpy.path.abspath(path))
+            sidecar = VoxelSidecar.create(path, chunks)
+            _voxel_sidecars[path] = sidecar
+            grid.source = sidecar
+        else:
+            data = encode_grid(list(grid.encoded_chunks()))
+            self.obj["vox_grid"] = data
+            grid.source = GridBlobSource(data)
+        if path:
+            #so a sidecar which goes missing isn't taken for an empty one
+            self.obj["vox_sidecar_count"] = len(grid)
+        old_props = ("vox_chunks",) + (("vox_grid",) if path else
+                                       ("vox_sidecar_count",))
+        for prop in old_props:
+            if prop in self.obj:
+                del self.obj[prop]
+        _voxel_unsaved.discard(self.obj.name)
 
     def draw_type(self):
         return self.obj.vox_empty.voxel_draw_type
@@ -392,10 +3970,33 @@ class VoxelArray(object):
         return self.obj.matrix_world * pos
 
     def new_vox(self, pos):
+        """add a voxel at the local position, returns the new Voxel, or None
+        if the array is displayed by chunk"""
         #TODO: need to add check for replacing existing voxel
         #pos_local = self.obj.matrix_world * pos
-        bpy.ops.mesh.primitive_cube_add()
-        vox = Voxel(get_active(self.context), self.context, creating=True)
+        coord = pos_to_coord(pos)
+        self.grid.set(coord)
+        if self.display_chunks():
+            self.update_display(REMESH_BUDGET)
+            return None
+
+        vox = self.new_vox_obj(coord)
+        self.grid.clean_chunk(chunk_key(coord))
+        return vox
+
+    def new_vox_obj(self, coord):
+        """create the cube object displaying the voxel at coord"""
+        pos = coord_to_pos(coord)
+        if self.obj.vox_empty.share_mesh:
+            #link the shared cube mesh to a new object through bpy.data,
+            #rather than having the operator create a new mesh every time
+            obj = bpy.data.objects.new(Voxel.gen_get_name(pos),
+                                       get_voxel_cube_mesh())
+            self.context.scene.objects.link(obj)
+            vox = Voxel(obj, self.context)
+        else:
+            bpy.ops.mesh.primitive_cube_add()
+            vox = Voxel(get_active(self.context), self.context, creating=True)
         vox.obj.location = pos
         #vox.obj.scale = self.obj.scale
         #svox.obj.rotation_euler = self.obj.rotation_euler
@@ -405,45 +4006,88 @@ class VoxelArray(object):
         vox.obj.parent = self.obj
         vox.gen_set_name(pos)
         vox.set_draw_type(self.draw_type())
+        self.index[tuple(coord)] = vox.obj
         return vox
 
+    def del_vox(self, voxel):
+        """delete a voxel object and remove it from the grid"""
+        coord = pos_to_coord(voxel.get_local_location())
+        self.grid.remove(coord)
+        self.grid.clean_chunk(chunk_key(coord))
+        self.index.pop(coord, None)
+        voxel.delete()
+
     def del_vox_pos(self, pos):
         #TODO: delete or rethink this function and if it's needed
-        vox = self.get_vox(pos)
+        coord = pos_to_coord(pos)
+        if self.display_chunks():
+            if not self.grid.remove(coord):
+                return False
+            self.update_display(REMESH_BUDGET)
+            return True
+
+        vox = self.get_vox_coord(coord)
         if vox is not None:
-            override = {'selected_bases':[vox.obj]}
-            bpy.ops.delete(override)
+            self.del_vox(vox)
             return True
         else:
             return False
 
     def voxels(self):
-        for c in self.obj.children:
+        for c in self.voxel_objects():
             yield Voxel(c, self.context)
 
 
     def get_vox_pos(self, pos):
-        key_str = Voxel.gen_get_name(pos)
+        return self.get_vox_coord(pos_to_coord(pos))
 
-        for c in self.obj.children:
-            if(c.name == key_str):
-                return Voxel(c, self.context)
+    def get_vox_coord(self, coord):
+        """return the Voxel at the integer grid coordinate, or None"""
+        obj = self.index.get(tuple(coord))
+        if obj is None:
+            return None
 
-        return None
+        #the object may have been deleted or moved by the user outside of
+        #the voxel editor, in which case the index is out of date.
+        try:
+            valid = (obj.parent == self.obj and
+                     pos_to_coord(obj.location) == tuple(coord))
+        except ReferenceError:
+            valid = False
+        if not valid:
+            self.rebuild_index()
+            self.grid = _voxel_grids[self.obj.name]
+            self.index = _voxel_indices[self.obj.name]
+            obj = self.index.get(tuple(coord))
+            if obj is None:
+                return None
+
+        return Voxel(obj, self.context)
+
+    def has_vox(self, coord):
+        """constant time occupancy test for an integer grid coordinate"""
+        return tuple(coord) in self.grid
 
     def intersect_ray(self, ray_origin, ray_target):
-        """return list of voxel ray intersection instances
-        [VoxelRayIntersection, ...]"""
-        isects = []
-        for voxel in self.voxels():
-            isect = voxel.ray_cast(ray_origin, ray_target)
-            if isect is not None:
-                isects.append(isect)
-
-        if len(isects) == 0:
+        """return the VoxelRayIntersection for the first voxel hit by the
+        ray between the two global positions, or None. The ray is moved
+        into grid space once, and walked through the grid cell by cell."""
+        origin_local = self.global_to_local(ray_origin)
+        target_local = self.global_to_local(ray_target)
+        origin = [c / VOXEL_SIZE + 0.5 for c in origin_local]
+        direction = [(t - o) / VOXEL_SIZE
+                     for t, o in zip(target_local, origin_local)]
+
+        hit = grid_raycast(self.grid, origin, direction, 1.0)
+        if hit is None:
             return None
-        else:
-            return isects
+
+        coord, normal, t = hit
+        loc = origin_local + (target_local - origin_local) * t
+        dist_squared = ((ray_target - ray_origin) * t).length_squared
+        voxel = self.get_vox_coord(coord)
+        return VoxelRayIntersection(voxel, loc, Vector(normal),
+                                    dist_squared, coord)
 
     def get_intersect_obj(self):
         isect_obj_name = self.obj.vox_empty.intersect_obj
@@ -456,26 +4100,531 @@ class VoxelArray(object):
         isect_obj = self.context.scene.objects[isect_obj_name]
         return isect_obj
 
+    def voxelize(self, obj, solid=True):
+        """fill the array with the cells of the mesh object, see
+        voxelize_mesh. The whole mesh goes into the grid with one
+        set_many, unless it has more than STREAM_BATCH polygons, when it
+        is streamed through voxelize_batches instead.
+        returns the number of cells of the mesh"""
+        matrix = self.obj.matrix_world.inverted() * obj.matrix_world
+        if len(obj.data.polygons) > STREAM_BATCH:
+            return self.voxelize_batches(mesh_object_triangle_batches(
+                obj, matrix, self.context.scene, STREAM_BATCH), solid)
+
+        tris = mesh_object_triangles(obj, matrix, self.context.scene)
+        coords = voxelize_mesh(tris, VOXEL_SIZE, solid)
+        new = []
+        if not self.display_chunks():
+            new = [c for c in coords.tolist() if tuple(c) not in self.grid]
+        self.grid.set_many(coords)
+        self.show_new_cells(new)
+        return len(coords)
+
+    def voxelize_file(self, path, solid=True):
+        """voxelize_batches for a binary STL or PLY file, which is taken to
+        be in world space"""
+        matrix = matrix_array(self.obj.matrix_world.inverted())
+        batches = (np.dot(tris, matrix[:3, :3].T) + matrix[:3, 3]
+                   for tris in read_mesh_file_batches(path))
+        return self.voxelize_batches(batches, solid)
+
+    def voxelize_batches(self, batches, solid=True):
+        """fill the array with the cells of triangles which come in batches,
+        see voxelize_stream. The cells are gathered in a ChunkSpill in a
+        temporary directory, and go into the grid a chunk at a time.
+        When the array is displayed by chunk and kept in a sidecar, every
+        SPILL_RESIDENT_CHUNKS chunks are meshed, written to the sidecar and
+        unloaded again, and the edit isn't journaled, so the memory used
+        doesn't grow with the size of the mesh. Such an edit can't be
+        undone. Otherwise the whole grid is in memory in the end anyway.
+        returns the number of cells of the mesh"""
+        stream = (self.display_chunks() and
+                  bool(self.obj.vox_empty.sidecar_path))
+        self.streamed = stream
+        journal = self.grid.journal
+        if stream:
+            #the sidecar has to hold the grid for chunks to be unloaded
+            self.save_grid()
+            self.grid.journal = None
+        work_dir = tempfile.mkdtemp(prefix="voxel_painter_")
+        n_cells = 0
+        new = []
+        try:
+            spill = ChunkSpill(os.path.join(work_dir, "chunks"))
+            voxelize_stream(batches, VOXEL_SIZE, spill, work_dir, solid)
+            for i, (key, values) in enumerate(spill.items()):
+                n_cells += int(np.count_nonzero(values))
+                chunk = self.grid.get_chunk(key)
+                old = np.zeros_like(values) if chunk is None else chunk.values
+                if not self.display_chunks():
+                    added = np.argwhere((values != 0) & (old == 0))
+                    new.extend((added + np.array(key) * CHUNK_SIZE).tolist())
+                self.grid.set_chunk_values(key, np.where(values != 0, values,
+                                                         old))
+                if stream and (i + 1) % SPILL_RESIDENT_CHUNKS == 0:
+                    self.flush_stream()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            if stream:
+                self.grid.journal = journal
+                self.obj["vox_journal_step"] = journal.reset()
+        if stream:
+            self.flush_stream()
+        else:
+            self.show_new_cells(new)
+        return n_cells
+
+    def flush_stream(self):
+        """mesh and save the chunks voxelize_batches has written so far,
+        and unload every chunk which the sidecar now holds"""
+        self.update_display()
+        self.save_grid()
+        for key in list(self.grid.chunks):
+            self.grid.unload(key)
+
+    def import_voxels(self, path):
+        """add the voxels of a .vox or .binvox file to the array, see
+        read_voxel_file_batches, returns the number of voxels read"""
+        n_cells = 0
+        new = []
+        for coords, values in read_voxel_file_batches(path):
+            if not self.display_chunks():
+                new.extend(c for c in coords.tolist()
+                           if tuple(c) not in self.grid)
+            self.grid.set_many(coords, values)
+            n_cells += len(coords)
+        self.show_new_cells(new)
+        return n_cells
+
+    def export_voxels(self, path):
+        """write the voxels of the array to a .vox or .binvox file, by the
+        file extension"""
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".vox":
+            write_vox(path, self.grid)
+        elif ext == ".binvox":
+            write_binvox(path, self.grid, VOXEL_SIZE)
+        else:
+            raise ValueError("can't write voxels to {0} files".format(ext))
+
+    def add_cells(self, coords, value=1):
+        """add an (n, 3) array of cells in one batch, with one update of the
+        display, see VoxelGrid.set_many"""
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        new = []
+        if not self.display_chunks():
+            new = [c for c in coords.tolist() if tuple(c) not in self.grid]
+        self.grid.set_many(coords, value)
+        self.show_new_cells(new, REMESH_BUDGET)
+
+    def remove_cells(self, coords):
+        """remove an (n, 3) array of cells in one batch, with one update of
+        the display, see VoxelGrid.remove_many"""
+        coords = np.asarray(coords, dtype=np.int64).reshape(-1, 3)
+        if not self.display_chunks():
+            for coord in coords.tolist():
+                vox = self.get_vox_coord(coord)
+                if vox is not None:
+                    self.index.pop(tuple(coord), None)
+                    vox.delete()
+        self.grid.remove_many(coords)
+        self.show_new_cells([], REMESH_BUDGET)
+
+    def apply_brush(self, centres, shape, radius, value=1):
+        """fill the empty cells inside the brush_mask around each of
+        centres, a list of (cell, axis of the cylinder), with value, or
+        remove the cells if value is 0, with one update of the display.
+        When the array is displayed by chunk each brush is one
+        VoxelGrid.fill_mask"""
+        masks = {}
+        if self.display_chunks():
+            for centre, axis in centres:
+                if axis not in masks:
+                    masks[axis] = brush_mask(shape, radius, axis)
+                self.grid.fill_mask(np.array(centre) - radius, masks[axis],
+                                    value)
+            self.update_display(REMESH_BUDGET)
+            return
+
+        #voxel objects have to be made or deleted one by one anyway
+        cells = []
+        for centre, axis in centres:
+            if axis not in masks:
+                masks[axis] = np.argwhere(brush_mask(shape, radius, axis))
+            cells.append(masks[axis] + (np.array(centre) - radius))
+        cells = unique_cells(np.concatenate(cells))
+        if value:
+            #keep the values of the voxels which are there already
+            empty = [tuple(c) not in self.grid for c in cells.tolist()]
+            self.add_cells(cells[np.array(empty, dtype=bool)], value)
+        else:
+            self.remove_cells(cells)
+
+    def apply_chunk_masks(self, masks, value=1):
+        """set the cells of a dict of chunk key -> boolean mask, like the
+        ones the region operations return, or remove them if value is 0,
+        see VoxelGrid.fill_chunk_masks"""
+        if self.display_chunks():
+            self.grid.fill_chunk_masks(masks, value)
+            self.update_display(REMESH_BUDGET)
+            return
+        cells = [np.argwhere(mask) + np.array(key) * CHUNK_SIZE
+                 for key, mask in masks.items()]
+        if not cells:
+            return
+        if value:
+            self.add_cells(np.concatenate(cells), value)
+        else:
+            self.remove_cells(np.concatenate(cells))
+
+    def apply_boolean(self, other, operation):
+        """combine the voxels with the ones of other, a VoxelGrid, cell for
+        cell, see boolean_cells. A union takes the values of the cells it
+        adds from other. Returns the number of cells changed"""
+        masks = boolean_cells(self.grid, other, operation)
+        if operation != 'UNION':
+            self.apply_chunk_masks(masks, 0)
+            return sum(int(np.count_nonzero(m)) for m in masks.values())
+        coords = []
+        values = []
+        for key, mask in masks.items():
+            coords.append(np.argwhere(mask) + np.array(key) * CHUNK_SIZE)
+            values.append(other.get_chunk(key).values[mask])
+        if coords:
+            self.add_cells(np.concatenate(coords), np.concatenate(values))
+        return sum(len(c) for c in coords)
+
+    def show_new_cells(self, new, budget=None):
+        """bring the display up to date after a bulk edit of the grid, new
+        being the cells which need a voxel object when there is one per
+        voxel, budget is as for update_display"""
+        if self.display_chunks():
+            self.update_display(budget)
+            return
+        for coord in new:
+            self.new_vox_obj(coord)
+        for key in self.grid.dirty_chunks():
+            self.grid.clean_chunk(key)
+
     def intersect_mesh(self, obj, progress_callback):
-        n_voxels = len(self)
-        i = 0
-        for voxel in self.voxels():
-            isect_mesh = voxel.get_isect_mesh()
-            if isect_mesh is not None:
-                isect_mesh.delete()
-            voxel.intersect_mesh(obj)
-            print("Intersecting: {0}/{1}".format(i, n_voxels))
-            i += 1
-            progress_callback(int((float(i)/float(n_voxels))*100.0))
+        """run intersect_mesh_job to the end, progress_callback is called
+        with the percentage done"""
+        for done, total in self.intersect_mesh_job(obj):
+            progress_callback(int((float(done)/float(max(total, 1)))*100.0))
+
+    def intersect_mesh_job(self, obj):
+        """intersect every voxel with the mesh object, see intersect_box.
+        The triangles of the mesh are moved into the local space of the
+        array once, and binned into the voxels by bin_triangles. Only the
+        boundary voxels, which have triangles in them, are clipped. The
+        rest are classified in one batch as entirely inside, and get a
+        whole cube, or entirely outside, and get nothing.
+
+        Re-intersecting is incremental. Every voxel gets a key, the
+        isect_key of its triangles, or its classification when it has
+        none, and only the voxels whose key has changed are redone. When
+        the hash of all the triangles is the same as last time, only the
+        chunks edited since then are looked at, so re-intersecting after
+        a small edit costs little more than reading the mesh.
+
+        This is a generator which does the work in small steps, yielding
+        (voxels done, voxels to do) after each one, so it can be driven
+        from a modal operator. Closing it early keeps the voxels which
+        are finished, and the next run picks up the rest."""
+        matrix = self.obj.matrix_world.inverted() * obj.matrix_world
+        tris = mesh_object_triangles(obj, matrix, self.context.scene)
+        target_hash = hashlib.sha1(tris.tobytes()).hexdigest()
+
+        props = self.obj.vox_empty
+        saved = self.obj.get("vox_isect_keys")
+        if not props.intersected or saved is None:
+            self.delete_intersection(obj)
+            keys = self.grid.chunk_keys()
+        elif props.isect_hash != target_hash:
+            keys = self.grid.chunk_keys()
+            keys.update(chunk_name_key(name) for name in saved.keys())
+        else:
+            keys = self.grid.edited_since(props.isect_generation)
+            #chunks which were emptied before the grid was last rebuilt
+            #aren't in it to be found edited
+            saved_keys = set(chunk_name_key(name) for name in saved.keys())
+            keys.update(saved_keys - self.grid.chunk_keys())
+
+        old_keys = {}
+        parts = []
+        for key in keys:
+            old_keys.update(self.load_isect_keys(key))
+            chunk = self.grid.get_chunk(key)
+            if chunk is not None and chunk.count:
+                parts.append(chunk.coords())
+        if parts:
+            coords = np.concatenate(parts)
+        else:
+            coords = np.empty((0, 3), dtype=np.int32)
+
+        bins = bin_triangles(tris, coords, VOXEL_SIZE)
+        interior = np.array([tuple(c) not in bins for c in coords.tolist()],
+                            dtype=bool)
+        inside = np.zeros(len(coords), dtype=bool)
+        inside[interior] = classify_voxels(coords[interior], tris, VOXEL_SIZE)
+
+        new_keys = {}
+        for coord, is_inside in zip(coords.tolist(), inside.tolist()):
+            coord = tuple(coord)
+            indices = bins.get(coord)
+            if indices is not None:
+                new_keys[coord] = isect_key(tris[indices])
+            elif is_inside:
+                new_keys[coord] = ISECT_KEY_INSIDE
+            else:
+                new_keys[coord] = ISECT_KEY_OUTSIDE
+        changed = [c for c, k in new_keys.items() if old_keys.get(c) != k]
+        for coord in old_keys:
+            if coord not in new_keys:
+                self.set_isect(coord, None)
+
+        #the old intersection of a changed voxel stays until its new one
+        #is written, and its key is only replaced once it is finished
+        finished = set()
+        cache = None
+        if props.use_isect_cache:
+            cache = get_isect_cache()
+        parallel = None
+        try:
+            self.flush_isect()
+            yield 0, len(changed)
+            cube_verts, cube_faces = voxel_cube_geometry()
+            cube = (cube_verts, np.full(len(cube_faces), 4, dtype=np.int32),
+                    cube_faces.ravel())
+            tasks = {}
+            for i, coord in enumerate(changed):
+                if i and i % ISECT_STEP_VOXELS == 0:
+                    self.flush_isect()
+                    yield len(finished), len(changed)
+                if coord in bins:
+                    if cache is not None:
+                        hit = cache.get(cache.key(target_hash, VOXEL_SIZE,
+                                                  coord))
+                        if hit is not None:
+                            self.set_isect(coord, hit)
+                            finished.add(coord)
+                            continue
+                    #the boundary voxels are clipped a chunk at a time,
+                    #possibly spread over several processes
+                    tasks.setdefault(chunk_key(coord), []).append(
+                        (coord, bins[coord]))
+                elif new_keys[coord] == ISECT_KEY_INSIDE:
+                    self.set_isect(coord, cube)
+                    finished.add(coord)
+                else:
+                    self.set_isect(coord, None)
+                    finished.add(coord)
+
+            self.flush_isect()
+            yield len(finished), len(changed)
+            parallel = intersect_voxels_parallel(
+                tris, list(tasks.items()), VOXEL_SIZE,
+                self.intersect_processes())
+            for key, n_done, results in parallel:
+                voxels = dict(tasks[key])
+                for coord, verts, loop_totals, loop_indices in results:
+                    self.set_isect(coord, (verts, loop_totals, loop_indices))
+                    if cache is not None:
+                        cache.put(cache.key(target_hash, VOXEL_SIZE, coord),
+                                  verts, loop_totals, loop_indices)
+                    del voxels[coord]
+                empty = np.empty(0, dtype=np.int32)
+                for coord in voxels:
+                    self.set_isect(coord, None)
+                    if cache is not None:
+                        #the voxels which came back empty are worth caching
+                        cache.put(cache.key(target_hash, VOXEL_SIZE, coord),
+                                  empty, empty, empty)
+                finished.update(coord for coord, indices in tasks[key])
+                self.flush_isect()
+                yield len(finished), len(changed)
+        finally:
+            if parallel is not None:
+                parallel.close()
+            self.flush_isect()
+
+            by_chunk = dict((key, {}) for key in keys)
+            for coord, k in new_keys.items():
+                if coord in finished or old_keys.get(coord) == k:
+                    by_chunk[chunk_key(coord)][coord] = k
+                elif coord in old_keys:
+                    by_chunk[chunk_key(coord)][coord] = old_keys[coord]
+            for key, chunk_keys in by_chunk.items():
+                self.save_isect_keys(key, chunk_keys)
+
+            props.intersected = True
+            if len(finished) == len(changed):
+                props.isect_hash = target_hash
+                props.isect_generation = self.grid.generation
+            else:
+                #make the next run compare the keys of every voxel, to
+                #find the ones which weren't finished
+                props.isect_hash = ""
+
+    def isect_chunks(self):
+        return self.obj.vox_empty.isect_output == 'CHUNKS'
+
+    def set_isect(self, coord, buffers):
+        """replace the intersection of the voxel at coord with the mesh
+        buffers (verts, loop_totals, loop_indices) intersect_voxels returns,
+        verts being relative to the centre of the voxel. None or empty
+        buffers leave the voxel without a mesh. When the output is merged
+        by chunk, the change waits in isect_staged until flush_isect."""
+        coord = tuple(coord)
+        if self.isect_chunks():
+            self.isect_staged.setdefault(chunk_key(coord), {})[coord] = buffers
+            return
+        self.delete_isect_coord(coord)
+        if buffers is None or len(buffers[1]) == 0:
+            return
+        verts, loop_totals, loop_indices = buffers
+        faces = np.split(loop_indices, np.cumsum(loop_totals)[:-1])
+        self.write_isect_mesh(coord, verts, faces)
+
+    def flush_isect(self):
+        """write the changes set_isect has staged into the chunk meshes"""
+        for key, staged in self.isect_staged.items():
+            self.update_isect_chunk(key, staged)
+        self.isect_staged.clear()
+
+    def update_isect_chunk(self, key, staged):
+        """rebuild the merged intersection mesh of a chunk, with the pieces
+        of the voxels in staged replaced. The voxel each face belongs to is
+        kept in the vox_index face layer, as the index of the voxel in the
+        chunk, so the pieces can be picked apart again"""
+        name = IntersectionMesh.gen_get_chunk_name(self.obj.name, key)
+        isect_obj = bpy.data.objects.get(name)
+        pieces = {}
+        if isect_obj is not None and "vox_index" in \
+                isect_obj.data.polygon_layers_int:
+            mesh = isect_obj.data
+            face_ids = np.empty(len(mesh.polygons), dtype=np.int32)
+            mesh.polygon_layers_int["vox_index"].data.foreach_get("value",
+                                                                  face_ids)
+            pieces = split_pieces(*(read_mesh_data(mesh) + (face_ids,)))
+
+        origin = np.array(key) * CHUNK_SIZE
+        for coord, buffers in staged.items():
+            local = np.array(coord) - origin
+            index = int(np.ravel_multi_index(local, (CHUNK_SIZE,) * 3))
+            pieces.pop(index, None)
+            if buffers is not None and len(buffers[1]):
+                verts, loop_totals, loop_indices = buffers
+                pieces[index] = (verts + local * VOXEL_SIZE, loop_totals,
+                                 loop_indices)
+        if not pieces:
+            if isect_obj is not None:
+                remove_object(self.context, isect_obj)
+            return
 
-        self.obj.vox_empty.intersected = True
+        verts, loop_totals, loop_indices, face_ids = merge_pieces(pieces)
+        mesh = bpy.data.meshes.new(name)
+        faces = np.split(loop_indices, np.cumsum(loop_totals)[:-1])
+        write_mesh_data(mesh, verts, faces)
+        layer = mesh.polygon_layers_int.new("vox_index")
+        layer.data.foreach_set("value", face_ids)
+        if isect_obj is None:
+            isect_obj = bpy.data.objects.new(name, mesh)
+            isect_obj["vox_isect_chunk"] = key
+            self.context.scene.objects.link(isect_obj)
+            isect_obj.parent = self.obj
+            #the origin of the object is the centre of the first voxel
+            isect_obj.location = coord_to_pos(origin)
+            isect_obj.draw_type = 'TEXTURED'
+        else:
+            old_mesh = isect_obj.data
+            isect_obj.data = mesh
+            bpy.data.meshes.remove(old_mesh)
+
+    def load_isect_keys(self, key):
+        """return the intersection keys saved for the voxels in a chunk, as a
+        dict from the coordinate tuple to the key"""
+        data = self.obj.get("vox_isect_keys", {}).get(chunk_name(key))
+        if data is None:
+            return {}
+        records = np.frombuffer(bytes(data), dtype=ISECT_KEY_DTYPE)
+        local = np.unravel_index(records["index"], (CHUNK_SIZE,) * 3)
+        coords = np.stack(local, axis=1) + np.array(key) * CHUNK_SIZE
+        return dict(zip(map(tuple, coords.tolist()), records["key"].tolist()))
+
+    def save_isect_keys(self, key, keys):
+        """store the intersection keys of the voxels in a chunk in the
+        vox_isect_keys ID property"""
+        if "vox_isect_keys" not in self.obj:
+            self.obj["vox_isect_keys"] = {}
+        saved = self.obj["vox_isect_keys"]
+        name = chunk_name(key)
+        if not keys:
+            if name in saved:
+                del saved[name]
+            return
+        local = np.array(list(keys.keys())) - np.array(key) * CHUNK_SIZE
+        records = np.empty(len(keys), dtype=ISECT_KEY_DTYPE)
+        records["index"] = np.ravel_multi_index(local.T, (CHUNK_SIZE,) * 3)
+        records["key"] = list(keys.values())
+        saved[name] = records.tobytes()
+
+    def intersect_processes(self):
+        """number of processes to intersect with, 0 means one per cpu"""
+        processes = self.obj.vox_empty.intersect_processes
+        if processes == 0:
+            processes = os.cpu_count() or 1
+        return processes
+
+    def write_isect_mesh(self, coord, verts, faces):
+        """create the intersection mesh object for the voxel at coord, verts
+        are relative to the centre of the voxel"""
+        pos = coord_to_pos(coord)
+        voxel = None
+        if not self.display_chunks():
+            voxel = self.get_vox_coord(coord)
+        if voxel is not None:
+            parent = voxel.obj
+            name = voxel.obj.name + "_isect"
+        else:
+            parent = self.obj
+            name = Voxel.gen_get_name(pos) + "_isect"
+
+        mesh = bpy.data.meshes.new(name)
+        write_mesh_data(mesh, verts, faces)
+        isect_obj = bpy.data.objects.new(name, mesh)
+        isect_obj["vox_isect"] = coord
+        self.context.scene.objects.link(isect_obj)
+        isect_obj.parent = parent
+        if voxel is None:
+            isect_obj.location = pos
+        isect_obj.draw_type = 'TEXTURED'
+        return IntersectionMesh(isect_obj, self.context)
+
+    def find_isect_obj(self, coord):
+        """return the intersection mesh object of the voxel at coord, or
+        None. It has the same name whether it is parented to the voxel
+        object or to the empty"""
+        name = Voxel.gen_get_name(coord_to_pos(coord)) + "_isect"
+        isect_obj = bpy.data.objects.get(name)
+        if isect_obj is None or "vox_isect" not in isect_obj:
+            return None
+        if tuple(isect_obj["vox_isect"]) != tuple(coord):
+            return None
+        return isect_obj
+
+    def delete_isect_coord(self, coord):
+        isect_obj = self.find_isect_obj(coord)
+        if isect_obj is not None:
+            remove_object(self.context, isect_obj)
 
     def delete_intersection(self, obj):
-        for voxel in self.voxels():
-            isect_mesh = voxel.get_isect_mesh()
-            if isect_mesh is not None:
-                isect_mesh.delete()
+        for isect_obj in list(self.isect_objects()):
+            remove_object(self.context, isect_obj)
 
+        if "vox_isect_keys" in self.obj:
+            del self.obj["vox_isect_keys"]
+        self.obj.vox_empty.isect_hash = ""
         self.obj.vox_empty.intersected = False
 
     def __getitem__(self, index):
@@ -489,13 +4638,41 @@ class VoxelArray(object):
         return str(self.obj)
 
     def __len__(self):
-        return len(self.obj.children)
+        return len(self.grid)
 
 def voxelarray_apply_draw_type(drawtype_prop, context):
     obj = context.object
     va = VoxelArray(obj, context)
     va.apply_draw_type()
 
+def voxelarray_apply_display_mode(displaymode_prop, context):
+    obj = context.object
+    va = VoxelArray(obj, context)
+    va.apply_display_mode()
+
+def voxelarray_apply_isect_output(isectoutput_prop, context):
+    obj = context.object
+    va = VoxelArray(obj, context)
+    #the intersection is rebuilt in the new form by the next intersect
+    if va.is_intersected():
+        va.delete_intersection(None)
+
+def voxelarray_apply_sidecar_path(sidecarpath_prop, context):
+    obj = context.object
+    va = VoxelArray(obj, context)
+    if va.grid.load_error is not None:
+        #try loading the voxels from the new path instead
+        del _voxel_grids[obj.name]
+        VoxelArray(obj, context)
+    elif va.display_chunks():
+        #move the grid into the new sidecar, or back into the blend file
+        va.save_grid()
+
+def voxelarray_apply_share_mesh(sharemesh_prop, context):
+    obj = context.object
+    va = VoxelArray(obj, context)
+    va.apply_share_mesh()
+
 class VoxelEmpty_props(bpy.types.PropertyGroup):
     """This class stores all the overall properties for the voxel array"""
     intersect_obj = StringProperty(name="Intersect Obj",
@@ -526,6 +4703,102 @@ class VoxelEmpty_props(bpy.types.PropertyGroup):
         update=voxelarray_apply_draw_type,
         default='TEXTURED')
 
+    display_mode = EnumProperty(
+        items=[
+        ('OBJECTS', 'Objects', 'one cube object per voxel'),
+        ('CHUNKS', 'Chunks', 'one greedy meshed object per chunk of voxels')],
+        name="Display Mode",
+        description="How the voxels in this VoxelArray are displayed",
+        update=voxelarray_apply_display_mode,
+        default='OBJECTS')
+
+    isect_output = EnumProperty(
+        items=[
+        ('VOXELS', 'Voxels', 'one intersection object per voxel'),
+        ('CHUNKS', 'Chunks', 'one merged intersection mesh per chunk, with '
+                             'the voxel of each face in the vox_index face '
+                             'layer')],
+        name="Intersection Output",
+        description="How the intersection with the object is output",
+        update=voxelarray_apply_isect_output,
+        default='VOXELS')
+
+    use_isect_cache = BoolProperty(
+        name="Cache Intersection",
+        description="Keep the intersection of the boundary voxels in an on "
+                    "disk cache, and reuse it when intersecting the same "
+                    "object again",
+        default=True)
+
+    isect_hash = StringProperty(
+        name="Intersection Hash",
+        description="Hash of the triangles of the object the array was last "
+                    "intersected with")
+
+    isect_generation = IntProperty(
+        name="Intersection Generation",
+        description="Generation of the voxel grid when the array was last "
+                    "intersected",
+        default=0)
+
+    intersect_processes = IntProperty(
+        name="Intersect Processes",
+        description="Number of processes to intersect the voxels with the "
+                    "object in, 0 uses one per cpu",
+        min=0,
+        default=0)
+
+    sidecar_path = StringProperty(
+        name="Sidecar File",
+        description="File to keep the voxels in when they are displayed by "
+                    "chunk, instead of the blend file. It is memory mapped, "
+                    "so only the chunks which are used get read, which "
+                    "keeps opening big arrays quick",
+        subtype='FILE_PATH',
+        update=voxelarray_apply_sidecar_path,
+        default="")
+
+    brush_shape = EnumProperty(
+        items=[
+        ('VOXEL', 'Voxel', 'one voxel at a time'),
+        ('SPHERE', 'Sphere', 'every voxel within the radius'),
+        ('BOX', 'Box', 'a cube of voxels, twice the radius across'),
+        ('CYLINDER', 'Cylinder', 'a cylinder standing on the face which '
+                                 'is painted on')],
+        name="Brush",
+        description="Shape of the voxels added or deleted by the voxel "
+                    "editor around the cell under the mouse",
+        default='VOXEL')
+
+    brush_radius = IntProperty(
+        name="Brush Radius",
+        description="Radius of the brush in voxels",
+        min=1,
+        soft_max=64,
+        default=4)
+
+    fill_connectivity = EnumProperty(
+        items=[
+        ('6', '6', 'cells connect through their faces'),
+        ('26', '26', 'cells connect through their faces, edges and '
+                     'corners')],
+        name="Fill Connectivity",
+        description="Which neighbouring cells a fill spreads to, through a "
+                    "diagonal gap in a wall too with 26",
+        default='6')
+
+    boolean_array = StringProperty(
+        name="Boolean Array",
+        description="Voxel array to combine the voxels of this one with, "
+                    "cell for cell")
+
+    share_mesh = BoolProperty(
+        name="Share Voxel Mesh",
+        description="Link all the voxel objects to one cube mesh, instead of "
+                    "giving every voxel a copy of its own",
+        update=voxelarray_apply_share_mesh,
+        default=False)
+
 class VoxelEmpty_obj_prop(bpy.types.Panel):
     """This class is the panel that goes with the empty representing, and storing
     all the data for the voxel array"""
@@ -564,6 +4837,9 @@ class VoxelEmpty_obj_prop(bpy.types.Panel):
             row = layout.row()
             nvoxels = len(va)
             row.label(text="Voxels:{0}".format(nvoxels))
+        if va.grid.load_error is not None:
+            row = layout.row()
+            row.label(text=va.grid.load_error, icon='ERROR')
 
         row = layout.row()
         row.operator('object.voxelarray_select_children', text="Select Children")
@@ -572,6 +4848,29 @@ class VoxelEmpty_obj_prop(bpy.types.Panel):
         row = layout.row()
         p = context.object.vox_empty
         row.prop(p, "voxel_draw_type")
+        row = layout.row()
+        row.prop(p, "display_mode")
+        if not va.display_chunks():
+            row.prop(p, "share_mesh")
+        else:
+            row = layout.row()
+            row.prop(p, "sidecar_path")
+        row = layout.row()
+        row.prop(p, "brush_shape")
+        if p.brush_shape != 'VOXEL':
+            row.prop(p, "brush_radius")
+        row = layout.row()
+        row.operator("object.voxelarray_fill_cavities", text="Fill Cavities")
+        row.operator("object.voxelarray_hollow", text="Hollow")
+        row.prop(p, "fill_connectivity")
+        row = layout.row()
+        row.prop_search(p, "boolean_array", context.scene, "objects",
+                        icon='OBJECT_DATA', text="")
+        for operation, text in (('UNION', "Union"),
+                                ('DIFFERENCE', "Difference"),
+                                ('INTERSECT', "Intersect")):
+            op = row.operator("object.voxelarray_boolean", text=text)
+            op.operation = operation
 
 
         # -- VoxelArray -> Mesh intersection ---
@@ -600,6 +4899,14 @@ class VoxelEmpty_obj_prop(bpy.types.Panel):
 
         if va.is_intersected():
             row.operator("object.voxelarray_delete_intersection", text="Delete Intersection")
+        row = layout.row()
+        if(valid_isect_obj):
+            row.operator("object.voxelarray_voxelize", text="Voxelize Object")
+        row.operator("object.voxelarray_voxelize_file", text="Voxelize File")
+        row = layout.row()
+        row.operator("object.voxelarray_import_voxels", text="Import Voxels")
+        row.operator("object.voxelarray_export_vox", text="Export .vox")
+        row.operator("object.voxelarray_export_binvox", text="Export .binvox")
 
         row = layout.row()
         row.prop_search(context.object.vox_empty, "intersect_obj",
@@ -609,6 +4916,12 @@ class VoxelEmpty_obj_prop(bpy.types.Panel):
                         #search_data=context.scene.objects,
                         #search_property="name")
 
+        row = layout.row()
+        row.prop(p, "isect_output")
+        row = layout.row()
+        row.prop(p, "intersect_processes")
+        row.prop(p, "use_isect_cache")
+
 
 class VoxelMesh_obj_prop(bpy.types.Panel):
     """This class is the panel that goes with objects which represent the individual
@@ -706,13 +5019,19 @@ class VoxelArraySelectChildrenIsect(Operator):
         return VoxelArray.poll_voxelarray_empty(context.active_object)
 
 class VoxelArrayIntersectMeshOp(Operator):
-    """Operator to intersect between mesh object and the voxel array"""
+    """Operator to intersect between mesh object and the voxel array.
+    Invoked from the UI it runs as a modal job, doing ISECT_TICK_BUDGET
+    seconds of VoxelArray.intersect_mesh_job every timer tick, with the
+    progress and time left in the header. ESC stops it, keeping the
+    voxels which are finished, and running it again does the rest."""
     bl_idname = "object.voxelarray_intersect_mesh"
     bl_label = "Intersect Voxels Mesh"
     bl_options = {'UNDO'}
     _timer = None
+    _job = None
 
     def execute(self, context):
+        """run the whole intersection in one go, for scripts"""
         wm = bpy.context.window_manager
         wm.progress_begin(0, 100)
 
@@ -720,7 +5039,7 @@ class VoxelArrayIntersectMeshOp(Operator):
         obj = context.object
         va = VoxelArray(obj, context)
         isect_obj = va.get_intersect_obj()
-        print("Intersecting:" + isect_obj.name)
+        self.report({'INFO'}, "Intersecting with {0}".format(isect_obj.name))
         va.intersect_mesh(isect_obj, self.progress_callback)
         sb.restore()
 
@@ -730,13 +5049,337 @@ class VoxelArrayIntersectMeshOp(Operator):
     def progress_callback(self, value):
         bpy.context.window_manager.progress_update(value)
 
+    def invoke(self, context, event):
+        va = VoxelArray(context.object, context)
+        isect_obj = va.get_intersect_obj()
+        if isect_obj is None:
+            self.report({'WARNING'}, "No object to intersect with")
+            return {'CANCELLED'}
+        self.report({'INFO'}, "Intersecting with {0}".format(isect_obj.name))
+
+        self._sb = SelectionBackup(context)
+        self._area = context.area
+        self._job = va.intersect_mesh_job(isect_obj)
+        self._start = time.time()
+        self._done = 0
+        self._total = 0
+        wm = context.window_manager
+        wm.progress_begin(0, 100)
+        self._timer = wm.event_timer_add(0.05, context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type in {'MIDDLEMOUSE', 'WHEELUPMOUSE', 'WHEELDOWNMOUSE'}:
+            # allow navigation
+            return {'PASS_THROUGH'}
+
+        if event.type == 'ESC':
+            self.finish(context)
+            self.report({'INFO'}, "Intersection stopped at {0}/{1} voxels, "
+                        "intersect again to finish".format(self._done,
+                                                           self._total))
+            #the finished voxels are kept, so this still needs an undo step
+            return {'FINISHED'}
+
+        if event.type != 'TIMER':
+            return {'RUNNING_MODAL'}
+
+        start = time.time()
+        try:
+            while time.time() - start < ISECT_TICK_BUDGET:
+                self._done, self._total = next(self._job)
+        except StopIteration:
+            self.finish(context)
+            return {'FINISHED'}
+        except Exception:
+            self.finish(context)
+            raise
+        self.update_progress(context)
+        return {'RUNNING_MODAL'}
+
+    def update_progress(self, context):
+        total = max(self._total, 1)
+        context.window_manager.progress_update(
+            int((float(self._done)/float(total))*100.0))
+        if self._area is None:
+            return
+        text = "Intersecting: {0}/{1} voxels".format(self._done, self._total)
+        if self._done:
+            elapsed = time.time() - self._start
+            left = elapsed * (self._total - self._done) / self._done
+            text += ", {0:.0f}s left".format(left)
+        self._area.header_text_set(text + " (ESC to stop)")
+
+    def finish(self, context):
+        """stop the job, which saves what it has finished, and tidy up"""
+        if self._job is not None:
+            self._job.close()
+            self._job = None
+        wm = context.window_manager
+        if self._timer is not None:
+            wm.event_timer_remove(self._timer)
+            self._timer = None
+        wm.progress_end()
+        if self._area is not None:
+            self._area.header_text_set()
+        self._sb.restore()
+
     @classmethod
     def poll(cls, context):
         return VoxelArray.poll_voxelarray_empty_created(context.object)
 
     def cancel(self, context):
+        if self._job is not None:
+            self.finish(context)
         return {'CANCELLED'}
 
+class VoxelArrayVoxelizeOp(Operator):
+    """Operator to fill the voxel array with the voxels of the intersect
+    object. The array is switched to chunk display first, a voxelized
+    mesh being far too many voxels for an object each"""
+    bl_idname = "object.voxelarray_voxelize"
+    bl_label = "Voxelize Object"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    solid = BoolProperty(
+        name="Solid",
+        description="Fill the inside of the object as well as its surface",
+        default=True)
+
+    def execute(self, context):
+        sb = SelectionBackup(context)
+        obj = context.object
+        va = VoxelArray(obj, context)
+        isect_obj = va.get_intersect_obj()
+        if isect_obj is None:
+            self.report({'WARNING'}, "No object to voxelize")
+            return {'CANCELLED'}
+        if not va.display_chunks():
+            obj.vox_empty.display_mode = 'CHUNKS'
+        n = va.voxelize(isect_obj, self.solid)
+        va.commit_edit()
+        sb.restore()
+        message = "Voxelized {0} into {1} voxels".format(isect_obj.name, n)
+        if va.streamed:
+            self.report({'WARNING'}, message + ", straight into the "
+                        "sidecar file, which can't be undone")
+        else:
+            self.report({'INFO'}, message)
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        return VoxelArray.poll_voxelarray_empty_created(context.object)
+
+class VoxelArrayVoxelizeFileOp(Operator, ImportHelper):
+    """Operator to fill the voxel array from a binary STL or PLY file,
+    which is streamed through the voxelizer rather than loaded. Files
+    bigger than memory can only be voxelized into an array with a
+    sidecar file, see VoxelArray.voxelize_batches"""
+    bl_idname = "object.voxelarray_voxelize_file"
+    bl_label = "Voxelize File"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    filename_ext = ".stl"
+    filter_glob = StringProperty(default="*.stl;*.ply", options={'HIDDEN'})
+
+    solid = BoolProperty(
+        name="Solid",
+        description="Fill the inside of the mesh as well as its surface",
+        default=True)
+
+    def execute(self, context):
+        sb = SelectionBackup(context)
+        obj = context.object
+        va = VoxelArray(obj, context)
+        if not va.display_chunks():
+            obj.vox_empty.display_mode = 'CHUNKS'
+        try:
+            n = va.voxelize_file(self.filepath, self.solid)
+        except (IOError, OSError, ValueError) as e:
+            sb.restore()
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        va.commit_edit()
+        sb.restore()
+        message = "Voxelized {0} into {1} voxels".format(
+            os.path.basename(self.filepath), n)
+        if va.streamed:
+            self.report({'WARNING'}, message + ", straight into the "
+                        "sidecar file, which can't be undone")
+        else:
+            self.report({'WARNING'}, message + ". Without a sidecar file "
+                        "the whole array is kept in memory")
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        return VoxelArray.poll_voxelarray_empty_created(context.object)
+
+class VoxelArrayFillCavitiesOp(Operator):
+    """Operator to fill the empty space enclosed by the voxels of the
+    array, see fill_cavities"""
+    bl_idname = "object.voxelarray_fill_cavities"
+    bl_label = "Fill Cavities"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        sb = SelectionBackup(context)
+        obj = context.object
+        va = VoxelArray(obj, context)
+        masks = fill_cavities(va.grid, int(obj.vox_empty.fill_connectivity))
+        n = sum(int(np.count_nonzero(mask)) for mask in masks.values())
+        va.apply_chunk_masks(masks)
+        va.commit_edit()
+        sb.restore()
+        self.report({'INFO'}, "Filled {0} voxels".format(n))
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        return VoxelArray.poll_voxelarray_empty_created(context.object)
+
+class VoxelArrayHollowOp(Operator):
+    """Operator to hollow the voxels of the array out into a shell, see
+    hollow_cells"""
+    bl_idname = "object.voxelarray_hollow"
+    bl_label = "Hollow"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    thickness = IntProperty(
+        name="Wall Thickness",
+        description="Number of voxels left in the walls",
+        min=1,
+        max=CHUNK_SIZE,
+        default=1)
+
+    def execute(self, context):
+        sb = SelectionBackup(context)
+        va = VoxelArray(context.object, context)
+        masks = hollow_cells(va.grid, self.thickness)
+        n = sum(int(np.count_nonzero(mask)) for mask in masks.values())
+        va.apply_chunk_masks(masks, 0)
+        va.commit_edit()
+        sb.restore()
+        self.report({'INFO'}, "Removed {0} voxels".format(n))
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        return VoxelArray.poll_voxelarray_empty_created(context.object)
+
+class VoxelArrayBooleanOp(Operator):
+    """Operator to combine the voxels of the array with the voxels of the
+    boolean array, see VoxelArray.apply_boolean"""
+    bl_idname = "object.voxelarray_boolean"
+    bl_label = "Voxel Boolean"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    operation = EnumProperty(
+        items=[
+        ('UNION', 'Union', 'add the voxels of the other array'),
+        ('DIFFERENCE', 'Difference', 'remove the voxels which are in the '
+                                     'other array'),
+        ('INTERSECT', 'Intersect', 'keep only the voxels which are in the '
+                                   'other array')],
+        name="Operation",
+        default='UNION')
+
+    def execute(self, context):
+        obj = context.object
+        other_obj = context.scene.objects.get(obj.vox_empty.boolean_array)
+        if (other_obj is None or other_obj == obj or
+                not VoxelArray.poll_voxelarray_empty_created(other_obj)):
+            self.report({'ERROR'}, "Pick another voxel array to combine with")
+            return {'CANCELLED'}
+        sb = SelectionBackup(context)
+        va = VoxelArray(obj, context)
+        other = VoxelArray(other_obj, context)
+        n = va.apply_boolean(other.grid, self.operation)
+        va.commit_edit()
+        sb.restore()
+        self.report({'INFO'}, "Changed {0} voxels".format(n))
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        return VoxelArray.poll_voxelarray_empty_created(context.object)
+
+class VoxelArrayImportVoxelsOp(Operator, ImportHelper):
+    """Operator to add the voxels of a MagicaVoxel .vox or a .binvox file to
+    the voxel array, the values of .vox voxels being their palette index"""
+    bl_idname = "object.voxelarray_import_voxels"
+    bl_label = "Import Voxels"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    filename_ext = ".vox"
+    filter_glob = StringProperty(default="*.vox;*.binvox", options={'HIDDEN'})
+
+    def execute(self, context):
+        sb = SelectionBackup(context)
+        obj = context.object
+        va = VoxelArray(obj, context)
+        if not va.display_chunks():
+            obj.vox_empty.display_mode = 'CHUNKS'
+        try:
+            n = va.import_voxels(self.filepath)
+        except (IOError, OSError, ValueError, struct.error) as e:
+            sb.restore()
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        va.commit_edit()
+        sb.restore()
+        self.report({'INFO'}, "Imported {0} voxels from {1}".format(
+            n, os.path.basename(self.filepath)))
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        return VoxelArray.poll_voxelarray_empty_created(context.object)
+
+class VoxelArrayExportVoxOp(Operator, ExportHelper):
+    """Operator to write the voxel array to a MagicaVoxel .vox file"""
+    bl_idname = "object.voxelarray_export_vox"
+    bl_label = "Export .vox"
+
+    filename_ext = ".vox"
+    filter_glob = StringProperty(default="*.vox", options={'HIDDEN'})
+
+    def execute(self, context):
+        va = VoxelArray(context.object, context)
+        try:
+            va.export_voxels(self.filepath)
+        except (IOError, OSError, ValueError) as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        return VoxelArray.poll_voxelarray_empty_created(context.object)
+
+class VoxelArrayExportBinvoxOp(Operator, ExportHelper):
+    """Operator to write the occupancy of the voxel array to a .binvox file"""
+    bl_idname = "object.voxelarray_export_binvox"
+    bl_label = "Export .binvox"
+
+    filename_ext = ".binvox"
+    filter_glob = StringProperty(default="*.binvox", options={'HIDDEN'})
+
+    def execute(self, context):
+        va = VoxelArray(context.object, context)
+        try:
+            va.export_voxels(self.filepath)
+        except (IOError, OSError, ValueError) as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        return VoxelArray.poll_voxelarray_empty_created(context.object)
+
 class VoxelArrayCreateVoxelsOp(Operator):
     """Operator to create and enable voxels on an empty"""
 
@@ -750,6 +5393,7 @@ class VoxelArrayCreateVoxelsOp(Operator):
         obj.vox_empty.created = True
         va = VoxelArray(obj, context)
         va.new_vox(Vector((0, 0, 2)))
+        va.commit_edit()
         va.select()
         del va
         sb.restore()
@@ -769,6 +5413,11 @@ class EditVoxelsOperator(bpy.types.Operator):
     when editing in this operator"""
     bl_idname = "view3d.edit_voxels"
     bl_label = "Voxel Editor"
+    _timer = None
+    #'ADD' or 'DELETE' while a mouse button is held down, see begin_stroke
+    _stroke_mode = None
+    _stroke = None
+    _last_sample = 0.0
 
     def pick_voxel(self, context, event, voxelarray):
         """Run this function on left mouse, execute the ray cast
@@ -789,27 +5438,13 @@ class EditVoxelsOperator(bpy.types.Operator):
         #TODO: raise some kind of error, or do a check/poll on this operator
         #to ensure that there has been a voxel array created and selected
 
-        isects = voxelarray.intersect_ray(ray_origin, ray_target)
-
-        best_dist_squared = ray_max * ray_max
-        best_isect = None
-
-        if isects is None:
-            return None
-
-        for isect in isects:
-            dist_squared = isect.dist_squared
-            if(dist_squared < best_dist_squared):
-                best_dist_squared = dist_squared
-                best_isect = isect
-
-        return best_isect
+        return voxelarray.intersect_ray(ray_origin, ray_target)
 
     def select_voxel(self, context, event):
         sb = SelectionBackup(context)
         va = VoxelArray.get_selected(context)
         isect = self.pick_voxel(context, event, va)
-        if(isect is None):
+        if(isect is None or isect.voxel is None):
             sb.restore()
             return None
         vox = isect.voxel
@@ -817,63 +5452,157 @@ class EditVoxelsOperator(bpy.types.Operator):
         vox.select()
         return vox
 
-    def add_voxel(self, context, event):
-        sb = SelectionBackup(context)
+    def push_undo(self, va, message):
+        """make the edits since the last one an undo step. The operator
+        is modal, so blender doesn't push one for each edit itself"""
+        if va.commit_edit():
+            bpy.ed.undo_push(message=message)
+
+    def begin_stroke(self, context, event, mode):
+        """start collecting the cells under the mouse while the button is
+        held down. Nothing is edited until the button is released, so the
+        rays keep hitting the surface the stroke started on, and the whole
+        stroke goes into the grid as one edit, see end_stroke"""
+        self._stroke_mode = mode
+        #cell -> axis of the normal of the face the ray hit
+        self._stroke = {}
+        self._last_sample = 0.0
+        self.sample_stroke(context, event)
+
+    def sample_stroke(self, context, event, force=False):
+        """add the cell under the mouse to the stroke. Mouse moves come in
+        far faster than they need ray casting, so samples closer together
+        than STROKE_SAMPLE_INTERVAL are dropped, unless force is True"""
+        now = time.time()
+        if not force and now - self._last_sample < STROKE_SAMPLE_INTERVAL:
+            return
+        self._last_sample = now
         va = VoxelArray.get_selected(context)
         isect = self.pick_voxel(context, event, va)
-        if(isect is None):
-            sb.restore()
-            return None
-
-        vox = isect.voxel
-        base_loc = vox.get_local_location()
-        new_loc = isect.nor * 2 + base_loc #add new voxel in direction normal
+        if isect is None:
+            return
+        coord = tuple(isect.coord)
+        if self._stroke_mode == 'ADD':
+            #add new voxel in direction normal
+            coord = tuple(c + int(n) for c, n in zip(coord, isect.nor))
+            if va.obj.vox_empty.brush_shape == 'VOXEL' and va.has_vox(coord):
+                return
+        if coord not in self._stroke:
+            axis = max(range(3), key=lambda a: abs(isect.nor[a]))
+            self._stroke[coord] = axis
+        context.area.header_text_set("{0} {1} voxels".format(
+            "Add" if self._stroke_mode == 'ADD' else "Delete",
+            len(self._stroke)))
+
+    def end_stroke(self, context, event):
+        """make the edit of the stroke, with one update of the display and
+        one undo step. Returns False if the stroke didn't hit anything"""
+        self.sample_stroke(context, event, force=True)
+        mode = self._stroke_mode
+        stroke = self._stroke
+        self._stroke_mode = None
+        self._stroke = None
+        context.area.header_text_set()
+        if not stroke:
+            return False
 
-        new_vox = va.new_vox(new_loc)
+        sb = SelectionBackup(context)
+        va = VoxelArray.get_selected(context)
+        props = va.obj.vox_empty
+        if props.brush_shape != 'VOXEL':
+            va.apply_brush(sorted(stroke.items()), props.brush_shape,
+                           props.brush_radius, 1 if mode == 'ADD' else 0)
+        elif mode == 'ADD':
+            va.add_cells(np.array(sorted(stroke), dtype=np.int64))
+        else:
+            va.remove_cells(np.array(sorted(stroke), dtype=np.int64))
+        self.push_undo(va, "Add Voxels" if mode == 'ADD' else "Delete Voxels")
         sb.restore()
-        #TODO: add a toggle for the select after placement
-        new_vox.select()
-        return new_vox
+        return True
 
-    def delete_voxel(self, context, event):
+    def fill_voxels(self, context, event):
+        """fill the empty space in front of the face under the mouse, as far
+        as the voxels enclose it, see fill_enclosed"""
         sb = SelectionBackup(context)
         va = VoxelArray.get_selected(context)
         isect = self.pick_voxel(context, event, va)
-        #select_none(context)
-        if(isect is not None):
-            vox = isect.voxel
-            vox.delete()
+        if isect is None:
             sb.restore()
-            return True
-        else:
+            return
+        seed = tuple(c + int(n) for c, n in zip(isect.coord, isect.nor))
+        masks = fill_enclosed(va.grid, seed,
+                              int(va.obj.vox_empty.fill_connectivity))
+        if masks is None:
             sb.restore()
-            return False
+            self.report({'WARNING'}, "The space isn't enclosed by voxels")
+            return
+        va.apply_chunk_masks(masks)
+        self.push_undo(va, "Fill Voxels")
+        sb.restore()
+
+    def refine_display(self, context, budget=None):
+        """greedy mesh the chunks left with a quick mesh by recent edits"""
+        va = VoxelArray.get_selected(context)
+        if va is not None:
+            va.refine_display(budget)
+
+    def finish(self, context):
+        if self._stroke_mode is not None:
+            context.area.header_text_set()
+        context.window_manager.event_timer_remove(self._timer)
+        self.refine_display(context)
+        return {'CANCELLED'}
 
     def modal(self, context, event):
         if event.type in {'MIDDLEMOUSE', 'WHEELUPMOUSE', 'WHEELDOWNMOUSE'}:
             # allow navigation
             return {'PASS_THROUGH'}
 
+        if event.type == 'TIMER':
+            #no greedy meshing in the middle of a stroke
+            if self._stroke_mode is None:
+                self.refine_display(context, REMESH_BUDGET)
+            return {'PASS_THROUGH'}
+
+        if event.type == 'MOUSEMOVE' and self._stroke_mode is not None:
+            self.sample_stroke(context, event)
+            return {'RUNNING_MODAL'}
+
+        if (event.type in {'LEFTMOUSE', 'RIGHTMOUSE'} and
+                event.value == 'PRESS'):
+            if self._stroke_mode is None:
+                mode = 'ADD' if event.type == 'LEFTMOUSE' else 'DELETE'
+                self.begin_stroke(context, event, mode)
+            return {'RUNNING_MODAL'}
+
+        if (event.type == 'F' and event.value == 'PRESS' and
+                self._stroke_mode is None):
+            self.fill_voxels(context, event)
+            return {'RUNNING_MODAL'}
+
         if event.type == 'LEFTMOUSE' and event.value == 'RELEASE':
-            self.add_voxel(context, event)
+            if self._stroke_mode == 'ADD':
+                self.end_stroke(context, event)
             return {'RUNNING_MODAL'}
 
         if event.type == 'RIGHTMOUSE' and event.value == 'RELEASE':
-            #TODO: check return value, and cancel operator if
-            #nothing was deleted
-            retval = self.delete_voxel(context, event)
-            if(retval == False):
-                #TODO: add an option for this
-                return {'CANCELLED'}
+            if self._stroke_mode == 'DELETE':
+                if not self.end_stroke(context, event):
+                    #a click on nothing closes the editor
+                    #TODO: add an option for this
+                    return self.finish(context)
 
         if event.type in {'ESC'}:
-            return {'CANCELLED'}
+            return self.finish(context)
 
         return {'RUNNING_MODAL'}
 
     def invoke(self, context, event):
         if context.space_data.type == 'VIEW_3D':
-            context.window_manager.modal_handler_add(self)
+            wm = context.window_manager
+            #the timer drives the deferred greedy meshing between edits
+            self._timer = wm.event_timer_add(0.1, context.window)
+            wm.modal_handler_add(self)
             return {'RUNNING_MODAL'}
         else:
             self.report({'WARNING'}, "Active space must be a View3d")
@@ -883,12 +5612,22 @@ class EditVoxelsOperator(bpy.types.Operator):
 def register():
     bpy.utils.register_module(__name__)
     bpy.types.Object.vox_empty = PointerProperty(type=VoxelEmpty_props)
-
+    bpy.app.handlers.load_post.append(voxel_grids_clear_handler)
+    bpy.app.handlers.save_pre.append(voxel_grids_save_handler)
+    bpy.app.handlers.undo_post.append(voxel_grids_undo_handler)
+    bpy.app.handlers.redo_post.append(voxel_grids_undo_handler)
 
 
 def unregister():
     bpy.utils.unregister_module(__name__)
     del bpy.types.Object.vox_empty
+    bpy.app.handlers.load_post.remove(voxel_grids_clear_handler)
+    bpy.app.handlers.save_pre.remove(voxel_grids_save_handler)
+    bpy.app.handlers.undo_post.remove(voxel_grids_undo_handler)
+    bpy.app.handlers.redo_post.remove(voxel_grids_undo_handler)
+    _voxel_grids.clear()
+    _voxel_indices.clear()
+    close_sidecars()
 
 if __name__ == "__main__":
     register()